@@ -3,16 +3,29 @@ from PyQt5.QtWidgets import *
 from qgis.core import *
 from qgis.gui import *
 from qgis.PyQt.QtGui import QColor, QIcon
-from qgis.PyQt.QtCore import QSize, Qt, QDate
+from qgis.PyQt.QtCore import QSize, Qt, QDate, QDateTime, QVariant, QTimer, QProcess, QProcessEnvironment
 from qgis.PyQt.QtXml import QDomDocument
-import os, shutil, re, math
+from osgeo import gdal, ogr, osr
+import os, sys, io, shutil, re, math, csv, json, hashlib, weakref, time, tempfile, subprocess, cProfile, threading
 from os import path as osp
-from . import xlsxwriter
+from . import xlsxwriter, template_manifest
 import glob
 from collections import Counter
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import locale
-locale.setlocale(locale.LC_ALL, 'de')
+# 'de' is the name on Windows, the export workers may run elsewhere
+for name in ['de', 'de_DE.UTF-8', 'de_DE']:
+    try:
+        locale.setlocale(locale.LC_ALL, name)
+        break
+    except locale.Error:
+        pass
 
 
 '''
@@ -42,12 +55,12 @@ def run(data, resolve, reject):
         data.quotient = divident / divisor
         resolve()
 
-t = Task(run, effort=1, name='Divide by user input')
+t = Task(run, effort=1, name='Divide by user input', needs=['number'], produces=['quotient'])
 
 This class is used only internally in the TaskQueue.
 '''
 class Task:
-    def __init__(self, run, effort=1, name=''):
+    def __init__(self, run, effort=1, name='', depends_on=None, background=False, needs=None, produces=None):
         def callback(data, resolve, reject):
             try:
                 run(data, resolve, reject)
@@ -56,9 +69,15 @@ class Task:
         self.run = callback
         self.effort = effort
         self.name = name
+        self.depends_on = depends_on
+        self.background = background
+        self.needs = needs
+        self.produces = produces if produces else []
+        # only synchronous tasks have a meaningful runtime (no user interaction)
+        self.measured = False
 
     @staticmethod
-    def synchronous(run, effort=1, name=''):
+    def synchronous(run, effort=1, name='', depends_on=None, background=False, needs=None, produces=None):
         def callback(data, resolve, reject):
             try:
                 run(data)
@@ -66,19 +85,529 @@ class Task:
             except BaseException as e:
                 reject(e)
 
-        return Task(callback, effort, name)
+        task = Task(callback, effort, name, depends_on, background, needs, produces)
+        task.measured = True
+        return task
 
 
 '''
+Read-only stand-in for a vector layer in a background task, captured on the
+main thread. QGIS layers are not thread-safe and the main thread keeps
+rendering them, so background tasks read the features from a
+QgsVectorLayerFeatureSource and get a copy of the fields, renderer and
+expression context scopes. Provides the part of the QgsVectorLayer interface
+the evaluations use:
+
+snapshot = LayerSnapshot(layer)    # on the main thread
+snapshot.getFeatures(request)      # in any thread
+snapshot.renderer().categories()
 
+This class is used only internally in the TaskQueue.
+'''
+class LayerSnapshot:
+    def __init__(self, layer):
+        self.layer_id = layer.id()
+        self.layer_name = layer.name()
+        self.layer_crs = QgsCoordinateReferenceSystem(layer.crs())
+        self.layer_fields = QgsFields(layer.fields())
+        self.layer_renderer = layer.renderer().clone() if layer.renderer() else None
+        self.scopes = QgsExpressionContextUtils.globalProjectLayerScopes(layer)
+        self.source = QgsVectorLayerFeatureSource(layer)
+
+    def id(self):
+        return self.layer_id
+
+    def name(self):
+        return self.layer_name
+
+    def crs(self):
+        return self.layer_crs
+
+    def fields(self):
+        return self.layer_fields
+
+    def renderer(self):
+        return self.layer_renderer
+
+    def getFeatures(self, request=None):
+        return self.source.getFeatures(request if request else QgsFeatureRequest())
+
+    '''
+    Expression context scopes of the layer, copied for every context since the
+    context takes ownership of them.
+    '''
+    def expression_scopes(self):
+        return [QgsExpressionContextScope(scope) for scope in self.scopes]
+
+
+'''
+Runs a synchronous Task of a TaskQueue as QgsTask in a worker thread of the
+QGIS task manager. The outcome is reported back on the main thread.
+
+This class is used only internally in the TaskQueue.
+'''
+class BackgroundTask(QgsTask):
+    def __init__(self, task, data, resolve, reject, profiler=None):
+        super().__init__(task.name, QgsTask.CanCancel)
+        self.task = task
+        self.data = data
+        self.resolve = resolve
+        self.reject = reject
+        self.profiler = profiler
+        self.error = None
+        self.elapsed = None
+        self.cpu = None
+
+    def run(self):
+        outcome = []
+        if self.profiler:
+            self.profiler.enable(self.task)
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        self.task.run(self.data, lambda *args: outcome.append(None), outcome.append)
+        self.cpu = time.thread_time() - cpu
+        self.elapsed = time.perf_counter() - start
+        if self.profiler:
+            self.profiler.disable(self.task)
+        self.error = outcome[0] if len(outcome) > 0 else None
+        return self.error is None
+
+    def finished(self, result):
+        if result:
+            self.resolve(self.elapsed, self.cpu)
+        else:
+            self.reject(self.error if self.error else RuntimeError(f'"{self.task.name}" wurde abgebrochen.'))
+
+
+'''
+Measured runtimes of the tasks of a TaskQueue, kept between runs in a JSON
+file. Runtimes are stored per unit of effort, so that the estimate of a task
+whose effort depends on the input (e.g. one unit per Fotopunkt) scales with it.
+Tasks that never ran are estimated with the median rate of all known tasks.
+'''
+class RuntimeHistory:
+    # weight of a new measurement in the moving average
+    SMOOTHING = 0.5
+
+    def __init__(self, path=None):
+        self.path = path
+        self.rates = {}
+        if path and osp.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.rates = json.load(f)
+            except ValueError:
+                self.rates = {}
+
+    def default_rate(self):
+        if len(self.rates) == 0:
+            return 1.0
+        rates = sorted(self.rates.values())
+        return rates[len(rates) // 2]
+
+    def estimate(self, task):
+        if not task.measured:
+            return 0
+        rate = self.rates[task.name] if task.name in self.rates else self.default_rate()
+        return rate * max(task.effort, 1)
+
+    def record(self, task, seconds):
+        if not task.measured or seconds is None:
+            return
+        rate = seconds / max(task.effort, 1)
+        if task.name in self.rates:
+            rate = RuntimeHistory.SMOOTHING * rate + (1 - RuntimeHistory.SMOOTHING) * self.rates[task.name]
+        self.rates[task.name] = rate
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.rates, f, indent=2)
+        os.replace(temporary, self.path)
+
+
+'''
+Fingerprint of the data and style of a layer, or None if it has unsaved edits.
+Layers of files are identified by source, filter, feature count and the
+modification time and size of every file an edit may land in (the -wal file
+of a GeoPackage or SQLite database, the .dbf of a shapefile). Vector layers
+without such a change signal (memory layers, databases and services) are
+identified by a checksum of their features, other layers (e.g. web tiles) by
+their source. If a memo (layer id: fingerprint) is given, every layer is
+fingerprinted once.
+'''
+def layer_fingerprint(layer, memo=None):
+    if memo is not None:
+        if layer.id() not in memo:
+            memo[layer.id()] = layer_fingerprint(layer)
+        return memo[layer.id()]
+
+    doc = QDomDocument()
+    layer.exportNamedStyle(doc)
+    digest = hashlib.blake2b(doc.toString().encode(), digest_size=16)
+    if isinstance(layer, QgsVectorLayer) and layer.isModified():
+        return None
+
+    def feature_digest():
+        for feature in layer.getFeatures():
+            digest.update(bytes(feature.geometry().asWkb()))
+            digest.update(repr(feature.attributes()).encode())
+        return digest.hexdigest()
+
+    if layer.providerType() == 'memory':
+        return feature_digest()
+
+    fingerprint = [layer.providerType(), layer.source(), digest.hexdigest()]
+    if isinstance(layer, QgsVectorLayer):
+        fingerprint += [layer.subsetString(), layer.featureCount()]
+    path = layer.source().split('|')[0]
+    if osp.isfile(path):
+        files = [path, path + '-wal']
+        if path.lower().endswith('.shp'):
+            files += [osp.splitext(path)[0] + extension for extension in ['.dbf', '.shx']]
+        for file in files:
+            if osp.isfile(file):
+                stat = os.stat(file)
+                fingerprint += [osp.basename(file), stat.st_mtime_ns, stat.st_size]
+    elif isinstance(layer, QgsVectorLayer):
+        # e.g. PostgreSQL, which tells nothing about changes
+        fingerprint.append(feature_digest())
+    return fingerprint
+
+
+'''
+Records, in a JSON file next to the outputs of a TaskQueue, from which inputs
+each output file was created. The inputs of a task are the values of the keys
+it needs; layers are compared with layer_fingerprint, so only the attributes
+that the LayerSelector kept matter. With data.incremental, a task whose output
+files exist and whose inputs did not change since they were recorded is not
+run again. Without it, no inputs are fingerprinted and the records are
+dropped, so the first incremental run creates and records all outputs. The
+layer fingerprints may be shared with a RenderCache of the same run.
+'''
+class Manifest:
+    FILENAME = '.auswertungstools.json'
+
+    def __init__(self, fingerprints=None):
+        self.path = None
+        self.tasks = {}
+        self.fingerprints = fingerprints if fingerprints is not None else {}
+        self.pending = {}
+        self.modified = False
+
+    @staticmethod
+    def outputs(task):
+        # keys of the shared data never contain a dot, file names always do
+        return [key for key in task.produces if '.' in key]
+
+    def load(self, data):
+        path = osp.join(data.destination, Manifest.FILENAME)
+        if path == self.path:
+            return
+        self.path = path
+        self.tasks = {}
+        if data.incremental and osp.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.tasks = json.load(f)
+            except (OSError, ValueError):
+                self.tasks = {}
+        self.modified = True
+
+    def value_fingerprint(self, value):
+        if isinstance(value, QgsMapLayer):
+            return layer_fingerprint(value, self.fingerprints)
+        if isinstance(value, QgsFeature):
+            wkb = bytes(value.geometry().asWkb())
+            return [repr(value.attributes()), hashlib.blake2b(wkb, digest_size=16).hexdigest()]
+        if isinstance(value, QgsRectangle):
+            return value.toString(6)
+        if isinstance(value, QDate):
+            return value.toString(Qt.ISODate)
+        if isinstance(value, (list, tuple)):
+            return [self.value_fingerprint(x) for x in value]
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        # objects without content of their own, e.g. caches
+        return type(value).__name__
+
+    '''
+    Return the fingerprint of the inputs of the task, or None if one of them
+    cannot be compared (a layer with unsaved edits).
+    '''
+    def fingerprint(self, task, data):
+        values = []
+        for key in sorted(task.needs):
+            value = self.value_fingerprint(data.get(key))
+            if value is None and isinstance(data.get(key), QgsMapLayer):
+                return None
+            values.append([key, value])
+        return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+    '''
+    Determine whether the outputs of a task that is about to start are up to
+    date. If they are not, the task's record is dropped until it completes.
+    '''
+    def current(self, task, data):
+        outputs = Manifest.outputs(task)
+        if len(outputs) == 0 or not data.destination:
+            return False
+
+        self.load(data)
+        if not data.incremental:
+            return False
+        fingerprint = self.fingerprint(task, data)
+        recorded = self.tasks.get(task.name)
+        if fingerprint and recorded and recorded['inputs'] == fingerprint and \
+                recorded['outputs'] == outputs and all([osp.exists(osp.join(data.destination, o)) for o in outputs]):
+            return True
+
+        if task.name in self.tasks:
+            del self.tasks[task.name]
+            self.modified = True
+        self.pending[task] = (fingerprint, outputs)
+        return False
+
+    def record(self, task):
+        if task not in self.pending:
+            return
+        (fingerprint, outputs) = self.pending.pop(task)
+        if fingerprint:
+            self.tasks[task.name] = { 'inputs': fingerprint, 'outputs': outputs }
+            self.modified = True
+
+    '''
+    Output files of earlier runs that still exist, relative to data.destination.
+    '''
+    def existing_outputs(self, data):
+        self.load(data)
+        outputs = [o for record in self.tasks.values() for o in record['outputs']]
+        return [o for o in outputs if osp.exists(osp.join(data.destination, o))]
+
+    def save(self):
+        if not self.path or not self.modified:
+            return
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.tasks, f, indent=2)
+        self.modified = False
+
+
+'''
+Peak resident memory of this process in bytes so far, or None if the platform
+does not tell.
+'''
+def peak_memory():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD),
+                ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+'''
+Records for every task of a TaskQueue its wall time, the CPU time of the
+thread that ran it, the peak resident memory of the process once it finished
+and the number of features of the layers it needs. For tasks waiting for
+other processes or the user, the CPU time only covers the code run by the
+task itself. With profile=True, the tasks additionally run under cProfile
+(where no other task is profiled at the same time).
+
+The report is written as JSON into data.destination (see FILENAME), the
+cProfile statistics into the folder PROFILES next to it. Example:
+
+q = TaskQueue(parallel=True, profiler=TaskProfiler())
+...
+q.data.profiler.slowest(3)  # [(name, seconds), ...]
+'''
+class TaskProfiler:
+    FILENAME = '.auswertungstools-timings.json'
+    PROFILES = '.auswertungstools-profiles'
+
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.records = []
+        self.features = {}
+        self.profiles = {}
+        self.active = {}
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+
+    '''
+    Count the features of the layers the task needs. Called on the main thread
+    when the task is started.
+    '''
+    def count_features(self, task, data):
+        counts = {}
+        for key in task.needs or []:
+            value = data.get(key)
+            if isinstance(value, QgsVectorLayer):
+                counts[key] = value.featureCount()
+        self.features[task] = counts
+
+    '''
+    Start profiling the task on the calling thread.
+    '''
+    def enable(self, task):
+        if not self.profile:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another task is being profiled on another thread
+            return
+        self.active[task] = profile
+
+    def disable(self, task):
+        profile = self.active.pop(task, None)
+        if profile is not None:
+            profile.disable()
+            self.profiles[task] = profile
+
+    def record(self, task, elapsed=None, cpu=None, skipped=False):
+        peak = peak_memory()
+        self.records.append({
+            'name': task.name,
+            'status': 'skipped' if skipped else 'done',
+            'measured': task.measured,
+            'wall_seconds': elapsed,
+            'cpu_seconds': cpu,
+            'peak_rss_mb': round(peak / (1 << 20), 1) if peak else None,
+            'features': self.features.pop(task, {}),
+            'profile': None,
+            'task': task,
+        })
+
+    '''
+    Names and wall times of the n slowest tasks so far, not counting the tasks
+    waiting for the user.
+    '''
+    def slowest(self, n=3):
+        records = [r for r in self.records if r['measured'] and r['wall_seconds'] is not None]
+        records.sort(key=lambda r: r['wall_seconds'], reverse=True)
+        return [(r['name'], r['wall_seconds']) for r in records[:n]]
+
+    def save(self, data, status='done'):
+        # tasks on the main thread that failed are still being profiled
+        for task in list(self.active):
+            self.disable(task)
+        if not data.destination or not osp.isdir(data.destination):
+            return
+
+        tasks = []
+        for (i, record) in enumerate(self.records):
+            record = dict(record)
+            task = record.pop('task')
+            if task in self.profiles:
+                directory = osp.join(data.destination, TaskProfiler.PROFILES)
+                os.makedirs(directory, exist_ok=True)
+                name = re.sub(r'[^\w-]+', '_', task.name) or 'task'
+                path = osp.join(directory, f'{i:02d}-{name}.prof')
+                self.profiles.pop(task).dump_stats(path)
+                record['profile'] = osp.relpath(path, data.destination)
+            tasks.append(record)
+
+        peak = peak_memory()
+        report = {
+            'started': self.started.isoformat(timespec='seconds'),
+            'status': status,
+            'wall_seconds': time.perf_counter() - self.start,
+            'peak_rss_mb': round(peak / (1 << 20), 1) if peak else None,
+            'tasks': tasks,
+        }
+        path = osp.join(data.destination, TaskProfiler.FILENAME)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        os.replace(temporary, path)
+
+
+'''
+Runs tasks sharing the data of the queue. By default, the tasks are run one
+after another on the main thread in the order they were added.
+
+With parallel=True, the queue builds a dependency graph and starts each task
+as soon as the tasks it depends on are complete. Dependencies are derived from
+the keys a task needs and the keys other tasks produce (attributes of the
+shared data or files relative to data.destination), or given explicitly as
+depends_on. A task declaring neither depends on all tasks added before it.
+Tasks added with background=True are run concurrently as QgsTask on the task
+manager of QGIS, all other tasks are run on the main thread, one at a time.
+An asynchronous task that goes on to wait for something else than the main
+thread (e.g. external processes) releases it with q.release(task), so that the
+next task on the main thread starts while it keeps running. A task whose work
+goes on outside of its callback (background tasks, external processes)
+registers how to cancel it with q.cancel_on_abort(task, cancel).
+Background tasks must not touch the GUI; the vector layers they need are
+replaced by a LayerSnapshot in their view of the shared data. Among the tasks that are ready, the
+one with the longest remaining critical path is started first.
+
+If a RuntimeHistory is given, the critical paths and the reported progress are
+based on the measured runtimes of earlier runs instead of the static efforts,
+and the runtimes of this run are recorded. If a Manifest is given, tasks whose
+output files are up to date are skipped (see Manifest). If a TaskProfiler is
+given, it is available as data.profiler and records every task, its report is
+written once the queue is done or aborted. Example:
+
+q = TaskQueue(parallel=True, history=RuntimeHistory(path), manifest=Manifest(), profiler=TaskProfiler())
+q.add_async_task(show_dialog, produces=['layer', 'destination'])
+q.add_task(calculate_statistics, background=True, needs=['layer'], produces=['statistics.tex'])
+q.add_task(render_map, needs=['layer', 'destination'], produces=['map.pdf'])
+q.add_task(show_success)    # waits for all tasks above
+q.start()
 '''
 class TaskQueue:
     IDLE = 0
     RUNNING = 1
     ABORTED = 2
 
-    def __init__(self):
+    def __init__(self, parallel=False, history=None, manifest=None, profiler=None):
+        self.parallel = parallel
+        self.history = history
+        self.manifest = manifest
+        self.profiler = profiler
         self.tasks = []
+        self.added = []
+        self.running = {}
+        self.completed = set()
+        self.dependents = {}
+        self.priorities = {}
+        self.partial = {}
+        self.checked = set()
+        # task holding the main thread and callbacks releasing it
+        self.main_thread_task = None
+        self.releases = {}
+        # functions cancelling the work of running tasks
+        self.cancels = {}
         self.total_effort = 0
         self.progress = 0
         self.status = TaskQueue.IDLE
@@ -91,25 +620,64 @@ class TaskQueue:
         self.on_error = noop
 
     def notify(self):
-        total = self.total_effort
-        progress = self.progress / total if total > 0 else 0
-        self.on_task_complete(progress)
+        if self.history:
+            total = sum([self.history.estimate(task) for task in self.added])
+            progress = sum([self.history.estimate(task) for task in self.completed])
+            progress += sum([self.history.estimate(task) * f for (task, f) in self.partial.items()])
+        else:
+            total = self.total_effort
+            progress = self.progress + sum([task.effort * f for (task, f) in self.partial.items()])
+        self.on_task_complete(progress / total if total > 0 else 0)
 
     def handle_error(self, e):
+        if self.status == TaskQueue.ABORTED:
+            return
         self.on_error(e)
         self.abort()
 
-    def add_task(self, run, effort=1, name=''):
-        task = Task.synchronous(run, effort, name)
+    def append(self, task):
+        if task.depends_on is None:
+            task.depends_on = list(self.added) if task.needs is None else []
+        else:
+            task.depends_on = list(task.depends_on)
+        if task.needs is None:
+            task.needs = []
         self.tasks.append(task)
-        self.total_effort += effort
+        self.added.append(task)
+        self.total_effort += task.effort
         return task
 
-    def add_async_task(self, run, effort=1, name=''):
-        task = Task(run, effort, name)
-        self.tasks.append(task)
-        self.total_effort += effort
-        return task
+    def add_task(self, run, effort=1, name='', depends_on=None, background=False, needs=None, produces=None):
+        return self.append(Task.synchronous(run, effort, name, depends_on, background, needs, produces))
+
+    def add_async_task(self, run, effort=1, name='', depends_on=None, needs=None, produces=None):
+        return self.append(Task(run, effort, name, depends_on, False, needs, produces))
+
+    '''
+    Report the progress of a running task as fraction between 0 and 1.
+    '''
+    def report(self, task, fraction):
+        if task in self.completed:
+            return
+        self.partial[task] = fraction
+        self.notify()
+
+    '''
+    Let the next task run on the main thread while the given asynchronous task
+    waits for the rest of its work to be done elsewhere (parallel mode only).
+    The task keeps running until it resolves.
+    '''
+    def release(self, task):
+        callback = self.releases.pop(task, None)
+        if callback:
+            callback()
+
+    '''
+    Register a function cancelling the rest of the work of the given running
+    task, called if the queue is aborted before the task resolves.
+    '''
+    def cancel_on_abort(self, task, cancel):
+        self.cancels[task] = cancel
 
     def update_effort(self, task, effort):
         self.total_effort += effort - task.effort
@@ -122,22 +690,226 @@ class TaskQueue:
 
         if len(self.tasks) == 0:
             self.status = TaskQueue.IDLE
+            if self.profiler:
+                self.profiler.save(self.data)
             return
 
         task = self.tasks.pop(0)
+        if self.profiler:
+            self.profiler.count_features(task, self.data)
+            self.profiler.enable(task)
+        start = time.perf_counter()
+        cpu = time.thread_time()
         def callback(*args):
+            self.cancels.pop(task, None)
+            if self.profiler:
+                self.profiler.disable(task)
+                self.profiler.record(task, time.perf_counter() - start, time.thread_time() - cpu)
+            self.partial.pop(task, None)
             self.progress += task.effort
             self.notify()
             self.next()
 
         task.run(self.data, callback, self.handle_error)
 
+    '''
+    Add the dependencies implied by needs and produces.
+    '''
+    def build_graph(self):
+        producers = {}
+        for task in self.added:
+            for key in task.produces:
+                producers.setdefault(key, []).append(task)
+
+        self.dependents = { task: [] for task in self.added }
+        for task in self.added:
+            for key in task.needs:
+                for producer in producers.get(key, []):
+                    if producer is not task and producer not in task.depends_on:
+                        task.depends_on.append(producer)
+            for dependency in task.depends_on:
+                self.dependents[dependency].append(task)
+
+        self.rank()
+
+    '''
+    Rank every task by the estimated runtime of the longest path from it to the
+    end of the graph.
+    '''
+    def rank(self):
+        def cost(task):
+            return self.history.estimate(task) if self.history else task.effort
+
+        visiting = set()
+        def rank(task):
+            if task in self.priorities:
+                return self.priorities[task]
+            if task in visiting:
+                raise RuntimeError(f'Zyklische Abhängigkeit bei "{task.name}".')
+            visiting.add(task)
+            self.priorities[task] = cost(task) + max([rank(d) for d in self.dependents[task]] + [0])
+            visiting.remove(task)
+            return self.priorities[task]
+
+        self.priorities = {}
+        for task in self.added:
+            rank(task)
+
+    '''
+    Start all tasks whose dependencies are complete (parallel mode only).
+    '''
+    def schedule(self):
+        if self.status != TaskQueue.RUNNING:
+            return
+
+        if len(self.tasks) == 0 and len(self.running) == 0:
+            self.status = TaskQueue.IDLE
+            if self.history:
+                self.history.save()
+            if self.manifest:
+                self.manifest.save()
+            if self.profiler:
+                self.profiler.save(self.data)
+            return
+
+        # efforts may have changed since the last ranking
+        self.rank()
+        ready = [task for task in self.tasks if all([d in self.completed for d in task.depends_on])]
+        if self.manifest:
+            up_to_date = []
+            for task in ready:
+                if task not in self.checked:
+                    self.checked.add(task)
+                    if self.manifest.current(task, self.data):
+                        up_to_date.append(task)
+            if len(up_to_date) > 0:
+                for task in up_to_date:
+                    self.tasks.remove(task)
+                    self.completed.add(task)
+                    self.progress += task.effort
+                    if self.profiler:
+                        self.profiler.record(task, skipped=True)
+                self.notify()
+                self.schedule()
+                return
+
+        ready.sort(key=lambda task: self.priorities[task], reverse=True)
+        for task in ready:
+            if task.background:
+                self.tasks.remove(task)
+                self.run_background(task)
+            elif self.main_thread_task is None:
+                self.tasks.remove(task)
+                self.run_main_thread(task)
+
+        if len(self.running) == 0 and self.main_thread_task is None and len(self.tasks) > 0:
+            names = ', '.join([f'"{task.name}"' for task in self.tasks])
+            self.handle_error(RuntimeError(f'Abhängigkeiten der folgenden Schritte können nicht erfüllt werden: {names}'))
+
+    def complete(self, task, elapsed=None, cpu=None):
+        if task in self.completed:
+            return
+        if task in self.running:
+            del self.running[task]
+        self.cancels.pop(task, None)
+        if self.history:
+            self.history.record(task, elapsed)
+        if self.profiler:
+            self.profiler.record(task, elapsed, cpu)
+        if self.manifest:
+            self.manifest.record(task)
+        self.partial.pop(task, None)
+        self.completed.add(task)
+        self.progress += task.effort
+        self.notify()
+        self.schedule()
+
+    def run_main_thread(self, task):
+        self.main_thread_task = task
+        self.running[task] = None
+
+        def run():
+            if self.profiler:
+                self.profiler.count_features(task, self.data)
+                self.profiler.enable(task)
+            start = time.perf_counter()
+            cpu = time.thread_time()
+            # CPU time of the task on the main thread, once released
+            used = []
+
+            def release():
+                if self.main_thread_task is not task:
+                    return
+                self.main_thread_task = None
+                used.append(time.thread_time() - cpu)
+                if self.profiler:
+                    self.profiler.disable(task)
+                self.schedule()
+
+            def resolve(*args):
+                self.releases.pop(task, None)
+                if self.main_thread_task is task:
+                    self.main_thread_task = None
+                if self.profiler:
+                    self.profiler.disable(task)
+                self.complete(task, time.perf_counter() - start, used[0] if used else time.thread_time() - cpu)
+
+            self.releases[task] = release
+            task.run(self.data, resolve, self.handle_error)
+
+        # run from the event loop, so that the GUI and finished background
+        # tasks are processed in between
+        QTimer.singleShot(0, run)
+
+    def run_background(self, task):
+        if self.profiler:
+            # layers must only be accessed from the main thread
+            self.profiler.count_features(task, self.data)
+        # the task sees snapshots of the layers it needs, taken on this thread
+        data = self.data
+        layers = [key for key in task.needs if isinstance(data.get(key), QgsVectorLayer)]
+        if len(layers) > 0:
+            data = dotdict(self.data)
+            for key in layers:
+                data[key] = LayerSnapshot(self.data[key])
+
+        def resolve(elapsed, cpu):
+            # values the task produced in its view of the shared data
+            for key in task.produces:
+                if '.' not in key and key in data and data is not self.data:
+                    self.data[key] = data[key]
+            self.complete(task, elapsed, cpu)
+
+        background_task = BackgroundTask(task, data, resolve, self.handle_error, self.profiler)
+        self.running[task] = background_task
+        self.cancel_on_abort(task, background_task.cancel)
+        QgsApplication.taskManager().addTask(background_task)
+
     def start(self):
         self.status = TaskQueue.RUNNING
-        self.next()
+        if self.profiler:
+            self.data.profiler = self.profiler
+        if self.parallel:
+            try:
+                self.build_graph()
+            except RuntimeError as e:
+                self.handle_error(e)
+                return
+            self.schedule()
+        else:
+            self.next()
 
     def abort(self):
         self.status = TaskQueue.ABORTED
+        if self.manifest:
+            # keep the records of the tasks that did complete
+            self.manifest.save()
+        if self.profiler:
+            self.profiler.save(self.data, status='aborted')
+        cancels = list(self.cancels.values())
+        self.cancels = {}
+        for cancel in cancels:
+            cancel()
 
 
 '''
@@ -183,6 +955,151 @@ class SelectDirectoryWidget(QWidget):
         self.path = QFileDialog.getExistingDirectory(None, 'Ordner auswählen')
         self.label.setText(self.path)
 
+'''
+Index of the layers of the project for the lookups of the dialogs: layers by a
+part of their name and vector layers by required fields and renderer. The
+field names and renderer type of every layer are read once, and every lookup
+is answered from a memo after its first call. The catalog follows the project
+through its signals (layers added or removed, fields, renderer or name of a
+layer changed), which clear the memo. Example:
+
+catalog = LayerCatalog.instance()
+catalog.layers_named('OpenStreetMap')
+catalog.layers_with_fields(['Ort', 'Kreis'], 'categorizedSymbol')
+'''
+class LayerCatalog:
+    catalog = None
+
+    def __init__(self, project):
+        self.project = project
+        self.layers = {}
+        self.fields = {}
+        self.renderers = {}
+        self.slots = {}
+        self.memo = {}
+
+        project.layersAdded.connect(self.add_layers)
+        # the layers are already deleted once layersRemoved is emitted
+        project.layersWillBeRemoved.connect(self.remove_layers)
+        project.cleared.connect(self.rebuild)
+        self.rebuild()
+
+    @staticmethod
+    def instance():
+        if LayerCatalog.catalog is None:
+            LayerCatalog.catalog = LayerCatalog(QgsProject.instance())
+        return LayerCatalog.catalog
+
+    '''
+    Stop following the project (when the plugin is unloaded).
+    '''
+    @staticmethod
+    def release():
+        catalog = LayerCatalog.catalog
+        if catalog is None:
+            return
+        LayerCatalog.catalog = None
+        catalog.project.layersAdded.disconnect(catalog.add_layers)
+        catalog.project.layersWillBeRemoved.disconnect(catalog.remove_layers)
+        catalog.project.cleared.disconnect(catalog.rebuild)
+        for (id, layer) in list(catalog.layers.items()):
+            catalog.disconnect_layer(id, layer)
+
+    def rebuild(self):
+        for (id, layer) in list(self.layers.items()):
+            self.disconnect_layer(id, layer)
+        self.layers = {}
+        self.fields = {}
+        self.renderers = {}
+        self.add_layers(self.project.mapLayers().values())
+
+    def add_layers(self, layers):
+        for layer in layers:
+            self.layers[layer.id()] = layer
+            self.index_layer(layer)
+
+            slot = lambda *args, layer=layer: self.layer_changed(layer)
+            self.slots[layer.id()] = slot
+            layer.nameChanged.connect(slot)
+            if layer.type() == QgsMapLayer.VectorLayer:
+                layer.updatedFields.connect(slot)
+                layer.rendererChanged.connect(slot)
+        self.clear()
+
+    def remove_layers(self, ids):
+        for id in ids:
+            self.fields.pop(id, None)
+            self.renderers.pop(id, None)
+            layer = self.layers.pop(id, None)
+            if layer:
+                self.disconnect_layer(id, layer)
+        self.clear()
+
+    '''
+    Disconnect the slots of a layer, which may already be deleted: only its id
+    is used to look up the slot.
+    '''
+    def disconnect_layer(self, id, layer):
+        slot = self.slots.pop(id, None)
+        if not slot:
+            return
+        try:
+            layer.nameChanged.disconnect(slot)
+            if layer.type() == QgsMapLayer.VectorLayer:
+                layer.updatedFields.disconnect(slot)
+                layer.rendererChanged.disconnect(slot)
+        except (TypeError, RuntimeError):
+            # the layer is already deleted
+            pass
+
+    def index_layer(self, layer):
+        if layer.type() != QgsMapLayer.VectorLayer:
+            return
+        self.fields[layer.id()] = frozenset(layer.fields().names())
+        renderer = layer.renderer()
+        self.renderers[layer.id()] = renderer.type() if renderer else None
+
+    def layer_changed(self, layer):
+        self.index_layer(layer)
+        self.clear()
+
+    def clear(self):
+        self.memo = {}
+
+    '''
+    Layers whose name contains key, in the order of the project.
+    '''
+    def layers_named(self, key):
+        memo_key = ('name', key)
+        if memo_key not in self.memo:
+            self.memo[memo_key] = [layer for layer in self.layers.values() if key in layer.name()]
+        return self.memo[memo_key]
+
+    '''
+    Vector layers having all required fields and, if given, the renderer type.
+    '''
+    def layers_with_fields(self, required_fields, renderer=None):
+        memo_key = ('fields', frozenset(required_fields), renderer or None)
+        if memo_key not in self.memo:
+            required = frozenset(required_fields)
+            self.memo[memo_key] = [
+                layer for (id, layer) in self.layers.items()
+                if id in self.fields and required <= self.fields[id]
+                    and (not renderer or self.renderers[id] == renderer)
+            ]
+        return self.memo[memo_key]
+
+    '''
+    All other layers, i.e. those the user may not choose for these fields.
+    '''
+    def layers_without_fields(self, required_fields, renderer=None):
+        memo_key = ('exceptions', frozenset(required_fields), renderer or None)
+        if memo_key not in self.memo:
+            allowed = set(self.layers_with_fields(required_fields, renderer))
+            self.memo[memo_key] = [layer for layer in self.layers.values() if layer not in allowed]
+        return self.memo[memo_key]
+
+
 class LayerSelector:
     def __init__(self, parent, layout, options):
         self.input = QgsMapLayerComboBox(parent)
@@ -198,6 +1115,9 @@ class LayerSelector:
 
         layout.addRow(options['label'], self.input)
 
+        # part of the selected features that is copied (None copies everything)
+        self.projection = options['projection'] if 'projection' in options else None
+
         if 'select_features' in options:
             self.in_selection = QCheckBox('Objekte in Layer-Auswahl')
             self.in_polygons = QCheckBox('Objekte in Polygonen')
@@ -224,29 +1144,25 @@ class LayerSelector:
                 return
 
             if self.in_selection:
-                if self.in_selection.isChecked():
-                    layer = GeneratePresentation.features_within_selection(layer)
-                else:
-                    layer = GeneratePresentation.features_within_polygons(layer, selected_polygons)
+                in_selection = self.in_selection.isChecked()
+                layer = LayerSelector.select_features(layer, selected_polygons, in_selection, self.projection)
 
             return layer
 
+    '''
+    Copy the features of the layer within its selection or within the selected
+    polygons, keeping the given Projection. A spatial index of the layer (with
+    geometries) speeds up repeated selections within polygons.
+    '''
     @staticmethod
-    def layers_with_fields(required_fields, renderer=None):
-        def allowed(layer):
-            if layer.type() != QgsMapLayer.VectorLayer:
-                return False
+    def select_features(layer, selected_polygons, in_selection=False, projection=None, index=None):
+        if in_selection:
+            return GeneratePresentation.features_within_selection(layer, projection)
+        return GeneratePresentation.features_within_polygons(layer, selected_polygons, projection, index)
 
-            if renderer and layer.renderer().type() != renderer:
-                return False
-
-            fields = layer.fields().names()
-            for field in required_fields:
-                if field not in fields:
-                    return False
-            return True
-        layers = QgsProject.instance().mapLayers().values()
-        return list(filter(allowed, layers))
+    @staticmethod
+    def layers_with_fields(required_fields, renderer=None):
+        return list(LayerCatalog.instance().layers_with_fields(required_fields, renderer))
 
     '''
     Determine which layers do NOT conform to the given fields and renderer
@@ -255,15 +1171,15 @@ class LayerSelector:
     '''
     @staticmethod
     def get_exceptions(required_fields, renderer, optional):
-        all_layers = QgsProject.instance().mapLayers().values()
-        allowed = LayerSelector.layers_with_fields(required_fields, renderer)
+        catalog = LayerCatalog.instance()
+        allowed = catalog.layers_with_fields(required_fields, renderer)
 
         if not optional and len(allowed) == 0:
             required = ', '.join(['"' + f + '"' for f in required_fields])
             r = 'Renderer "' + renderer + '" und' if renderer else ''
             raise RuntimeError(f'Kein Layer mit {r} den folgenden Attributfeldern gefunden: ' + required + '.')
 
-        return list(set(all_layers) - set(allowed))
+        return list(catalog.layers_without_fields(required_fields, renderer))
 
 
 '''
@@ -280,7 +1196,10 @@ class EvaluationDialog(QDialog):
     * text_fields: Text metadata the user should be asked to input. For example,
         { 'age': { 'label': 'Alter', 'value': 31   } }
       would ask the user to enter their age, with a default value of 31. The
-      users answer will be written to data.age.
+      users answer will be written to data.age. A value of True or False is
+      asked for with a checkbox, an integer with a spin box (optionally within
+      'minimum' and 'maximum'). With 'choices' (value: label), one of the
+      values is chosen in a combo box.
     * layer_fields: Layers the user should be asked to choose. Example:
       {
         'polygons': {
@@ -290,7 +1209,9 @@ class EvaluationDialog(QDialog):
         }
       }
       This would prompt the reader to select a layer with the fields 'Ort',
-      'Kreis', 'Bundesland' and a QgsCategorizedSymbolRenderer.
+      'Kreis', 'Bundesland' and a QgsCategorizedSymbolRenderer. With
+      'select_features', only the features within the selection or polygons
+      are used; 'projection' then is the Projection to keep of them.
     '''
     def __init__(self, on_accept, data, text_fields={}, layer_fields={}):
         super().__init__()
@@ -305,10 +1226,22 @@ class EvaluationDialog(QDialog):
         self.feature_fields = {}
 
         for key, field in text_fields.items():
-            if isinstance(field['value'], QDate):
+            if 'choices' in field:
+                input = QComboBox(self)
+                for (value, label) in field['choices'].items():
+                    input.addItem(label, value)
+                input.setCurrentIndex(max(input.findData(field['value']), 0))
+            elif isinstance(field['value'], QDate):
                 input = QDateEdit(self)
                 input.setDisplayFormat('dd.MM.yyyy')
                 input.setDate(field['value'])
+            elif isinstance(field['value'], bool):
+                input = QCheckBox(self)
+                input.setChecked(field['value'])
+            elif isinstance(field['value'], int):
+                input = QSpinBox(self)
+                input.setRange(field.get('minimum', 0), field.get('maximum', 999))
+                input.setValue(field['value'])
             else:
                 input = QLineEdit(self)
                 input.setText(field['value'])
@@ -342,7 +1275,16 @@ class EvaluationDialog(QDialog):
             return
 
         for key, field in self.text_fields.items():
-            self.data[key] = field.date() if isinstance(field, QDateEdit) else field.text()
+            if isinstance(field, QDateEdit):
+                self.data[key] = field.date()
+            elif isinstance(field, QCheckBox):
+                self.data[key] = field.isChecked()
+            elif isinstance(field, QSpinBox):
+                self.data[key] = field.value()
+            elif isinstance(field, QComboBox):
+                self.data[key] = field.currentData()
+            else:
+                self.data[key] = field.text()
 
         for key, field in self.layer_fields.items():
             self.data[key] = field.get_layer(self.data.selection)
@@ -360,8 +1302,11 @@ def format_number_latex(x):
         return str(x)
 
 '''
-Unified way to store data in a table and export it to LaTeX code or to an Excel
-file. Tuples as cell entries indicate a quantity together with a unit. Example:
+Unified way to store data in a table and export it to LaTeX code, to an Excel
+file, to CSV or to JSON. Tuples as cell entries indicate a quantity together
+with a unit. The cells are split into value and unit columns once when a row
+is added, all exports render from these columns without changing them.
+Example:
 
 # Create table with blue table head:
 my_table = Table()
@@ -375,6 +1320,9 @@ my_table.add_row(['Berta', 56, (61, 'kg')])
 # command to handle the color.
 my_table.to_latex('lrr', 'coloredbullet')
 
+# Sum up the ages in Excel instead of writing the number
+my_table.set_xlsx_cell(2, 1, '=SUM(C2:C3)')
+
 # Convert the table to Excel with column widths 20, 5, 5, 2 (for the 'kg' column)
 my_table.to_xlsx(handle_to_xlsx_file, [20, 5, 5, 2])
 '''
@@ -384,22 +1332,51 @@ class Table:
         PRIMARY = 1
         SECONDARY = 2
 
-    offset = 0
+    # row at which the next table is written, per worksheet
+    offsets = weakref.WeakKeyDictionary()
+
+    # white default format, per worksheet, and the number of columns it covers
+    backgrounds = weakref.WeakKeyDictionary()
+    WHITE_COLUMNS = 20
+
+    # formats by their properties, per workbook
+    formats = weakref.WeakKeyDictionary()
+
+    # guards the registries above, workbooks are written in background tasks
+    registry_lock = threading.RLock()
 
     def __init__(self):
         self.row_highlight_primary = []
         self.row_highlight_secondary = []
-        self.rows = []
         self.row_colors = {}
 
+        # per column: the values, their units (None for cells without unit) and
+        # whether the value is a number
+        self.values = []
+        self.units = []
+        self.numeric = []
+
+        # number of cells of every row
+        self.lengths = []
+
+        # cells replaced in the Excel export only, e.g. by formulas
+        self.xlsx_cells = {}
+
+    def __len__(self):
+        return len(self.lengths)
+
     '''
-    Convert all cells containing a number x to the tuple (x, unit)
+    Give all numbers without unit the given unit, in all columns or only in the
+    given one.
     '''
-    def numbers_to_unit(self, unit):
-        for row in self.rows:
-            for i in range(len(row)):
-                if isinstance(row[i], int) or isinstance(row[i], float):
-                    row[i] = (row[i], unit)
+    def numbers_to_unit(self, unit, column=None):
+        columns = range(len(self.values)) if column is None else [column]
+        for j in columns:
+            units = self.units[j]
+            numeric = self.numeric[j]
+            for i in range(len(self)):
+                if numeric[i] and units[i] is None:
+                    units[i] = unit
 
     def set_row_color(self, i, c):
         self.row_colors[i] = c
@@ -415,109 +1392,169 @@ class Table:
       the Excel export, the row will be decorated with t.
     '''
     def add_row(self, row, highlight=Highlight.NONE):
+        i = len(self)
         if highlight == Table.Highlight.PRIMARY:
-            self.row_highlight_primary.append(len(self.rows))
+            self.row_highlight_primary.append(i)
         elif highlight == Table.Highlight.SECONDARY:
-            self.row_highlight_secondary.append(len(self.rows))
+            self.row_highlight_secondary.append(i)
         elif isinstance(highlight, QColor) or isinstance(highlight, tuple):
-            self.row_colors[len(self.rows)] = highlight
-        self.rows.append(row)
+            self.row_colors[i] = highlight
 
-    def set_row(self, i, row):
-        self.rows[i] = row
+        while len(self.values) < len(row):
+            self.values.append([None] * i)
+            self.units.append([None] * i)
+            self.numeric.append([False] * i)
+        for j in range(len(self.values)):
+            self.values[j].append(None)
+            self.units[j].append(None)
+            self.numeric[j].append(False)
+        self.lengths.append(len(row))
 
-    def set_cell(self, i, j, value):
-        if i < len(self.rows) and j < len(self.rows[i]):
-            self.rows[i][j] = value
+        for (j, x) in enumerate(row):
+            self.set_cell(i, j, x)
 
-    @staticmethod
-    def pad_and_add_units(row):
-        result = []
-        for x in row:
-            if isinstance(x, tuple):
-                number, unit = x
-                if unit == '%':
-                    unit = '\\%'
-                s = format_number_latex(number) + '~' + unit
-            elif x is None:
-                s = ''
-            else:
-                s = str(x)
-            result.append(s)
-        return ' & '.join(result)
+    '''
+    Set a cell to x, which is a value or a tuple (value, unit).
+    '''
+    def set_cell(self, i, j, x):
+        if isinstance(x, tuple):
+            self.set_value(i, j, *x)
+        else:
+            self.set_value(i, j, x)
+
+    def set_value(self, i, j, value, unit=None):
+        self.values[j][i] = value
+        self.units[j][i] = unit
+        self.numeric[j][i] = isinstance(value, int) or isinstance(value, float)
+
+    def value(self, i, j):
+        return self.values[j][i]
+
+    '''
+    Replace the value of a cell in the Excel export only, e.g. with a formula.
+    The unit of the cell is kept.
+    '''
+    def set_xlsx_cell(self, i, j, value):
+        self.xlsx_cells[(i, j)] = value
+
+    def latex_cell(self, i, j):
+        value = self.values[j][i]
+        unit = self.units[j][i]
+        if unit is not None:
+            if unit == '%':
+                unit = '\\%'
+            return format_number_latex(value) + '~' + unit
+        elif value is None:
+            return ''
+        else:
+            return str(value)
+
+    '''
+    Write the table as tblr environment row by row to the open text file f. If
+    no file is given, the LaTeX code is returned as string.
+    '''
+    def to_latex(self, colspec, color_command, f=None):
+        out = io.StringIO() if f is None else f
 
-    def to_latex(self, colspec, color_command):
         primary = ','.join([str(i + 1) for i in self.row_highlight_primary])
         secondary = ','.join([str(i + 1) for i in self.row_highlight_secondary])
-        result = '\\begin{tblr}{width=\\textwidth,colspec={' + colspec + '}'
+        out.write('\\begin{tblr}{width=\\textwidth,colspec={' + colspec + '}')
         if len(primary) > 0:
-            result += ',row{' + primary + '}={3.5ex,f,bg=dnpblue,fg=white,font=\\bfseries}'
+            out.write(',row{' + primary + '}={3.5ex,f,bg=dnpblue,fg=white,font=\\bfseries}')
         if len(secondary) > 0:
-            result += ',row{' + secondary + '}={3.5ex,f,font=\\bfseries,bg=dnplightblue,fg=black}'
-        result += '}'
+            out.write(',row{' + secondary + '}={3.5ex,f,font=\\bfseries,bg=dnplightblue,fg=black}')
+        out.write('}')
 
-        for (i, row) in enumerate(self.rows):
-            result += '\n    '
+        for (i, length) in enumerate(self.lengths):
+            out.write('\n    ')
             if i in self.row_colors:
                 color = self.row_colors[i]
                 if isinstance(color, QColor):
-                    result += f'\\{color_command}{{{color_to_tikz(color)}}} '
+                    out.write(f'\\{color_command}{{{color_to_tikz(color)}}} ')
                 elif isinstance(color, tuple):
-                    result += color[0]
+                    out.write(color[0])
 
-            result += ' & '
-            result += Table.pad_and_add_units(row)
-            result += ' \\\\'
+            out.write(' & ')
+            out.write(' & '.join([self.latex_cell(i, j) for j in range(length)]))
+            out.write(' \\\\')
 
-        result += '\n\\end{tblr}'
+        out.write('\n\\end{tblr}')
 
-        return result
+        if f is None:
+            return out.getvalue()
 
-    @staticmethod
-    def add_units(row):
+    '''
+    Cells of row i for spreadsheets: quantities and empty cells take two
+    columns (value and unit), all other cells one.
+    '''
+    def spreadsheet_row(self, i, overrides={}):
         result = []
-        for x in row:
-            if isinstance(x, tuple):
-                number, unit = x
-                result.append(number)
+        for j in range(self.lengths[i]):
+            value = overrides.get((i, j), self.values[j][i])
+            unit = self.units[j][i]
+            if unit is not None:
+                result.append(value)
                 result.append(unit)
-            elif x is None:
+            elif self.values[j][i] is None:
                 result.append('')
                 result.append('')
             else:
-                result.append(x)
+                result.append(value)
         return result
 
-    def to_xlsx(self, workbook, column_widths=[], worksheet=None):
-        offset = Table.offset
+    '''
+    Return the format of the workbook with the given properties, creating it
+    only on first use. Repeated exports into the same workbook and long color
+    legends thereby share their formats.
+    '''
+    @staticmethod
+    def workbook_format(workbook, properties):
+        key = tuple(sorted(properties.items()))
+        with Table.registry_lock:
+            formats = Table.formats.setdefault(workbook, {})
+            if key not in formats:
+                formats[key] = workbook.add_format(properties)
+            return formats[key]
+
+    '''
+    Give the worksheet its white look once: hide the gridlines and use a white
+    default format for the first columns, instead of writing empty white cells.
+    Returns the white format of the worksheet.
+    '''
+    @staticmethod
+    def white_background(workbook, worksheet):
+        with Table.registry_lock:
+            if worksheet not in Table.backgrounds:
+                bg_white = Table.workbook_format(workbook, { 'bg_color': 'white', 'num_format': '#,##0' })
+                worksheet.hide_gridlines(2)
+                worksheet.set_column(0, Table.WHITE_COLUMNS - 1, None, bg_white)
+                Table.backgrounds[worksheet] = bg_white
+            return Table.backgrounds[worksheet]
 
+    def to_xlsx(self, workbook, column_widths=[], worksheet=None):
         if not worksheet:
             worksheet = workbook.add_worksheet()
+        with Table.registry_lock:
+            offset = Table.offsets.get(worksheet, 0)
+        bg_white = Table.white_background(workbook, worksheet)
 
-        # set column widths
+        # set column widths, keeping the white column format
         for i, w in enumerate(column_widths):
-            worksheet.set_column(i, i, w)
-
-        primary = workbook.add_format()
-        primary.set_bold()
-        primary.set_bg_color('#001aae') # DNP blue
-        primary.set_font_color('white')
-        primary.set_num_format('#,##0')
-
-        secondary = workbook.add_format()
-        secondary.set_bold()
-        secondary.set_bg_color('#dde2ff')
-        secondary.set_num_format('#,##0')
-
-        bg_white = workbook.add_format()
-        bg_white.set_bg_color('white')
-        bg_white.set_num_format('#,##0')
-
-        for i in range(0, 100):
-            for j in range(0, 20):
-                worksheet.write(i + offset, j, '', bg_white)
-
-        for (i, row) in enumerate(self.rows):
+            worksheet.set_column(i, i, w, bg_white)
+
+        primary = Table.workbook_format(workbook, {
+            'bold': True,
+            'bg_color': '#001aae', # DNP blue
+            'font_color': 'white',
+            'num_format': '#,##0',
+        })
+        secondary = Table.workbook_format(workbook, {
+            'bold': True,
+            'bg_color': '#dde2ff',
+            'num_format': '#,##0',
+        })
+
+        for i in range(len(self)):
             fmt = bg_white
             if i in self.row_highlight_secondary:
                 fmt = secondary
@@ -527,17 +1564,546 @@ class Table:
             if i in self.row_colors:
                 color = self.row_colors[i]
                 if isinstance(color, QColor):
-                    color_fmt = workbook.add_format()
-                    color_fmt.set_bg_color(self.row_colors[i].name())
+                    color_fmt = Table.workbook_format(workbook, { 'bg_color': color.name() })
                     worksheet.write(i + offset, 0, '', color_fmt)
                 elif isinstance(color, tuple):
                     worksheet.write(i + offset, 0, color[1], fmt)
             else:
                 worksheet.write(i + offset, 0, '', fmt)
 
-            worksheet.write_row(i + offset, 1, Table.add_units(row), fmt)
+            worksheet.write_row(i + offset, 1, self.spreadsheet_row(i, self.xlsx_cells), fmt)
+
+        with Table.registry_lock:
+            Table.offsets[worksheet] = offset + len(self) + 1
+
+    '''
+    Write the table to the open text file f, with the same value and unit
+    columns as the Excel export but without its formulas.
+    '''
+    def to_csv(self, f):
+        writer = csv.writer(f, delimiter=';')
+        for i in range(len(self)):
+            writer.writerow(self.spreadsheet_row(i))
+
+    '''
+    Return the table as JSON serializable dictionary: the rows as lists of
+    cells { 'value': ..., 'unit': ... } and the highlighting of the rows.
+    '''
+    def to_json(self):
+        rows = []
+        for (i, length) in enumerate(self.lengths):
+            rows.append([{ 'value': self.values[j][i], 'unit': self.units[j][i] } for j in range(length)])
+
+        colors = {}
+        for (i, color) in self.row_colors.items():
+            colors[str(i)] = color.name() if isinstance(color, QColor) else color[1]
+
+        return {
+            'rows': rows,
+            'primary': self.row_highlight_primary,
+            'secondary': self.row_highlight_secondary,
+            'colors': colors,
+        }
+
+
+'''
+Cache for the measures $length and $area of features. Ellipsoidal measurement is
+by far the most expensive part of the statistics expressions, so every feature
+is measured at most once per run. Values are keyed by layer id, feature id and a
+digest of the geometry. If a directory is given, the measures are additionally
+kept in sidecar files there (keyed by the geometry digest, one file per measure
+and measurement setup, i.e. CRS, ellipsoid and units), so that evaluating an
+unchanged layer again does not measure anything at all. Only the files of the
+setups in use are read. Example:
+
+measures = MeasureCache(sidecar_directory)
+aggregation = Aggregation(layer, measures)
+...
+measures.save()
+'''
+class MeasureCache:
+    EXPRESSIONS = { 'length': '$length', 'area': '$area' }
+
+    # geometries kept per sidecar file besides those used in the current run,
+    # each file is read as a whole
+    MAX_STORED = 100000
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.features = {}
+        self.tables = {}
+        # digests used in this run, per sidecar file
+        self.used = {}
+        self.modified = set()
+
+    @staticmethod
+    def digest(geometry):
+        return hashlib.blake2b(bytes(geometry.asWkb()), digest_size=16).hexdigest()
+
+    '''
+    Identify everything besides the geometry that influences a measure.
+    '''
+    @staticmethod
+    def setup(layer, context):
+        names = ['project_ellipsoid', 'project_distance_units', 'project_area_units']
+        parts = [str(context.variable(name)) for name in names] + [layer.crs().toWkt()]
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    '''
+    Stored measures of a setup (geometry digest: value), read from its sidecar
+    file on first use. Returns the file name and the table.
+    '''
+    def table(self, setup, measure):
+        name = f'{setup[:16]}-{measure}.json'
+        if name not in self.tables:
+            table = {}
+            path = osp.join(self.directory, name) if self.directory else None
+            if path and osp.exists(path):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        table = json.load(f)
+                except (OSError, ValueError):
+                    # a corrupt sidecar is simply rebuilt
+                    table = {}
+            self.tables[name] = table
+            self.used[name] = set()
+        return (name, self.tables[name])
+
+    def save(self):
+        if not self.directory:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        for name in list(self.modified):
+            table = self.tables[name]
+            # drop the least recently used geometries, but none used in this run:
+            # they were moved to the end of the table
+            limit = max(MeasureCache.MAX_STORED, len(self.used[name]))
+            if len(table) > limit:
+                for key in list(table.keys())[:len(table) - limit]:
+                    del table[key]
+
+            # several processes may save at once (batch mode), each replaces the file as a whole
+            path = osp.join(self.directory, name)
+            temporary = f'{path}.{os.getpid()}.tmp'
+            with open(temporary, 'w', encoding='utf-8') as f:
+                json.dump(table, f)
+            os.replace(temporary, path)
+        self.modified = set()
+
+    '''
+    Create a function (feature, context) -> value for the given measure
+    ('length' or 'area'). The context must belong to layer and already contain
+    the feature.
+    '''
+    def measurer(self, layer, measure, context):
+        expression = QgsExpression(MeasureCache.EXPRESSIONS[measure])
+        expression.prepare(context)
+        (name, stored) = self.table(MeasureCache.setup(layer, context), measure)
+        used = self.used[name]
+        features = self.features
+        layer_id = layer.id()
+
+        def measure_feature(feature, context):
+            digest = MeasureCache.digest(feature.geometry())
+            key = (layer_id, feature.id(), digest, measure)
+            value = features.get(key)
+            if value is not None:
+                return value
+
+            value = stored.pop(digest, None)
+            if value is None:
+                value = expression.evaluate(context)
+                value = float(value) if value else 0.0
+                self.modified.add(name)
+            # re-insert to keep recently used geometries at the end of the sidecar
+            stored[digest] = value
+            used.add(digest)
+            features[key] = value
+            return value
+
+        return measure_feature
+
+
+'''
+The part of a layer an evaluation step reads: the attributes it needs and
+whether it needs the geometries. The projections of several steps are
+combined with union(), and request() restricts a QgsFeatureRequest to them, so
+that providers only read and copies only hold what is needed. Example:
+
+projection = Projection(['Belag', 'Typ'], geometry=True)
+request = projection.request(layer, QgsFeatureRequest().setFilterFids(ids))
+'''
+class Projection:
+    def __init__(self, attributes=[], geometry=False):
+        self.attributes = list(attributes)
+        self.geometry = geometry
+
+    @staticmethod
+    def union(projections):
+        attributes = []
+        for projection in projections:
+            attributes += [a for a in projection.attributes if a not in attributes]
+        return Projection(attributes, any([projection.geometry for projection in projections]))
+
+    def request(self, layer, request=None):
+        request = request if request else QgsFeatureRequest()
+        request.setSubsetOfAttributes(self.attributes, layer.fields())
+        if not self.geometry:
+            request.setFlags(request.flags() | QgsFeatureRequest.NoGeometry)
+        return request
+
+
+'''
+Evaluate many conditional sums over a layer in a single pass. Each bucket is
+the sum of "CASE WHEN condition THEN column ELSE 0 END" over all features, i.e.
+the same value GeneratePresentation.filtered_column_sum would return. Example:
+
+aggregation = Aggregation(layer)
+asphalt = aggregation.add('"Belag" = \'a\'', '$length')
+asphalt_private = aggregation.add('"Belag" = \'a\' and "Privatweg"', '$length')
+crossings = aggregation.count('"Sonderquerung"')
+aggregation.run()
+
+print(asphalt.value, asphalt_private.value, crossings.value.most_common())
+
+Every distinct condition and column is compiled once and evaluated at most once
+per feature, no matter how many buckets refer to it. If a MeasureCache is given,
+$length and $area are taken from it instead of being measured again.
+'''
+class Aggregation:
+    class Bucket:
+        def __init__(self, condition, column):
+            self.condition = condition
+            self.column = column
+            self.value = 0
+
+    class Tally:
+        def __init__(self, expression):
+            self.expression = expression
+            self.value = Counter()
+
+    def __init__(self, layer, measures=None):
+        self.layer = layer
+        self.measures = measures
+        self.buckets = []
+        self.tallies = []
+
+    '''
+    Create an aggregation for the given backend: 'expression' (default) or
+    'numpy' (see ArrayAggregation).
+    '''
+    @staticmethod
+    def create(layer, measures=None, backend=None):
+        if backend == 'numpy':
+            return ArrayAggregation(layer, measures)
+        return Aggregation(layer, measures)
+
+    '''
+    Register the sum of column over all features satisfying condition. The
+    result is available as bucket.value once run() has been called.
+    '''
+    def add(self, condition, column):
+        bucket = Aggregation.Bucket(condition, column)
+        self.buckets.append(bucket)
+        return bucket
+
+    '''
+    Register a count of the non-empty values of expression.
+    '''
+    def count(self, expression):
+        tally = Aggregation.Tally(expression)
+        self.tallies.append(tally)
+        return tally
+
+    @staticmethod
+    def compile(expressions, text, context):
+        if text not in expressions:
+            expression = QgsExpression(text)
+            if expression.hasParserError():
+                raise RuntimeError(f'Ungültiger Ausdruck "{text}": {expression.parserErrorString()}')
+            expression.prepare(context)
+            expressions[text] = (len(expressions), expression)
+        return expressions[text][0]
+
+    '''
+    Compile all registered expressions and determine which attributes and
+    measures have to be fetched. Shared by all aggregation backends.
+    '''
+    def prepare(self):
+        layer = self.layer
+        plan = dotdict()
+        if isinstance(layer, LayerSnapshot):
+            scopes = layer.expression_scopes()
+        else:
+            scopes = QgsExpressionContextUtils.globalProjectLayerScopes(layer)
+        plan.context = context = QgsExpressionContext(scopes)
+
+        # Replace $length and $area by variables which are filled from the
+        # measure cache for every feature.
+        measured = {}
+        plan.scope = scope = QgsExpressionContextScope()
+        context.appendScope(scope)
+
+        def substitute_measures(text):
+            if not self.measures:
+                return text
+
+            def replace(match):
+                measure = match.group(1)
+                if measure not in measured:
+                    scope.setVariable('measure_' + measure, 0.0)
+                    measured[measure] = None
+                return '@measure_' + measure
+            return re.sub(r'\$(length|area)\b', replace, text)
+
+        # Conditions are wrapped in a CASE expression so that QGIS decides what
+        # counts as true, exactly like in filtered_column_sum.
+        conditions = {}
+        columns = {}
+        plan.buckets = []
+        for bucket in self.buckets:
+            condition = substitute_measures(bucket.condition)
+            column = substitute_measures(bucket.column)
+            i = Aggregation.compile(conditions, f'CASE WHEN {condition} THEN 1 ELSE 0 END', context)
+            j = Aggregation.compile(columns, column, context)
+            bucket.value = 0
+            plan.buckets.append((bucket, i, j))
+
+        tallies = {}
+        plan.tallies = []
+        for tally in self.tallies:
+            k = Aggregation.compile(tallies, substitute_measures(tally.expression), context)
+            tally.value = Counter()
+            plan.tallies.append((tally, k))
+
+        plan.conditions = [e for (_, e) in conditions.values()]
+        plan.columns = [e for (_, e) in columns.values()]
+        plan.tally_expressions = [e for (_, e) in tallies.values()]
+        expressions = plan.conditions + plan.columns + plan.tally_expressions
+
+        attributes = set()
+        for expression in expressions:
+            attributes.update(expression.referencedColumns())
+        plan.request = QgsFeatureRequest().setSubsetOfAttributes(attributes, layer.fields())
+        if len(measured) == 0 and not any([expression.needsGeometry() for expression in expressions]):
+            plan.request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        plan.measurers = [
+            ('measure_' + measure, self.measures.measurer(layer, measure, context)) for measure in measured
+        ]
+        plan.empty = len(expressions) == 0
+        return plan
+
+    def run(self):
+        plan = self.prepare()
+        if plan.empty:
+            return
+
+        context = plan.context
+        scope = plan.scope
+        for feature in self.layer.getFeatures(plan.request):
+            context.setFeature(feature)
+            for (name, measurer) in plan.measurers:
+                scope.setVariable(name, measurer(feature, context))
+            satisfied = [expression.evaluate(context) == 1 for expression in plan.conditions]
+            values = [None] * len(plan.columns)
+
+            for (bucket, i, j) in plan.buckets:
+                if not satisfied[i]:
+                    continue
+                if values[j] is None:
+                    x = plan.columns[j].evaluate(context)
+                    values[j] = x if x else 0
+                bucket.value += values[j]
 
-        Table.offset += len(self.rows) + 1
+            tokens = [expression.evaluate(context) for expression in plan.tally_expressions]
+            for (tally, k) in plan.tallies:
+                if tokens[k]:
+                    tally.value[tokens[k]] += 1
+
+
+'''
+NumPy backend for Aggregation. The layer is read once into arrays: a group id
+per feature (one group per distinct combination of the referenced attributes)
+and the cached measures. Conditions and attribute-only expressions are then
+evaluated by QGIS once per group instead of once per feature, and every bucket
+is summed with a boolean mask and numpy.bincount. Since bincount adds the
+selected values in feature order, the sums are identical to those of the
+expression-based Aggregation.
+
+Columns have to be attribute-only expressions or a measure optionally
+multiplied or divided by an attribute-only expression, e.g.
+'$area / (CASE WHEN "Typ" = \'b\' THEN 1.281 ELSE 5.787 END)'. Anything else
+falls back to the expression-based evaluation.
+'''
+class ArrayAggregation(Aggregation):
+    class Unsupported(Exception):
+        pass
+
+    def __init__(self, layer, measures=None):
+        super().__init__(layer, measures if measures else MeasureCache())
+
+    @staticmethod
+    def measure_variable(node):
+        if node.nodeType() != QgsExpressionNode.ntFunction:
+            return None
+        if QgsExpression.Functions()[node.fnIndex()].name() != 'var':
+            return None
+        names = [name for name in node.referencedVariables() if name.startswith('measure_')]
+        return names[0] if len(names) == 1 else None
+
+    '''
+    Split a column into (measure variable, operator, factor expression). Columns
+    without a measure yield (None, None, column).
+    '''
+    @staticmethod
+    def split_column(expression, context):
+        names = [name for name in expression.referencedVariables() if name.startswith('measure_')]
+        if len(names) == 0:
+            if expression.needsGeometry():
+                raise ArrayAggregation.Unsupported(expression.expression())
+            return (None, None, expression)
+
+        root = expression.rootNode()
+        name = ArrayAggregation.measure_variable(root)
+        if name:
+            return (name, None, None)
+
+        if root.nodeType() == QgsExpressionNode.ntBinaryOperator and \
+                root.op() in (QgsExpressionNodeBinaryOperator.boDiv, QgsExpressionNodeBinaryOperator.boMul):
+            name = ArrayAggregation.measure_variable(root.opLeft())
+            factor = QgsExpression(root.opRight().dump())
+            factor_names = [n for n in factor.referencedVariables() if n.startswith('measure_')]
+            if name and len(factor_names) == 0 and not factor.needsGeometry():
+                factor.prepare(context)
+                return (name, root.op(), factor)
+
+        raise ArrayAggregation.Unsupported(expression.expression())
+
+    def run(self):
+        if np is None:
+            return super().run()
+
+        plan = self.prepare()
+        if plan.empty:
+            return
+
+        try:
+            self.run_arrays(plan)
+        except ArrayAggregation.Unsupported:
+            super().run()
+
+    def run_arrays(self, plan):
+        layer = self.layer
+        context = plan.context
+
+        for expression in plan.conditions + plan.tally_expressions:
+            if expression.needsGeometry() or any([n.startswith('measure_') for n in expression.referencedVariables()]):
+                raise ArrayAggregation.Unsupported(expression.expression())
+        columns = [ArrayAggregation.split_column(expression, context) for expression in plan.columns]
+
+        # read the layer once: group id and measures of every feature
+        fields = layer.fields()
+        indices = sorted(plan.request.subsetOfAttributes()) \
+            if plan.request.flags() & QgsFeatureRequest.SubsetOfAttributes else list(range(fields.count()))
+        groups = {}
+        group_ids = array('q')
+        measures = { name: array('d') for (name, _) in plan.measurers }
+
+        for feature in layer.getFeatures(plan.request):
+            attributes = feature.attributes()
+            key = tuple([None if attributes[i] == NULL else attributes[i] for i in indices])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(groups)
+            group_ids.append(group)
+
+            if len(plan.measurers) > 0:
+                context.setFeature(feature)
+                for (name, measurer) in plan.measurers:
+                    measures[name].append(measurer(feature, context))
+
+        group_ids = np.frombuffer(group_ids, dtype=np.int64) if len(group_ids) > 0 else np.zeros(0, dtype=np.int64)
+        measures = { name: np.frombuffer(values, dtype=np.float64) if len(values) > 0 else np.zeros(0)
+                     for (name, values) in measures.items() }
+
+        # evaluate conditions and attribute-only expressions once per group
+        group_features = []
+        for key in groups:
+            feature = QgsFeature(fields)
+            attributes = [None] * fields.count()
+            for (i, value) in zip(indices, key):
+                attributes[i] = value
+            feature.setAttributes(attributes)
+            group_features.append(feature)
+
+        def evaluate_groups(expression):
+            result = []
+            for feature in group_features:
+                context.setFeature(feature)
+                result.append(expression.evaluate(context))
+            return result
+
+        masks = [np.array([x == 1 for x in evaluate_groups(e)], dtype=bool)[group_ids] for e in plan.conditions]
+
+        factors = []
+        for (name, op, factor) in columns:
+            if factor is None:
+                factors.append(None)
+                continue
+            values = [x if x else 0 for x in evaluate_groups(factor)]
+            for x in values:
+                if not isinstance(x, (int, float)):
+                    raise ArrayAggregation.Unsupported(factor.expression())
+            factors.append(values)
+
+        # per-feature values of every column
+        weights = []
+        for ((name, op, factor), values) in zip(columns, factors):
+            if name is None:
+                if all([isinstance(x, int) for x in values]):
+                    # integer columns are summed exactly via group counts
+                    weights.append((np.array(values, dtype=object), None))
+                else:
+                    weights.append((None, np.array(values, dtype=np.float64)[group_ids]))
+                continue
+
+            measure = measures[name]
+            if op is None:
+                weights.append((None, measure))
+                continue
+
+            factor = np.array(values, dtype=np.float64)[group_ids]
+            if op == QgsExpressionNodeBinaryOperator.boMul:
+                weights.append((None, measure * factor))
+                continue
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                w = measure / factor
+            # QGIS returns NULL when dividing by zero, which counts as 0
+            w[factor == 0] = 0.0
+            weights.append((None, w))
+
+        for (bucket, i, j) in plan.buckets:
+            mask = masks[i]
+            if not mask.any():
+                bucket.value = 0
+                continue
+
+            per_group, per_feature = weights[j]
+            if per_group is not None:
+                counts = np.bincount(group_ids[mask], minlength=len(groups))
+                bucket.value = sum([int(x) * int(n) for (x, n) in zip(per_group, counts) if n > 0])
+            else:
+                bucket.value = float(np.bincount(mask.astype(np.intp), weights=per_feature, minlength=2)[1])
+
+        counts = np.bincount(group_ids, minlength=len(groups))
+        for (tally, k) in plan.tallies:
+            tokens = evaluate_groups(plan.tally_expressions[k])
+            for (token, n) in zip(tokens, counts):
+                if token and n > 0:
+                    tally.value[token] += int(n)
 
 
 class SymbologyCategory:
@@ -549,6 +2115,7 @@ class SymbologyCategory:
 
     @staticmethod
     def extract_symbology_categories(layer, field, columns):
+        aggregation = Aggregation(layer)
         result = []
         for c in layer.renderer().categories():
             token = c.value()
@@ -559,81 +2126,1013 @@ class SymbologyCategory:
                 label = match.group(1)
 
             condition = f'"{field}" = \'{token}\''
-            value = [GeneratePresentation.filtered_column_sum(layer, condition, column) for column in columns]
+            value = [aggregation.add(condition, column) for column in columns]
             result.append(SymbologyCategory(token, color, label, value))
 
+        aggregation.run()
+        for category in result:
+            category.value = [bucket.value for bucket in category.value]
+
         return result
 
 
-class RectangleMapTool(QgsMapTool):
-    def __init__(self, canvas, action):
-        self.canvas = canvas
-        self.action = action
-        QgsMapTool.__init__(self, self.canvas)
-        self.rubberBand = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
-        self.rubberBand.setStrokeColor(Qt.red)
-        self.rubberBand.setWidth(1)
-        self.reset()
+class RectangleMapTool(QgsMapTool):
+    def __init__(self, canvas, action):
+        self.canvas = canvas
+        self.action = action
+        QgsMapTool.__init__(self, self.canvas)
+        self.rubberBand = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+        self.rubberBand.setStrokeColor(Qt.red)
+        self.rubberBand.setWidth(1)
+        self.reset()
+
+    def reset(self):
+        self.startPoint = self.endPoint = None
+        self.isEmittingPoint = False
+        self.rubberBand.reset(QgsWkbTypes.PolygonGeometry)
+
+    def canvasPressEvent(self, e):
+        self.startPoint = self.toMapCoordinates(e.pos())
+        self.endPoint = self.startPoint
+        self.isEmittingPoint = True
+        self.showRect(self.startPoint, self.endPoint)
+
+
+    def canvasReleaseEvent(self, e):
+        self.isEmittingPoint = False
+        r = self.rectangle()
+
+        if r is not None:
+            self.reset()
+            self.action(r)
+
+    def canvasMoveEvent(self, e):
+        if not self.isEmittingPoint:
+            return
+
+        self.endPoint = self.toMapCoordinates(e.pos())
+        self.showRect(self.startPoint, self.endPoint)
+
+
+    def showRect(self, startPoint, endPoint):
+        self.rubberBand.reset(QgsWkbTypes.PolygonGeometry)
+        if startPoint.x() == endPoint.x() or startPoint.y() == endPoint.y():
+            return
+
+        point1 = QgsPointXY(startPoint.x(), startPoint.y())
+        point2 = QgsPointXY(startPoint.x(), endPoint.y())
+        point3 = QgsPointXY(endPoint.x(), endPoint.y())
+        point4 = QgsPointXY(endPoint.x(), startPoint.y())
+
+        self.rubberBand.addPoint(point1, False)
+        self.rubberBand.addPoint(point2, False)
+        self.rubberBand.addPoint(point3, False)
+        self.rubberBand.addPoint(point4, True)    # true to update canvas
+        self.rubberBand.show()
+
+    def rectangle(self):
+        if self.startPoint is None or self.endPoint is None:
+            return None
+        elif (self.startPoint.x() == self.endPoint.x() or \
+            self.startPoint.y() == self.endPoint.y()):
+            return None
+        return QgsRectangle(self.startPoint, self.endPoint)
+
+    def deactivate(self):
+        QgsMapTool.deactivate(self)
+        self.reset()
+        self.deactivated.emit()
+
+
+'''
+Rendered map PDFs, kept between runs in the plugin's cache directory. A map is
+addressed by everything it depends on: extent, page size, project CRS and the
+layer_fingerprint of every layer. Maps of layers with unsaved edits are never
+cached. The fingerprints may be shared with the Manifest of the same run.
+'''
+class RenderCache:
+    # maps cached under fingerprints that missed edits are never used again
+    VERSION = 2
+    MAX_ENTRIES = 1000
+
+    def __init__(self, directory, fingerprints=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.fingerprints = fingerprints if fingerprints is not None else {}
+
+    def fingerprint(self, layer):
+        return layer_fingerprint(layer, self.fingerprints)
+
+    '''
+    Return the cache key of a map, or None if it must not be cached.
+    '''
+    def key(self, layers, extent, width, height):
+        fingerprints = [self.fingerprint(layer) if layer else None for layer in layers]
+        if any([layer and fingerprint is None for (layer, fingerprint) in zip(layers, fingerprints)]):
+            return None
+
+        description = json.dumps([
+            RenderCache.VERSION,
+            [extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()],
+            [width, height],
+            QgsProject.instance().crs().toWkt(),
+            fingerprints,
+        ])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def path(self, key):
+        return osp.join(self.directory, key + '.pdf')
+
+    def fetch(self, key, destination):
+        if not key or not osp.exists(self.path(key)):
+            return False
+        shutil.copyfile(self.path(key), destination)
+        # mark as recently used
+        os.utime(self.path(key))
+        return True
+
+    def store(self, key, source):
+        if not key:
+            return
+        temporary = f'{self.path(key)}.{os.getpid()}.tmp'
+        shutil.copyfile(source, temporary)
+        os.replace(temporary, self.path(key))
+
+    '''
+    Remove the least recently used maps beyond MAX_ENTRIES.
+    '''
+    def prune(self):
+        paths = glob.glob(osp.join(self.directory, '*.pdf'))
+        if len(paths) <= RenderCache.MAX_ENTRIES:
+            return
+        paths.sort(key=osp.getmtime, reverse=True)
+        for path in paths[RenderCache.MAX_ENTRIES:]:
+            os.remove(path)
+
+
+'''
+Renders maps to PDF files. All jobs share a single print layout, map item and
+exporter; only the page size, layers and extent are changed per job. Web tile
+layers (e.g. OpenStreetMap) are rendered once per extent and size into a
+georeferenced image, which is used instead of the tile layer by all further
+jobs with the same extent, so the tiles are neither fetched nor drawn again.
+Example:
+
+renderer = MapRenderer(1150, 800)
+renderer.render([trenches, osm], 'trenches.pdf', extent)
+renderer.render([addresses, osm], 'addresses.pdf', extent)   # reuses the OSM image
+renderer.close()
+
+With a RenderCache, maps that did not change since an earlier run are copied
+from the cache instead of being rendered.
+'''
+class MapRenderer:
+    def __init__(self, image_width, image_height, cache=None):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.cache = cache
+
+        self.layout = QgsPrintLayout(QgsProject.instance())
+        self.layout.initializeDefaults()
+        self.map = QgsLayoutItemMap(self.layout)
+        self.map.setBackgroundColor(QColor(255, 255, 255, 0))
+        self.layout.addLayoutItem(self.map)
+        self.exporter = QgsLayoutExporter(self.layout)
+        self.settings = QgsLayoutExporter.PdfExportSettings()
+        self.size = None
+
+        self.tiles_directory = None
+        self.tiles = {}
+
+    @staticmethod
+    def is_tile_layer(layer):
+        return isinstance(layer, QgsRasterLayer) and layer.providerType() == 'wms' and \
+            'type=xyz' in layer.source()
+
+    '''
+    Render the tile layer for the current map extent into an image and return
+    a raster layer showing it.
+    '''
+    def cached_tiles(self, layer):
+        extent = self.map.extent()
+        dpi = self.layout.renderContext().dpi()
+        width = round(self.size[0] / 25.4 * dpi)
+        height = round(self.size[1] / 25.4 * dpi)
+        key = (layer.id(), extent.toString(), width, height)
+        if key in self.tiles:
+            return self.tiles[key]
+
+        settings = QgsMapSettings()
+        settings.setLayers([layer])
+        settings.setDestinationCrs(self.map.crs())
+        settings.setTransformContext(QgsProject.instance().transformContext())
+        settings.setBackgroundColor(QColor(255, 255, 255, 0))
+        settings.setOutputDpi(dpi)
+        settings.setOutputSize(QSize(width, height))
+        settings.setExtent(extent)
+        job = QgsMapRendererParallelJob(settings)
+        job.start()
+        job.waitForFinished()
+
+        if not self.tiles_directory:
+            self.tiles_directory = tempfile.TemporaryDirectory(prefix='auswertungstools-')
+        path = osp.join(self.tiles_directory.name, f'tiles{len(self.tiles)}.png')
+        job.renderedImage().save(path, 'png')
+
+        # world file to georeference the image
+        rendered = settings.visibleExtent()
+        pixel_width = rendered.width() / width
+        pixel_height = rendered.height() / height
+        with open(path[:-4] + '.pgw', 'w') as f:
+            f.write('\n'.join([str(x) for x in [
+                pixel_width, 0, 0, -pixel_height,
+                rendered.xMinimum() + pixel_width / 2, rendered.yMaximum() - pixel_height / 2
+            ]]))
+
+        tiles = QgsRasterLayer(path, layer.name(), 'gdal')
+        tiles.setCrs(self.map.crs())
+        self.tiles[key] = tiles
+        return tiles
+
+    def cache_key(self, layers, extent, zoom_factor=4):
+        if not self.cache:
+            return None
+        return self.cache.key(layers, extent, self.image_width / zoom_factor, self.image_height / zoom_factor)
+
+    '''
+    Copy the map from the cache, if it is there. Returns whether it was.
+    '''
+    def restore(self, layers, destination, extent, zoom_factor=4):
+        return self.cache is not None and self.cache.fetch(self.cache_key(layers, extent, zoom_factor), destination)
+
+    def store(self, layers, destination, extent, zoom_factor=4):
+        if self.cache:
+            self.cache.store(self.cache_key(layers, extent, zoom_factor), destination)
+
+    def render(self, layers, destination, extent, zoom_factor=4):
+        if self.restore(layers, destination, extent, zoom_factor):
+            return
+
+        width = self.image_width / zoom_factor
+        height = self.image_height / zoom_factor
+        if self.size != (width, height):
+            self.layout.pageCollection().pages()[0].setPageSize(QgsLayoutSize(width, height))
+            self.map.setRect(0, 0, width, height)
+            self.size = (width, height)
+
+        self.map.zoomToExtent(extent)
+        self.map.setExtent(extent)
+        visible = [self.cached_tiles(layer) if MapRenderer.is_tile_layer(layer) else layer for layer in layers]
+        self.map.setLayers(visible)
+
+        if self.exporter.exportToPdf(destination, self.settings) == QgsLayoutExporter.Success:
+            self.store(layers, destination, extent, zoom_factor)
+
+    def close(self):
+        if self.cache:
+            self.cache.prune()
+        self.tiles = {}
+        if self.tiles_directory:
+            self.tiles_directory.cleanup()
+            self.tiles_directory = None
+
+
+'''
+Renders map PDFs in a pool of QGIS processes without GUI (export_worker.py).
+The layers are handed over as files: layers from files and web services by
+their source, memory layers as temporary GeoPackage, each with its style as
+QML. Every process renders a share of the jobs and reports each finished job,
+so that on_progress receives the fraction of finished jobs. Example:
+
+pool = ExportPool(1150, 800, zoom_factor=20, processes=8)
+pool.add(rect1, 'fotopunkt1.pdf')
+pool.add(rect2, 'fotopunkt2.pdf')
+pool.start([addresses, trenches, osm], resolve, reject, on_progress)
+'''
+class ExportPool:
+    # below this number of jobs, starting the processes takes longer than rendering
+    MIN_JOBS = 4
+    WORKER = osp.join(osp.dirname(osp.realpath(__file__)), 'export_worker.py')
+    # running pools, only referenced by the signals of their processes otherwise
+    active = set()
+
+    def __init__(self, image_width, image_height, zoom_factor=4, processes=None):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.zoom_factor = zoom_factor
+        self.process_count = processes if processes else (os.cpu_count() or 1)
+        self.jobs = []
+        self.processes = []
+        self.directory = None
+        self.done = 0
+        self.closed = False
+
+    def add(self, extent, destination):
+        self.jobs.append((extent, destination))
+
+    '''
+    Find the Python interpreter of this QGIS installation. Inside QGIS,
+    sys.executable is usually the QGIS binary itself.
+    '''
+    @staticmethod
+    def python_executable():
+        if osp.basename(sys.executable).lower().startswith('python'):
+            return sys.executable
+
+        candidates = [
+            osp.join(sys.exec_prefix, 'python.exe'),
+            osp.join(sys.exec_prefix, 'python3.exe'),
+            osp.join(sys.exec_prefix, 'bin', 'python3'),
+        ]
+        for candidate in candidates:
+            if osp.exists(candidate):
+                return candidate
+
+        executable = shutil.which('python3') or shutil.which('python')
+        if not executable:
+            raise RuntimeError('Python-Interpreter für den parallelen Export nicht gefunden.')
+        return executable
+
+    def serialize_layer(self, layer, index):
+        doc = QDomDocument()
+        layer.exportNamedStyle(doc)
+        source = layer.source()
+        provider = layer.providerType()
+        if provider == 'memory':
+            name = f'layer{index}'
+            source = osp.join(self.directory.name, name + '.gpkg')
+            GeneratePresentation.export_layer(layer, name, source)
+            source = f'{source}|layername={name}'
+            provider = 'ogr'
+
+        return {
+            'type': 'vector' if layer.type() == QgsMapLayer.VectorLayer else 'raster',
+            'name': layer.name(),
+            'source': source,
+            'provider': provider,
+            'subset': layer.subsetString() if provider != 'memory' and layer.type() == QgsMapLayer.VectorLayer else '',
+            'style': doc.toString(),
+        }
+
+    def start(self, layers, resolve, reject, on_progress=None):
+        self.resolve = resolve
+        self.reject = reject
+        self.on_progress = on_progress if on_progress else lambda fraction: None
+
+        python = ExportPool.python_executable()
+        ExportPool.active.add(self)
+        self.directory = tempfile.TemporaryDirectory(prefix='auswertungstools-')
+        try:
+            layers = [self.serialize_layer(layer, i) for (i, layer) in enumerate(layers) if layer]
+        except BaseException:
+            self.cleanup()
+            raise
+        project = QgsProject.instance()
+
+        environment = QProcessEnvironment.systemEnvironment()
+        environment.insert('PYTHONPATH', os.pathsep.join([p for p in sys.path if p]))
+        environment.insert('QGIS_PREFIX_PATH', QgsApplication.prefixPath())
+
+        count = min(self.process_count, len(self.jobs))
+        for k in range(count):
+            jobs = [{
+                'index': i,
+                'extent': [extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()],
+                'destination': destination,
+            } for (i, (extent, destination)) in enumerate(self.jobs) if i % count == k]
+
+            job_file = osp.join(self.directory.name, f'jobs{k}.json')
+            with open(job_file, 'w') as f:
+                json.dump({
+                    'crs': project.crs().toWkt(),
+                    'ellipsoid': project.ellipsoid(),
+                    'image_width': self.image_width,
+                    'image_height': self.image_height,
+                    'zoom_factor': self.zoom_factor,
+                    'layers': layers,
+                    'jobs': jobs,
+                }, f)
+
+            process = QProcess()
+            process.setProcessEnvironment(environment)
+            process.readyReadStandardOutput.connect(lambda p=process: self.read_output(p))
+            process.finished.connect(lambda code, status, p=process: self.process_finished(p, code, status))
+            process.errorOccurred.connect(lambda error, p=process: self.process_error(p, error))
+            self.processes.append(process)
+            process.start(python, [ExportPool.WORKER, job_file])
+
+        if count == 0:
+            self.finish()
+
+    def read_output(self, process):
+        while process.canReadLine():
+            line = bytes(process.readLine()).decode().strip()
+            if line.startswith('done'):
+                self.done += 1
+                self.on_progress(self.done / len(self.jobs))
+
+    def process_finished(self, process, code, status):
+        if self.closed:
+            return
+
+        self.read_output(process)
+        if status != QProcess.NormalExit or code != 0:
+            self.closed = True
+            error = bytes(process.readAllStandardError()).decode(errors='replace').strip()
+            self.cancel()
+            self.reject(RuntimeError(f'Export-Prozess fehlgeschlagen: {error}'))
+            return
+
+        if all([p.state() == QProcess.NotRunning for p in self.processes]):
+            self.finish()
+
+    '''
+    A process that fails to start never emits finished, all other errors are
+    followed by it.
+    '''
+    def process_error(self, process, error):
+        if self.closed or error != QProcess.FailedToStart:
+            return
+        self.closed = True
+        self.cancel()
+        self.reject(RuntimeError(f'Export-Prozess konnte nicht gestartet werden: {process.errorString()}'))
+
+    def finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cleanup()
+        if self.done < len(self.jobs):
+            self.reject(RuntimeError(f'Nur {self.done} von {len(self.jobs)} Karten wurden exportiert.'))
+        else:
+            self.resolve()
+
+    def cancel(self):
+        self.closed = True
+        for process in self.processes:
+            if process.state() != QProcess.NotRunning:
+                process.kill()
+                process.waitForFinished()
+        self.cleanup()
+
+    def cleanup(self):
+        ExportPool.active.discard(self)
+        if self.directory:
+            self.directory.cleanup()
+            self.directory = None
+
+
+'''
+Compiles LaTeX documents to PDF, several documents at a time, each with
+processes of its own. Every document is compiled into a private output
+directory, so that concurrent compilations never share auxiliary files; only
+the finished PDF is copied next to the document. latexmk runs the engine as
+often as the references require, without latexmk the engine is run twice.
+Example:
+
+compiler = LatexCompiler('pdflatex', formats=directory)
+compiler.add('/out/Musterstadt/Praesentation/Musterstadt_Ergebnisse_240101.tex')
+compiler.start(resolve, reject, on_progress)
+...
+compiler.timings    # seconds per document
+
+If a directory for formats is given, the part of a document up to
+FORMAT_MARKER (the document class and the shared preamble.tex) is dumped into
+a format file with mylatexformat, and the document is compiled from this
+format instead of loading beamer, TikZ and tabularray every time. The format
+is named after a hash of that part, of preamble.tex and of the engine version,
+so it is built once and only rebuilt when one of them changes. Documents
+without the marker, or whose format cannot be built, are compiled as usual.
+
+A failing document does not stop the others. Once all are done, reject is
+called with the first error (compiler.errors holds all of them).
+'''
+class LatexCompiler:
+    # latexmk option selecting the engine
+    ENGINES = { 'pdflatex': '-pdf', 'lualatex': '-lualatex', 'xelatex': '-xelatex' }
+    # engines whose formats can be dumped with mylatexformat
+    FORMAT_ENGINES = ['pdflatex']
+    FORMAT_MARKER = '\\csname endofdump\\endcsname'
+    FORMAT_VERSION = 1
+    # running compilers, only referenced by the signals of their processes otherwise
+    active = set()
+    # version string per engine, determined once per session
+    versions = {}
+
+    def __init__(self, engine='pdflatex', processes=None, formats=None):
+        if engine not in LatexCompiler.ENGINES:
+            raise RuntimeError(f'Unbekannte LaTeX-Engine "{engine}".')
+        self.engine = engine
+        self.process_count = processes if processes else (os.cpu_count() or 1)
+        self.formats = formats
+        self.documents = []
+        self.queue = []
+        self.running = {}
+        self.building = {}
+        self.timings = {}
+        self.format_timings = {}
+        self.errors = {}
+        self.directory = None
+        self.done = 0
+        self.total = 0
+        self.closed = False
+
+    def add(self, path):
+        self.documents.append(osp.abspath(path))
+
+    def engine_version(self):
+        if self.engine not in LatexCompiler.versions:
+            executable = shutil.which(self.engine)
+            version = None
+            if executable:
+                try:
+                    output = subprocess.run([executable, '--version'], capture_output=True, text=True, timeout=30)
+                    version = output.stdout.splitlines()[0] if output.stdout else None
+                except (OSError, subprocess.SubprocessError):
+                    version = None
+            LatexCompiler.versions[self.engine] = version
+        return LatexCompiler.versions[self.engine]
+
+    '''
+    Name of the format file for the document at path, or None if it is not
+    compiled from a format.
+    '''
+    def format_name(self, path):
+        if not self.formats or self.engine not in LatexCompiler.FORMAT_ENGINES:
+            return None
+        preamble = osp.join(osp.dirname(path), 'preamble.tex')
+        if not osp.exists(preamble):
+            return None
+        with open(path, encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        if LatexCompiler.FORMAT_MARKER not in content:
+            return None
+        version = self.engine_version()
+        if not version:
+            return None
+
+        digest = hashlib.sha1()
+        digest.update(f'{LatexCompiler.FORMAT_VERSION}|{self.engine}|{version}|'.encode('utf-8'))
+        digest.update(content[:content.index(LatexCompiler.FORMAT_MARKER)].encode('utf-8'))
+        with open(preamble, 'rb') as f:
+            digest.update(f.read())
+        return 'preamble-' + digest.hexdigest()[:16]
+
+    def format_exists(self, name):
+        return name is not None and osp.exists(osp.join(self.formats, name + '.fmt'))
+
+    def environment(self):
+        environment = QProcessEnvironment.systemEnvironment()
+        if self.formats:
+            # an empty entry at the end keeps the default search path
+            environment.insert('TEXFORMATS', self.formats + os.pathsep)
+        return environment
+
+    '''
+    Commands (program, arguments) compiling the document at path into the
+    given directory, run one after another in the folder of the document.
+    '''
+    def passes(self, path, directory, format_name=None):
+        options = ['-interaction=batchmode', '-halt-on-error', f'-output-directory={directory}']
+        latexmk = shutil.which('latexmk')
+        if latexmk:
+            engine = [LatexCompiler.ENGINES[self.engine]]
+            if format_name:
+                engine = [f'-{self.engine}={self.engine} -fmt={format_name} %O %S'] + engine
+            return [(latexmk, engine + ['-silent'] + options + [osp.basename(path)])]
+
+        executable = shutil.which(self.engine)
+        if not executable:
+            raise RuntimeError(f'Weder latexmk noch {self.engine} gefunden, die PDF kann nicht erstellt werden.')
+        if format_name:
+            options.append(f'-fmt={format_name}')
+        return [(executable, options + [osp.basename(path)])] * 2
+
+    '''
+    First error message in the log of the document, if any.
+    '''
+    @staticmethod
+    def log_error(path, directory):
+        log = osp.join(directory, osp.splitext(osp.basename(path))[0] + '.log')
+        if not osp.exists(log):
+            return None
+        with open(log, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.startswith('!'):
+                    return line[1:].strip()
+        return None
+
+    '''
+    Copy the compiled PDF next to the document, replacing an older one only
+    once the copy is complete.
+    '''
+    @staticmethod
+    def publish(path, directory):
+        stem = osp.splitext(osp.basename(path))[0]
+        target = osp.splitext(path)[0] + '.pdf'
+        temp = f'{target}.{os.getpid()}.tmp'
+        shutil.copyfile(osp.join(directory, stem + '.pdf'), temp)
+        os.replace(temp, target)
+
+    def start(self, resolve, reject, on_progress=None):
+        self.resolve = resolve
+        self.reject = reject
+        self.on_progress = on_progress if on_progress else lambda fraction: None
+
+        LatexCompiler.active.add(self)
+        self.directory = tempfile.TemporaryDirectory(prefix='auswertungstools-latex-')
+        try:
+            self.format_names = { path: self.format_name(path) for path in self.documents }
+            missing = {}
+            for (path, name) in self.format_names.items():
+                if name and not self.format_exists(name):
+                    missing[name] = path
+            for (name, path) in missing.items():
+                self.build_format(name, path)
+            if len(self.building) == 0:
+                self.queue_documents()
+        except BaseException:
+            self.cleanup()
+            raise
+
+    '''
+    Dump the document class and preamble.tex of the document at path into the
+    format file name (in the folder of the document, which holds preamble.tex).
+    '''
+    def build_format(self, name, path):
+        directory = osp.join(self.directory.name, name)
+        os.makedirs(directory)
+        with open(path, encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        stub = osp.join(directory, 'preamble-stub.tex')
+        with open(stub, 'w', encoding='utf-8') as f:
+            f.write(content[:content.index(LatexCompiler.FORMAT_MARKER)])
+            f.write(LatexCompiler.FORMAT_MARKER + '\n\\begin{document}\n\\end{document}\n')
+
+        executable = shutil.which(self.engine) or self.engine
+        process = QProcess()
+        process.setProcessEnvironment(self.environment())
+        process.setWorkingDirectory(osp.dirname(path))
+        process.finished.connect(lambda code, status, p=process: self.format_finished(p, code, status))
+        process.errorOccurred.connect(lambda error, p=process: self.format_error(p, error))
+        self.building[process] = (name, directory, time.perf_counter())
+        process.start(executable, [
+            '-ini', '-interaction=batchmode', '-halt-on-error', f'-jobname={name}',
+            f'-output-directory={directory}', f'&{self.engine}', 'mylatexformat.ltx', stub
+        ])
+
+    def format_finished(self, process, code, status):
+        if self.closed or process not in self.building:
+            return
+
+        (name, directory, start) = self.building.pop(process)
+        built = osp.join(directory, name + '.fmt')
+        if status == QProcess.NormalExit and code == 0 and osp.exists(built):
+            try:
+                os.makedirs(self.formats, exist_ok=True)
+                temp = osp.join(self.formats, f'{name}.{os.getpid()}.tmp')
+                shutil.copyfile(built, temp)
+                os.replace(temp, osp.join(self.formats, name + '.fmt'))
+                self.format_timings[name] = time.perf_counter() - start
+            except OSError:
+                # the documents are then compiled without the format
+                pass
+
+        if len(self.building) == 0:
+            self.queue_documents()
+
+    '''
+    A process that fails to start never emits finished. Without the format,
+    the documents are compiled from scratch.
+    '''
+    def format_error(self, process, error):
+        if self.closed or error != QProcess.FailedToStart or process not in self.building:
+            return
+        self.building.pop(process)
+        if len(self.building) == 0:
+            self.queue_documents()
+
+    def queue_documents(self):
+        for (i, path) in enumerate(self.documents):
+            directory = osp.join(self.directory.name, str(i))
+            os.makedirs(directory)
+            name = self.format_names[path]
+            passes = self.passes(path, directory, name if self.format_exists(name) else None)
+            self.queue.append((path, directory, passes))
+            self.total += len(passes)
+
+        self.launch()
+        if len(self.running) == 0:
+            self.finish()
+
+    def launch(self):
+        while self.queue and len(self.running) < self.process_count:
+            (path, directory, passes) = self.queue.pop(0)
+            self.run_pass(path, directory, passes, time.perf_counter())
+
+    def run_pass(self, path, directory, passes, start):
+        (program, arguments) = passes[0]
+        process = QProcess()
+        process.setProcessEnvironment(self.environment())
+        process.setWorkingDirectory(osp.dirname(path))
+        process.finished.connect(lambda code, status, p=process: self.pass_finished(p, code, status))
+        process.errorOccurred.connect(lambda error, p=process: self.pass_error(p, error))
+        self.running[process] = (path, directory, passes[1:], start)
+        process.start(program, arguments)
+
+    def pass_finished(self, process, code, status):
+        if self.closed or process not in self.running:
+            return
+
+        (path, directory, passes, start) = self.running.pop(process)
+        self.done += 1 + (len(passes) if code != 0 else 0)
+        self.on_progress(self.done / self.total)
+
+        if status != QProcess.NormalExit or code != 0:
+            error = LatexCompiler.log_error(path, directory) or f'Exit-Code {code}'
+            self.errors[path] = f'PDF von "{osp.basename(path)}" konnte nicht erstellt werden: {error}'
+        elif len(passes) > 0:
+            self.run_pass(path, directory, passes, start)
+            return
+        else:
+            try:
+                LatexCompiler.publish(path, directory)
+                self.timings[path] = time.perf_counter() - start
+            except OSError as e:
+                self.errors[path] = f'PDF von "{osp.basename(path)}" konnte nicht kopiert werden: {e}'
+
+        self.launch()
+        if len(self.running) == 0:
+            self.finish()
+
+    '''
+    A pass that fails to start never emits finished, so the document is given
+    up here. All other errors are followed by finished.
+    '''
+    def pass_error(self, process, error):
+        if self.closed or error != QProcess.FailedToStart or process not in self.running:
+            return
 
-    def reset(self):
-        self.startPoint = self.endPoint = None
-        self.isEmittingPoint = False
-        self.rubberBand.reset(QgsWkbTypes.PolygonGeometry)
+        (path, directory, passes, start) = self.running.pop(process)
+        self.done += 1 + len(passes)
+        self.on_progress(self.done / self.total)
+        self.errors[path] = f'PDF von "{osp.basename(path)}" konnte nicht erstellt werden: {process.errorString()}'
 
-    def canvasPressEvent(self, e):
-        self.startPoint = self.toMapCoordinates(e.pos())
-        self.endPoint = self.startPoint
-        self.isEmittingPoint = True
-        self.showRect(self.startPoint, self.endPoint)
+        self.launch()
+        if len(self.running) == 0:
+            self.finish()
 
+    def finish(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cleanup()
+        if len(self.errors) > 0:
+            self.reject(RuntimeError(next(iter(self.errors.values()))))
+        else:
+            self.resolve()
 
-    def canvasReleaseEvent(self, e):
-        self.isEmittingPoint = False
-        r = self.rectangle()
+    def cancel(self):
+        self.closed = True
+        for process in list(self.running.keys()) + list(self.building.keys()):
+            if process.state() != QProcess.NotRunning:
+                process.kill()
+                process.waitForFinished()
+        self.running = {}
+        self.building = {}
+        self.cleanup()
 
-        if r is not None:
-            self.reset()
-            self.action(r)
+    def cleanup(self):
+        LatexCompiler.active.discard(self)
+        if self.directory:
+            self.directory.cleanup()
+            self.directory = None
 
-    def canvasMoveEvent(self, e):
-        if not self.isEmittingPoint:
-            return
 
-        self.endPoint = self.toMapCoordinates(e.pos())
-        self.showRect(self.startPoint, self.endPoint)
+'''
+Writes vector layers and their styles into a GeoPackage over a single OGR
+connection. Features are streamed in transactions of BATCH_SIZE features, the
+styles are stored in the layer_styles table (as saveStyleToDatabase does) and
+the spatial indexes are built once all features are written. Example:
+
+writer = GeoPackageWriter('vorschlag.gpkg')
+writer.add(poi, 'Fotopunkt')
+writer.add(trenches, 'Trenches')
+writer.close()
+
+With append=True, the layers are added to an existing file; layers of the
+same name are replaced.
+'''
+class GeoPackageWriter:
+    BATCH_SIZE = 50000
+
+    FIELD_TYPES = {
+        QVariant.Int: ogr.OFTInteger,
+        QVariant.UInt: ogr.OFTInteger64,
+        QVariant.LongLong: ogr.OFTInteger64,
+        QVariant.ULongLong: ogr.OFTInteger64,
+        QVariant.Double: ogr.OFTReal,
+        QVariant.Bool: ogr.OFTInteger,
+        QVariant.Date: ogr.OFTDate,
+        QVariant.DateTime: ogr.OFTDateTime,
+    }
+
+    STYLE_FIELDS = [
+        ('f_table_catalog', ogr.OFTString), ('f_table_schema', ogr.OFTString),
+        ('f_table_name', ogr.OFTString), ('f_geometry_column', ogr.OFTString),
+        ('styleName', ogr.OFTString), ('styleQML', ogr.OFTString), ('styleSLD', ogr.OFTString),
+        ('useAsDefault', ogr.OFTInteger), ('description', ogr.OFTString), ('owner', ogr.OFTString),
+        ('ui', ogr.OFTString), ('update_time', ogr.OFTDateTime),
+    ]
+
+    def __init__(self, path, append=False):
+        driver = ogr.GetDriverByName('GPKG')
+        if append and osp.exists(path):
+            self.datasource = driver.Open(path, 1)
+        else:
+            if osp.exists(path):
+                driver.DeleteDataSource(path)
+            self.datasource = driver.CreateDataSource(path)
+        if self.datasource is None:
+            raise RuntimeError(f'GeoPackage "{path}" konnte nicht geöffnet werden.')
+        self.path = path
+        self.styles = []
+        self.indexed = []
+        self.datasource.StartTransaction()
 
+    @staticmethod
+    def geometry_type(layer):
+        wkb_type = layer.wkbType()
+        if wkb_type == QgsWkbTypes.NoGeometry:
+            return ogr.wkbNone
+        result = int(QgsWkbTypes.flatType(wkb_type))
+        if QgsWkbTypes.hasZ(wkb_type):
+            result = ogr.GT_SetZ(result)
+        if QgsWkbTypes.hasM(wkb_type):
+            result = ogr.GT_SetM(result)
+        return result
 
-    def showRect(self, startPoint, endPoint):
-        self.rubberBand.reset(QgsWkbTypes.PolygonGeometry)
-        if startPoint.x() == endPoint.x() or startPoint.y() == endPoint.y():
-            return
+    def create_layer(self, layer, name):
+        for i in range(self.datasource.GetLayerCount()):
+            if self.datasource.GetLayerByIndex(i).GetName() == name:
+                self.datasource.DeleteLayer(i)
+                break
+
+        srs = None
+        if layer.crs().isValid():
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(layer.crs().toWkt(QgsCoordinateReferenceSystem.WKT1_GDAL))
+        options = ['SPATIAL_INDEX=NO', 'FID=fid', 'GEOMETRY_NAME=geom']
+        target = self.datasource.CreateLayer(name, srs, GeoPackageWriter.geometry_type(layer), options)
+        if target is None:
+            raise RuntimeError(f'Layer "{name}" konnte nicht in "{self.path}" angelegt werden.')
+        return target
 
-        point1 = QgsPointXY(startPoint.x(), startPoint.y())
-        point2 = QgsPointXY(startPoint.x(), endPoint.y())
-        point3 = QgsPointXY(endPoint.x(), endPoint.y())
-        point4 = QgsPointXY(endPoint.x(), startPoint.y())
+    '''
+    Create the fields of the target layer. Returns for every source field the
+    index in the target layer and the converter of its values; the "fid"
+    field of layers from GeoPackages becomes the feature id instead.
+    '''
+    def create_fields(self, layer, target):
+        columns = []
+        for field in layer.fields():
+            if field.name().lower() == 'fid':
+                columns.append(('fid', None))
+                continue
 
-        self.rubberBand.addPoint(point1, False)
-        self.rubberBand.addPoint(point2, False)
-        self.rubberBand.addPoint(point3, False)
-        self.rubberBand.addPoint(point4, True)    # true to update canvas
-        self.rubberBand.show()
+            field_type = GeoPackageWriter.FIELD_TYPES.get(field.type(), ogr.OFTString)
+            definition = ogr.FieldDefn(field.name(), field_type)
+            if field.type() == QVariant.Bool:
+                definition.SetSubType(ogr.OFSTBoolean)
+            if target.CreateField(definition) != ogr.OGRERR_NONE:
+                self.fail(f'Feld "{field.name()}" konnte nicht angelegt werden')
+            index = target.GetLayerDefn().GetFieldIndex(field.name())
+
+            if field.type() == QVariant.Bool:
+                convert = lambda value: int(bool(value))
+            elif field.type() == QVariant.Date:
+                convert = lambda value: value.toString(Qt.ISODate)
+            elif field.type() == QVariant.DateTime:
+                convert = lambda value: value.toString(Qt.ISODateWithMs)
+            elif field_type == ogr.OFTString:
+                convert = str
+            else:
+                convert = None
+            columns.append((index, convert))
+        return columns
+
+    def add(self, layer, name):
+        target = self.create_layer(layer, name)
+        columns = self.create_fields(layer, target)
+        definition = target.GetLayerDefn()
+        has_geometry = layer.wkbType() != QgsWkbTypes.NoGeometry
+
+        count = 0
+        for feature in layer.getFeatures():
+            output = ogr.Feature(definition)
+            for ((index, convert), value) in zip(columns, feature.attributes()):
+                if value is None or (isinstance(value, QVariant) and value.isNull()):
+                    continue
+                if index == 'fid':
+                    output.SetFID(int(value))
+                else:
+                    output.SetField(index, convert(value) if convert else value)
+
+            geometry = feature.geometry()
+            if has_geometry and not geometry.isNull():
+                output.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+            if target.CreateFeature(output) != ogr.OGRERR_NONE:
+                self.fail(f'Objekt {feature.id()} von "{name}" konnte nicht geschrieben werden')
+
+            count += 1
+            if count % GeoPackageWriter.BATCH_SIZE == 0:
+                self.datasource.CommitTransaction()
+                self.datasource.StartTransaction()
+
+        doc = QDomDocument()
+        layer.exportNamedStyle(doc)
+        self.styles.append((name, 'geom' if has_geometry else '', doc.toString()))
+        if has_geometry:
+            self.indexed.append(name)
+
+    def write_styles(self):
+        styles = self.datasource.GetLayerByName('layer_styles')
+        if styles is None:
+            styles = self.datasource.CreateLayer('layer_styles', None, ogr.wkbNone, ['FID=id'])
+            for (name, field_type) in GeoPackageWriter.STYLE_FIELDS:
+                styles.CreateField(ogr.FieldDefn(name, field_type))
+
+        timestamp = QDateTime.currentDateTimeUtc().toString(Qt.ISODate)
+        for (name, geometry_column, qml) in self.styles:
+            quoted = name.replace("'", "''")
+            styles.SetAttributeFilter(f"f_table_name = '{quoted}' AND styleName = '{quoted}'")
+            for existing in [f.GetFID() for f in styles]:
+                styles.DeleteFeature(existing)
+            styles.SetAttributeFilter(None)
+
+            row = ogr.Feature(styles.GetLayerDefn())
+            row.SetField('f_table_catalog', '')
+            row.SetField('f_table_schema', '')
+            row.SetField('f_table_name', name)
+            row.SetField('f_geometry_column', geometry_column)
+            row.SetField('styleName', name)
+            row.SetField('styleQML', qml)
+            row.SetField('styleSLD', '')
+            row.SetField('useAsDefault', 1)
+            row.SetField('description', '')
+            row.SetField('owner', '')
+            row.SetField('ui', '')
+            row.SetField('update_time', timestamp)
+            if styles.CreateFeature(row) != ogr.OGRERR_NONE:
+                self.fail(f'Stil von "{name}" konnte nicht geschrieben werden')
 
-    def rectangle(self):
-        if self.startPoint is None or self.endPoint is None:
-            return None
-        elif (self.startPoint.x() == self.endPoint.x() or \
-            self.startPoint.y() == self.endPoint.y()):
-            return None
-        return QgsRectangle(self.startPoint, self.endPoint)
+    '''
+    Discard the current transaction and raise the error, with the reason
+    reported by GDAL.
+    '''
+    def fail(self, message):
+        reason = gdal.GetLastErrorMsg()
+        self.datasource.RollbackTransaction()
+        self.datasource = None
+        raise RuntimeError(f'{message} ({self.path}): {reason}' if reason else f'{message} ({self.path}).')
 
-    def deactivate(self):
-        QgsMapTool.deactivate(self)
-        self.reset()
-        self.deactivated.emit()
+    def close(self):
+        self.write_styles()
+        self.datasource.CommitTransaction()
+        for name in self.indexed:
+            quoted = name.replace("'", "''")
+            self.datasource.ExecuteSQL(f"SELECT CreateSpatialIndex('{quoted}', 'geom')")
+        self.datasource = None
 
 
 class GeneratePresentation:
+    # contents of template/manifest.json, loaded on first use
+    templates = None
+    # ranges in the subset string of a view (see fid_subset)
+    MAX_SUBSET_RANGES = 200
+
+    # backends of the trench and surface statistics (see Aggregation.create)
+    STATISTICS_BACKENDS = { 'expression': 'QGIS-Ausdrücke', 'numpy': 'NumPy' }
+
+    # what the evaluation steps read of the selected layers, per layer key
+    PROJECTIONS = {
+        'calculate_address_statistics': {
+            'addresses': Projection(['Pruefung', 'Total Kunde', 'Total DNP']),
+        },
+        'calculate_trench_lengths': {
+            # $length needs the geometries
+            'trenches': Projection(['Belag', 'Verfahren', 'In_Strasse', 'Handschachtung', 'Privatweg', 'Sonderquerung'], True),
+        },
+        'calculate_surface_statistics': {
+            'surfaces': Projection(['Belag', 'Typ', 'Handschachtung'], True),
+        },
+        'process_points_of_interest': {
+            'poi': Projection(['Punkt_ID'], True),
+        },
+        # the attributes the renderers need are added when copying
+        'maps': { key: Projection([], True) for key in ['poi', 'addresses', 'trenches', 'surfaces', 'polygons'] },
+    }
+
     def __init__(self, iface):
         self.iface = iface
         self.image_width = 1150
@@ -641,6 +3140,15 @@ class GeneratePresentation:
         self.destination_directory = osp.expanduser("~")
         self.dir_path = osp.dirname(osp.realpath(__file__))
         self.progress = None
+        # backend for the trench and surface statistics, see STATISTICS_BACKENDS
+        self.statistics_backend = 'expression'
+        # number of processes rendering the Fotopunkt maps, 1 renders them in QGIS itself
+        self.export_processes = 1
+        # engine and number of concurrent compilations for the optional PDF stage
+        self.latex_engine = 'pdflatex'
+        self.latex_processes = os.cpu_count() or 1
+        # run every task under cProfile (see TaskProfiler)
+        self.profile_tasks = False
 
     def initGui(self):
         presIcon = QIcon(osp.join(self.dir_path, 'file-easel.png'))
@@ -702,6 +3210,7 @@ class GeneratePresentation:
         del self.make_pic_action
         self.iface.unregisterMainWindowAction(self.select_rectangle_action)
         del self.select_rectangle_action
+        LayerCatalog.release()
 
     def attempt(self, fn):
         def inner(*args):
@@ -733,12 +3242,25 @@ class GeneratePresentation:
         self.iface.statusBarIface().clearMessage()
         self.iface.messageBar().pushMessage("Fehler", str(e), level=Qgis.Critical)
 
+    @staticmethod
+    def close_run(data):
+        if data.renderer:
+            data.renderer.close()
+
     def show_success(self, data):
+        GeneratePresentation.close_run(data)
         dst = data.destination
+        message = "<a href=\"file:///" + dst + "\">" + dst + "</a>"
+        if data.compile_timings:
+            message += " (PDF in {:.1f} s)".format(sum(data.compile_timings.values()))
+        if data.profiler:
+            slowest = ', '.join(['{} {:.1f} s'.format(name, seconds) for (name, seconds) in data.profiler.slowest(3)])
+            if slowest:
+                message += "<br>Langsamste Schritte: " + slowest
         self.iface.statusBarIface().clearMessage()
         self.iface.messageBar().pushMessage(
             "Erfolg",
-            "<a href=\"file:///" + dst + "\">" + dst + "</a>",
+            message,
             level=Qgis.MessageLevel.Success,
             duration=15
         )
@@ -755,32 +3277,138 @@ class GeneratePresentation:
 
     @staticmethod
     def require_layer_gracious(key):
-        layers = QgsProject.instance().mapLayers()
-        for layer in layers.values():
-            if key in layer.name():
-                return layer
-
-        return None
+        layers = LayerCatalog.instance().layers_named(key)
+        return layers[0] if len(layers) > 0 else None
 
     @staticmethod
     def require_layer(key):
-        layers = QgsProject.instance().mapLayers()
-        result = None
-        for layer in layers.values():
-            if key in layer.name():
-                if result:
-                    raise RuntimeError('Multiple layers containing the key "' + key + '" found! Make sure that there is only one.')
-                else:
-                    result = layer
-
-        if not result:
+        layers = LayerCatalog.instance().layers_named(key)
+        if len(layers) > 1:
+            raise RuntimeError('Multiple layers containing the key "' + key + '" found! Make sure that there is only one.')
+        if len(layers) == 0:
             raise RuntimeError('No layer containing the key "' + key + '" found!')
 
-        return result
+        return layers[0]
+
+    '''
+    Directory for data the plugin keeps between runs, e.g. the measure cache.
+    '''
+    @staticmethod
+    def cache_directory():
+        directory = osp.join(QgsApplication.qgisSettingsDirPath(), 'auswertungstools')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def runtime_history(self):
+        return RuntimeHistory(osp.join(GeneratePresentation.cache_directory(), 'runtimes.json'))
+
+    def render_cache(self, fingerprints=None):
+        return RenderCache(osp.join(GeneratePresentation.cache_directory(), 'renders'), fingerprints)
+
+    '''
+    The main documents of the presentations in the destination, i.e. the .tex
+    files in the Praesentation folder that start a document class.
+    '''
+    @staticmethod
+    def presentation_documents(destination):
+        documents = []
+        for path in sorted(glob.glob(osp.join(destination, 'Praesentation', '*.tex'))):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                if '\\documentclass' in f.read(4096):
+                    documents.append(path)
+        return documents
+
+    '''
+    Compile the presentations in data.destination to PDF if data.compile is
+    set. The compile time of every document is stored in data.compile_timings.
+    on_cancel is given the function cancelling the running compilations.
+    '''
+    def compile_presentation(self, data, resolve, reject, on_progress=None, on_cancel=None):
+        if not data.compile:
+            resolve()
+            return
+
+        formats = osp.join(GeneratePresentation.cache_directory(), 'formats')
+        compiler = LatexCompiler(self.latex_engine, self.latex_processes, formats)
+        for path in GeneratePresentation.presentation_documents(data.destination):
+            compiler.add(path)
 
-    def copy_template(self, subfolder, destination):
+        def done():
+            data.compile_timings = compiler.timings
+            resolve()
+        compiler.start(done, reject, on_progress)
+        if on_cancel and not compiler.closed:
+            on_cancel(compiler.cancel)
+
+    '''
+    Deploy a template into the destination as listed in template/manifest.json,
+    except for the files in keep (paths relative to the destination). In the
+    file names, the keys of renames are replaced by their values (e.g. OOO by
+    the Ort). Files are cloned where the file system supports it; read-only
+    assets (see template_manifest.LINKABLE) are otherwise hard-linked and all
+    other files, including the example images, copied.
+    '''
+    def copy_template(self, subfolder, destination, keep=[], renames={}):
         source = osp.join(self.dir_path, "template", subfolder)
-        shutil.copytree(source, destination, dirs_exist_ok=True)
+        if GeneratePresentation.templates is None:
+            GeneratePresentation.templates = template_manifest.load(osp.join(self.dir_path, "template"))
+        folder = GeneratePresentation.templates['folders'][subfolder]
+        keep = set([osp.normpath(path) for path in keep])
+
+        def rename(path):
+            for (key, value) in renames.items():
+                path = path.replace(key, value)
+            return path
+
+        for directory in folder['directories']:
+            os.makedirs(osp.join(destination, rename(directory)), exist_ok=True)
+
+        for entry in folder['files']:
+            target = rename(entry['path'])
+            if osp.normpath(target) in keep:
+                continue
+            GeneratePresentation.deploy_file(osp.join(source, entry['path']), osp.join(destination, target), entry['link'])
+
+    @staticmethod
+    def deploy_file(source, target, link):
+        if osp.exists(target):
+            if link and osp.samefile(source, target):
+                return
+            # never write through an earlier hard link into the template
+            os.remove(target)
+
+        if GeneratePresentation.reflink(source, target):
+            return
+        if link:
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                # e.g. another drive or a file system without hard links
+                pass
+        shutil.copyfile(source, target)
+
+    '''
+    Clone the file as copy-on-write copy (Linux with btrfs or XFS). Returns
+    whether that was possible.
+    '''
+    @staticmethod
+    def reflink(source, target):
+        try:
+            import fcntl
+        except ImportError:
+            return False
+
+        FICLONE = 0x40049409
+        with open(source, 'rb') as s, open(target, 'wb') as t:
+            try:
+                fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+                return True
+            except OSError:
+                pass
+        os.remove(target)
+        return False
+
 
     @staticmethod
     def add_rule(root_rule, expression, color, stroke_color = None, width = None):
@@ -845,30 +3473,16 @@ class GeneratePresentation:
                 duration=15
             )
 
-    def make_pic_pdf(self, layers, destination, extent=None, zoom_factor=4):
-        project = QgsProject.instance()
-        layout = QgsPrintLayout(project)
-        layout.initializeDefaults()
-
-        width = self.image_width / zoom_factor
-        height = self.image_height / zoom_factor
-        size = QgsLayoutSize(width, height)
-        pc = layout.pageCollection()
-        pc.pages()[0].setPageSize(size)
-
+    def make_pic_pdf(self, layers, destination, extent=None, zoom_factor=4, renderer=None):
         if not extent:
             extent = self.calculate_extent()
 
-        map = QgsLayoutItemMap(layout)
-        map.setRect(0, 0, width, height)
-        map.zoomToExtent(extent)
-        map.setExtent(extent)
-        map.setLayers(layers)
-        map.setBackgroundColor(QColor(255, 255, 255, 0))
-        layout.addLayoutItem(map)
-
-        exporter = QgsLayoutExporter(layout)
-        exporter.exportToPdf(destination, QgsLayoutExporter.PdfExportSettings())
+        if renderer:
+            renderer.render(layers, destination, extent, zoom_factor)
+        else:
+            renderer = MapRenderer(self.image_width, self.image_height)
+            renderer.render(layers, destination, extent, zoom_factor)
+            renderer.close()
 
     def make_pic_png(self, layers, destination):
         settings = QgsMapSettings()
@@ -886,30 +3500,167 @@ class GeneratePresentation:
         # Start the rendering
         render.start()
 
+    '''
+    Request for copying the features with the given ids (all features if ids
+    is None). With a Projection, the copy only contains its attributes and
+    those the renderer needs, and no geometries unless the projection needs
+    them.
+    '''
+    @staticmethod
+    def materialize_request(layer, ids, projection=None):
+        request = QgsFeatureRequest() if ids is None else QgsFeatureRequest().setFilterFids(list(ids))
+        if projection is not None:
+            attributes = list(projection.attributes)
+            if layer.renderer():
+                used = layer.renderer().usedAttributes(QgsRenderContext())
+                attributes += [a for a in sorted(used) if a not in attributes]
+            Projection(attributes, projection.geometry).request(layer, request)
+        return request
+
+    '''
+    Combined Projection of all evaluation steps reading the layer key, or None
+    if no step declares what it reads of it.
+    '''
+    @staticmethod
+    def projection(key):
+        projections = [p[key] for p in GeneratePresentation.PROJECTIONS.values() if key in p]
+        return Projection.union(projections) if len(projections) > 0 else None
+
+    '''
+    Subset string restricting a layer of the OGR provider to the given feature
+    ids (in addition to its own subset string), or None for other providers.
+    Runs of consecutive ids are written as ranges, at most MAX_SUBSET_RANGES of
+    them: SQLite limits the depth of the OR chain, so beyond that all ids are
+    listed in a single IN.
+    '''
+    @staticmethod
+    def fid_subset(layer, ids):
+        if layer.providerType() != 'ogr':
+            return None
+
+        parts = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+        dataset = ogr.Open(parts.get('path', ''))
+        if dataset is None:
+            return None
+        if parts.get('layerName'):
+            source = dataset.GetLayerByName(parts['layerName'])
+        else:
+            source = dataset.GetLayer(parts.get('layerId') or 0)
+        if source is None:
+            return None
+        column = source.GetFIDColumn()
+        column = f'"{column}"' if column else 'FID'
+
+        ids = sorted(ids)
+        singles = []
+        ranges = []
+        start = 0
+        for i in range(1, len(ids) + 1):
+            if i == len(ids) or ids[i] != ids[i - 1] + 1:
+                if i - start >= 3:
+                    ranges.append(f'{column} BETWEEN {ids[start]} AND {ids[i - 1]}')
+                else:
+                    singles += ids[start:i]
+                start = i
+        if len(ranges) > GeneratePresentation.MAX_SUBSET_RANGES:
+            (singles, ranges) = (ids, [])
+        conditions = ranges
+        if len(singles) > 0 or len(ranges) == 0:
+            conditions = [f'{column} IN ({",".join([str(fid) for fid in singles] or ["-1"])})'] + ranges
+        subset = ' OR '.join(conditions)
+
+        if layer.subsetString():
+            return f'({layer.subsetString()}) AND ({subset})'
+        return subset
+
+    '''
+    Make the features of layer with the given ids available as a layer of
+    their own. Layers of the OGR provider get a view: a clone restricted to the
+    ids by a subset string, which reads from the same data source instead of
+    copying the features. All other layers (and views whose subset string is
+    rejected) are copied into a memory layer with the given Projection. Steps
+    that modify the layer have to use editable_copy first.
+    '''
     @staticmethod
-    def features_within_selection(layer):
-        copy = layer.materialize(QgsFeatureRequest().setFilterFids(layer.selectedFeatureIds()))
+    def layer_view(layer, ids, projection=None):
+        ids = list(ids)
+        subset = GeneratePresentation.fid_subset(layer, ids)
+        if subset is not None:
+            view = layer.clone()
+            if view.setSubsetString(subset) and view.featureCount() == len(ids):
+                return view
+
+        copy = layer.materialize(GeneratePresentation.materialize_request(layer, ids, projection))
         copy.setRenderer(layer.renderer().clone())
         return copy
 
+    '''
+    Layer that may be edited without touching the project, i.e. a memory
+    copy of a view (see layer_view), optionally only of the given Projection.
+    Memory layers are copies already.
+    '''
     @staticmethod
-    def features_within_polygons(layer, polygons):
-        ids = set()
-        for polygon in polygons:
-            request = QgsFeatureRequest().setDistanceWithin(polygon.geometry(), 0).setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([])
-            ids.update([f.id() for f in layer.getFeatures(request)])
-        copy = layer.materialize(QgsFeatureRequest().setFilterFids(list(ids)))
+    def editable_copy(layer, projection=None):
+        if layer.providerType() == 'memory':
+            return layer
+        copy = layer.materialize(GeneratePresentation.materialize_request(layer, None, projection))
         copy.setRenderer(layer.renderer().clone())
         return copy
 
     @staticmethod
-    def filtered_column_sum(layer, condition, column):
-        values = QgsVectorLayerUtils.getValues(layer, f'CASE WHEN {condition} THEN {column} ELSE 0 END')[0]
-        return sum([x if x else 0 for x in values])
+    def features_within_selection(layer, projection=None):
+        return GeneratePresentation.layer_view(layer, layer.selectedFeatureIds(), projection)
+
+    '''
+    Select all features of layer which intersect one of the polygons as layer
+    of their own (see layer_view). The polygons are united into a single prepared geometry, so
+    that membership is resolved in one iteration over the candidates within its
+    bounding box (which uses the provider's spatial index). Alternatively, a
+    QgsSpatialIndex of layer built with FlagStoreFeatureGeometries can be given
+    to avoid querying the provider at all, e.g. when evaluating several Orte.
+    Where the features have to be copied, only the given Projection of them is
+    copied (see materialize_request).
+    '''
+    @staticmethod
+    def features_within_polygons(layer, polygons, projection=None, index=None):
+        geometries = [p.geometry() for p in polygons if p.hasGeometry()]
+        union = QgsGeometry.unaryUnion(geometries) if len(geometries) > 0 else QgsGeometry()
+
+        ids = []
+        if union.isNull() or union.isEmpty():
+            # invalid polygons cannot be united, query them one by one instead
+            ids = set()
+            for polygon in polygons:
+                request = QgsFeatureRequest().setDistanceWithin(polygon.geometry(), 0).setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([])
+                ids.update([f.id() for f in layer.getFeatures(request)])
+        elif index:
+            engine = QgsGeometry.createGeometryEngine(union.constGet())
+            engine.prepareGeometry()
+            for fid in index.intersects(union.boundingBox()):
+                geometry = index.geometry(fid)
+                if not geometry.isNull() and engine.intersects(geometry.constGet()):
+                    ids.append(fid)
+        else:
+            engine = QgsGeometry.createGeometryEngine(union.constGet())
+            engine.prepareGeometry()
+            request = QgsFeatureRequest().setFilterRect(union.boundingBox()).setNoAttributes()
+            for feature in layer.getFeatures(request):
+                geometry = feature.geometry()
+                if not geometry.isNull() and engine.intersects(geometry.constGet()):
+                    ids.append(feature.id())
+
+        return GeneratePresentation.layer_view(layer, ids, projection)
+
+    @staticmethod
+    def filtered_column_sum(layer, condition, column, measures=None):
+        aggregation = Aggregation(layer, measures)
+        bucket = aggregation.add(condition, column)
+        aggregation.run()
+        return bucket.value
 
     @staticmethod
-    def filtered_length_sum(layer, condition):
-        return math.ceil(GeneratePresentation.filtered_column_sum(layer, condition, '$length'))
+    def filtered_length_sum(layer, condition, measures=None):
+        return math.ceil(GeneratePresentation.filtered_column_sum(layer, condition, '$length', measures))
 
     @staticmethod
     def calculate_address_statistics(data):
@@ -946,17 +3697,19 @@ class GeneratePresentation:
                 table.add_row([c.label, c.value[0], '', '', ''], c.color)
 
         with open(osp.join(destination, "Praesentation", "AdressStatistik.tex"), "w") as f:
-            f.write('\\newcommand\\adressStatistik{' + table.to_latex('l@{}l|rrrr', 'colordot') + '}')
+            f.write('\\newcommand\\adressStatistik{')
+            table.to_latex('l@{}l|rrrr', 'colordot', f)
+            f.write('}')
 
-        table.set_cell(1, 2, 'Einheiten Kunde')
+        table.set_xlsx_cell(1, 2, 'Einheiten Kunde')
         total_offset = len(normal_categories) + 2
-        table.set_cell(total_offset, 1, f'=SUM(C3:C{total_offset})')
-        table.set_cell(total_offset, 2, f'=SUM(D3:D{total_offset})')
-        table.set_cell(total_offset, 3, f'=SUM(E3:E{total_offset})')
-        table.set_cell(total_offset, 4, f'=SUM(F3:F{total_offset})')
+        table.set_xlsx_cell(total_offset, 1, f'=SUM(C3:C{total_offset})')
+        table.set_xlsx_cell(total_offset, 2, f'=SUM(D3:D{total_offset})')
+        table.set_xlsx_cell(total_offset, 3, f'=SUM(E3:E{total_offset})')
+        table.set_xlsx_cell(total_offset, 4, f'=SUM(F3:F{total_offset})')
 
         for i in range(3, 3 + len(normal_categories)):
-            table.set_cell(i - 1, 4, f'=E{i}-D{i}')
+            table.set_xlsx_cell(i - 1, 4, f'=E{i}-D{i}')
 
         workbook = xlsxwriter.Workbook(osp.join(destination, "Adressauswertung.xlsx"))
         table.to_xlsx(workbook, [2, 25, 15, 15, 15, 15])
@@ -970,21 +3723,35 @@ class GeneratePresentation:
         conditions = ['"Belag" = \'a\'', '"Belag" = \'t\'', '"Belag" = \'g\'', '"Belag" = \'m\'',  '"Belag" = \'k\'']
         columns = ['1', '0', '"In_Strasse"', '"Handschachtung"', '"Privatweg"']
 
+        # collect all sums in a single pass over the trench layer
+        aggregation = Aggregation.create(layer, data.measures, data.backend)
+        length = lambda condition: aggregation.add(condition, '$length')
+
         result = []
         for condition in conditions:
             row = []
             for column in columns:
-                row.append(GeneratePresentation.filtered_length_sum(layer, f'{condition} and {column}'))
+                row.append(length(f'{condition} and {column}'))
             result.append(row)
 
+        rohrpressung = length('"Belag" = \'c\' and "Verfahren" = \'r\'')
+        rohrpressung_privat = length('"Belag" = \'c\' and "Verfahren" = \'r\' and "Privatweg"')
+        spuelbohrung = length('"Belag" = \'c\' and "Verfahren" = \'h\'')
+        spuelbohrung_privat = length('"Belag" = \'c\' and "Verfahren" = \'h\' and "Privatweg"')
+        special_crossings = aggregation.count('"Sonderquerung"')
+        aggregation.run()
+        if data.measures:
+            data.measures.save()
+
+        result = [[math.ceil(bucket.value) for bucket in row] for row in result]
         offener_tiefbau = [sum([row[col] for row in result]) for col in range(len(columns))]
-        rohrpressung = GeneratePresentation.filtered_length_sum(layer, '"Belag" = \'c\' and "Verfahren" = \'r\'')
-        rohrpressung_privat = GeneratePresentation.filtered_length_sum(layer, '"Belag" = \'c\' and "Verfahren" = \'r\' and "Privatweg"')
-        spuelbohrung = GeneratePresentation.filtered_length_sum(layer, '"Belag" = \'c\' and "Verfahren" = \'h\'')
-        spuelbohrung_privat = GeneratePresentation.filtered_length_sum(layer, '"Belag" = \'c\' and "Verfahren" = \'h\' and "Privatweg"')
+        rohrpressung = math.ceil(rohrpressung.value)
+        rohrpressung_privat = math.ceil(rohrpressung_privat.value)
+        spuelbohrung = math.ceil(spuelbohrung.value)
+        spuelbohrung_privat = math.ceil(spuelbohrung_privat.value)
         geschlossener_tiefbau = [rohrpressung + spuelbohrung, None, None, None, rohrpressung_privat + spuelbohrung_privat]
 
-        special_crossings = Counter(filter(None, QgsVectorLayerUtils.getValues(layer, '"Sonderquerung"')[0]))
+        special_crossings = special_crossings.value
 
         total = offener_tiefbau[0] + geschlossener_tiefbau[0]
         trench_table = Table()
@@ -1003,9 +3770,9 @@ class GeneratePresentation:
         trench_table.add_row(['Rohrpressung', rohrpressung, None, None, None, rohrpressung_privat], QColor('#ffba0b'))
         trench_table.add_row(['Spülbohrung',  spuelbohrung, None, None, None, spuelbohrung_privat], QColor('#01ffe1'))
 
-        for row in trench_table.rows:
-            value = round(row[1] * 100 / total) if total > 0 else 0
-            row[2] = (value, '%')
+        for i in range(len(trench_table)):
+            value = round(trench_table.value(i, 1) * 100 / total) if total > 0 else 0
+            trench_table.set_value(i, 2, value, '%')
 
         if special_crossings.total() == 0:
             trench_table.add_row(['Sonderquerungen', None, None, None, None, None], Table.Highlight.SECONDARY)
@@ -1018,18 +3785,20 @@ class GeneratePresentation:
         trench_table.numbers_to_unit('m')
 
         with open(osp.join(destination, "Praesentation", "TrenchStatistik.tex"), "w") as f:
-            f.write('\\newcommand\\trenchStatistik{' + trench_table.to_latex('l@{}l|rr|rrr', 'colorrule') + '}')
-
-        trench_table.set_cell(1, 1, (f'=SUM(C3:C7)', 'm'))
-        trench_table.set_cell(1, 3, (f'=SUM(G3:G7)', 'm'))
-        trench_table.set_cell(1, 4, (f'=SUM(I3:I7)', 'm'))
-        trench_table.set_cell(1, 5, (f'=SUM(K3:K7)', 'm'))
-
-        trench_table.set_cell(7, 1, ('=SUM(C9:C10)', 'm'))
-        trench_table.set_cell(7, 5, ('=SUM(K9:K10)', 'm'))
-        trench_table.set_cell(0, 1, ('=C2+C8', 'm'))
+            f.write('\\newcommand\\trenchStatistik{')
+            trench_table.to_latex('l@{}l|rr|rrr', 'colorrule', f)
+            f.write('}')
+
+        trench_table.set_xlsx_cell(1, 1, '=SUM(C3:C7)')
+        trench_table.set_xlsx_cell(1, 3, '=SUM(G3:G7)')
+        trench_table.set_xlsx_cell(1, 4, '=SUM(I3:I7)')
+        trench_table.set_xlsx_cell(1, 5, '=SUM(K3:K7)')
+
+        trench_table.set_xlsx_cell(7, 1, '=SUM(C9:C10)')
+        trench_table.set_xlsx_cell(7, 5, '=SUM(K9:K10)')
+        trench_table.set_xlsx_cell(0, 1, '=C2+C8')
         if special_crossings.total() > 0:
-            trench_table.set_cell(10, 1, (f'=SUM(C12:C{12+len(special_crossings)})', 'St.'))
+            trench_table.set_xlsx_cell(10, 1, f'=SUM(C12:C{12+len(special_crossings)})')
 
         workbook = xlsxwriter.Workbook(osp.join(destination, "Trenches.xlsx"))
         trench_table.to_xlsx(workbook, [5, 25, 15, 2, 10, 2, 15, 2, 15, 2, 15, 2])
@@ -1071,7 +3840,13 @@ class GeneratePresentation:
         )
         return self.calculate_extent([rect])
 
-    def process_points_of_interest(self, data, layers):
+    '''
+    Render a detail map of every Fotopunkt. With more than one export process
+    (data.export_processes) and enough Fotopunkte, the maps are rendered by an
+    ExportPool, and once the processes are started, on_waiting is called and
+    on_cancel is given the function cancelling them.
+    '''
+    def process_points_of_interest(self, data, layers, resolve, reject, on_progress=None, on_waiting=None, on_cancel=None):
         points = data.points_of_interest
         extent = data.extent
         dst = data.destination
@@ -1079,6 +3854,7 @@ class GeneratePresentation:
         max_id = max([point["Punkt_ID"] for point in points] + [6])
         x_coords = [0] * max_id
         y_coords = [0] * max_id
+        jobs = []
         for point in points:
             geometry = point.geometry()
             if geometry.type() != Qgis.GeometryType.Point:
@@ -1090,8 +3866,7 @@ class GeneratePresentation:
             y_coords[id-1] = 1 - (pt.y() - extent.yMinimum()) / extent.height()
 
             rect = self.rectangle_around_point(pt)
-            path = osp.join(dst, "Bilder", f"fotopunkt{id}.pdf")
-            self.make_pic_pdf(layers, path, rect, zoom_factor=20)
+            jobs.append((rect, osp.join(dst, "Bilder", f"fotopunkt{id}.pdf")))
 
         with open(osp.join(dst, "Praesentation", "PointsOfInterest.tex"), "w") as f:
             x_coords_str = ''.join(['{' + str(x) + '}' for x in x_coords])
@@ -1099,12 +3874,52 @@ class GeneratePresentation:
             f.write('\\storedata\\xcoords{' + x_coords_str + '}\n')
             f.write('\\storedata\\ycoords{' + y_coords_str + '}')
 
+        # maps that did not change since an earlier run are copied from the cache
+        renderer = data.renderer
+        jobs = [(rect, path) for (rect, path) in jobs if not renderer.restore(layers, path, rect, 20)]
+
+        processes = data.export_processes or self.export_processes
+        if processes > 1 and len(jobs) >= ExportPool.MIN_JOBS:
+            def done():
+                for (rect, path) in jobs:
+                    renderer.store(layers, path, rect, 20)
+                resolve()
+
+            pool = ExportPool(self.image_width, self.image_height, 20, processes)
+            for (rect, path) in jobs:
+                pool.add(rect, path)
+            pool.start(layers, done, reject, on_progress)
+            if on_cancel and not pool.closed:
+                on_cancel(pool.cancel)
+            if on_waiting:
+                on_waiting()
+            return
+
+        for (i, (rect, path)) in enumerate(jobs):
+            self.make_pic_pdf(layers, path, rect, zoom_factor=20, renderer=renderer)
+            if on_progress:
+                on_progress((i + 1) / len(jobs))
+        resolve()
+
+    '''
+    Files written by process_points_of_interest: the coordinates of the
+    Fotopunkte and a map of each.
+    '''
+    @staticmethod
+    def points_of_interest_outputs(points):
+        ids = set()
+        for point in points:
+            if point.hasGeometry() and point.geometry().type() == Qgis.GeometryType.Point:
+                ids.add(int(point['Punkt_ID']))
+        return ['Praesentation/PointsOfInterest.tex'] + [f'Bilder/fotopunkt{id}.pdf' for id in sorted(ids)]
+
     @staticmethod
     def get_selection_fields(layer, fields):
         if layer.type() != QgsMapLayer.VectorLayer:
             raise RuntimeError('Kein Vektor-Layer ausgewählt.')
 
-        features = list(layer.getSelectedFeatures())
+        # only the given fields are read, the geometries select the other layers
+        features = list(layer.getSelectedFeatures(Projection(fields, geometry=True).request(layer)))
         if len(features) == 0:
             raise RuntimeError('Keine Polygone im aktiven Layer ausgewählt.')
 
@@ -1116,7 +3931,16 @@ class GeneratePresentation:
         return features
 
     def write_metadata(data):
-        with open(osp.join(data.destination, "Praesentation", "Commands.tex"), "a") as f:
+        path = osp.join(data.destination, "Praesentation", "Commands.tex")
+        # in incremental mode, the file may still hold the metadata of an earlier run
+        with open(path) as f:
+            content = f.read()
+        start = content.find('\n\n% Ort\n')
+        if start > -1:
+            with open(path, "w") as f:
+                f.write(content[:start])
+
+        with open(path, "a") as f:
             f.write('\n\n% Ort\n\\newcommand{\\Ort}{' + data.ort + '}\n')
             f.write('\n% Landkreis\n\\newcommand{\\Kreis}{' + data.kreis + '}\n')
             f.write('\n% Bundesland\n\\newcommand{\\Land}{' + data.land + '}\n')
@@ -1127,48 +3951,100 @@ class GeneratePresentation:
         pass
 
     def evaluate_trenches(self, *args):
-        q = TaskQueue()
+        q = TaskQueue(
+            parallel=True, history=self.runtime_history(), manifest=Manifest(), profiler=TaskProfiler(self.profile_tasks)
+        )
         q.on_task_complete = self.print_progress
         q.on_error = self.print_error
 
-        q.add_async_task(self.show_trenches_dialog, name='Show trenches dialog')
+        layers = ['poi', 'addresses', 'trenches', 'polygons', 'background']
+        q.add_async_task(
+            self.show_trenches_dialog, name='Show trenches dialog',
+            produces=['extent', 'destination', 'selection', 'ort', 'kreis', 'land', 'datum', 'kunde'] + layers
+        )
 
         def copy_template(data):
-            Table.offset = 0
             #self.init_progress_bar(100)
             #data.poi = GeneratePresentation.features_within_polygons(data.poi, data.selection)
             #data.addresses = GeneratePresentation.features_within_polygons(data.addresses, data.selection)
             #data.trenches = GeneratePresentation.features_within_polygons(data.trenches, data.selection)
-            data.polygons = GeneratePresentation.features_within_polygons(data.polygons, data.selection)
+            data.polygons = GeneratePresentation.features_within_polygons(
+                data.polygons, data.selection, GeneratePresentation.projection('polygons')
+            )
+            data.measures = MeasureCache(osp.join(GeneratePresentation.cache_directory(), 'measures'))
+            data.backend = data.statistics_backend
+            data.renderer = MapRenderer(self.image_width, self.image_height, self.render_cache(q.manifest.fingerprints))
 
             data.points_of_interest = list(data.poi.getFeatures())
             q.update_effort(poi_task, 1 + len(data.points_of_interest))
+            poi_task.produces = GeneratePresentation.points_of_interest_outputs(data.points_of_interest)
             data.maps_dir = osp.join(data.destination, "Karten")
 
             self.destination_directory = data.destination
-            self.copy_template("common", data.destination)
-            self.copy_template("address_and_trenches", data.destination)
-
-        q.add_task(copy_template, name='Copy template')
-        q.add_task(GeneratePresentation.write_metadata, name='Write metadata')
-        q.add_task(GeneratePresentation.calculate_address_statistics, name='Calculate address statistics')
-        q.add_task(GeneratePresentation.calculate_trench_lengths, name='Calculate trench lengths')
+            self.export_processes = data.export_processes
+            self.statistics_backend = data.statistics_backend
+            # outputs of earlier runs are either up to date or created again
+            keep = q.manifest.existing_outputs(data) if data.incremental else []
+            self.copy_template("common", data.destination, keep)
+            self.copy_template("address_and_trenches", data.destination, keep)
+
+        q.add_task(
+            copy_template, name='Copy template',
+            needs=['destination', 'selection', 'polygons', 'poi'],
+            produces=['template', 'polygons', 'measures', 'backend', 'renderer', 'points_of_interest', 'maps_dir']
+        )
+        q.add_task(
+            GeneratePresentation.write_metadata, name='Write metadata',
+            needs=['template', 'ort', 'kreis', 'land', 'datum', 'kunde'],
+            produces=['Praesentation/Commands.tex']
+        )
+        q.add_task(
+            GeneratePresentation.calculate_address_statistics, name='Calculate address statistics',
+            background=True,
+            needs=['template', 'addresses'],
+            produces=['Praesentation/AdressStatistik.tex', 'Adressauswertung.xlsx']
+        )
+        q.add_task(
+            GeneratePresentation.calculate_trench_lengths, name='Calculate trench lengths',
+            background=True,
+            needs=['template', 'trenches', 'measures', 'backend'],
+            produces=['Praesentation/TrenchStatistik.tex', 'Trenches.xlsx']
+        )
 
-        poi_task = q.add_task(
-            lambda data: self.process_points_of_interest(data, [data.addresses, data.trenches, data.background]),
-            name='Process points of interest'
+        poi_task = q.add_async_task(
+            lambda data, resolve, reject: self.process_points_of_interest(
+                data, [data.addresses, data.trenches, data.background], resolve, reject,
+                lambda fraction: q.report(poi_task, fraction), lambda: q.release(poi_task),
+                lambda cancel: q.cancel_on_abort(poi_task, cancel)
+            ),
+            name='Process points of interest',
+            needs=['template', 'points_of_interest', 'extent', 'addresses', 'trenches', 'background', 'renderer'],
+            # the maps of the Fotopunkte are added once they are known
+            produces=['Praesentation/PointsOfInterest.tex']
         )
+        # no user interaction, so the runtime is worth recording
+        poi_task.measured = True
+
+        map_inputs = ['template', 'maps_dir', 'extent', 'polygons', 'background', 'renderer']
 
         def make_title_pic(data):
             titlepic_path = osp.join(data.destination, "Bilder", "titelbild.pdf")
             layers = [data.poi, data.addresses, data.polygons, data.background]
-            self.make_pic_pdf(layers, titlepic_path, data.extent)
-        q.add_task(make_title_pic, name='Make title pic')
+            self.make_pic_pdf(layers, titlepic_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_title_pic, name='Make title pic',
+            needs=['template', 'extent', 'poi', 'addresses', 'polygons', 'background', 'renderer'],
+            produces=['Bilder/titelbild.pdf']
+        )
 
         def make_address_map(data):
             address_check_path = osp.join(data.maps_dir, "adresscheck.pdf")
-            self.make_pic_pdf([data.addresses, data.polygons, data.background], address_check_path, data.extent)
-        q.add_task(make_address_map, name='Print address map')
+            layers = [data.addresses, data.polygons, data.background]
+            self.make_pic_pdf(layers, address_check_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_address_map, name='Print address map',
+            needs=map_inputs + ['addresses'], produces=['Karten/adresscheck.pdf']
+        )
 
         def make_hp_distribution(data):
             hp_distribution_path = osp.join(data.maps_dir, "hp-verteilung.pdf")
@@ -1180,14 +4056,22 @@ class GeneratePresentation:
                 ('"Total DNP" > 2 and "Total DNP" <= 12', color2, color2.darker(), 0.3),
                 ('"Total DNP" <= 2 and "Total DNP" is not null', color3, color3.darker(), 0.3)
             ])
-            self.make_pic_pdf([hp_distribution, data.polygons, data.background], hp_distribution_path, data.extent)
+            layers = [hp_distribution, data.polygons, data.background]
+            self.make_pic_pdf(layers, hp_distribution_path, data.extent, renderer=data.renderer)
             self.increment_progess()
-        q.add_task(make_hp_distribution, name='Print HP distribution')
+        q.add_task(
+            make_hp_distribution, name='Print HP distribution',
+            needs=map_inputs + ['addresses'], produces=['Karten/hp-verteilung.pdf']
+        )
 
         def make_trenches_map(data):
             trenches_path = osp.join(data.maps_dir, "trenches.pdf")
-            self.make_pic_pdf([data.trenches, data.polygons, data.background], trenches_path, data.extent)
-        q.add_task(make_trenches_map, name='Print trenches map')
+            layers = [data.trenches, data.polygons, data.background]
+            self.make_pic_pdf(layers, trenches_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_trenches_map, name='Print trenches map',
+            needs=map_inputs + ['trenches'], produces=['Karten/trenches.pdf']
+        )
 
         def make_trench_detail_maps(data):
             maps_dir = data.maps_dir
@@ -1196,32 +4080,61 @@ class GeneratePresentation:
                 ('"Handschachtung" = false', QColor('black'), None, 0.3),
                 ('"Handschachtung" = true', QColor('#54b04a'), None, 0.7)
             ])
-            self.make_pic_pdf([by_hands, data.polygons, data.background], by_hands_path, data.extent)
+            layers = [by_hands, data.polygons, data.background]
+            self.make_pic_pdf(layers, by_hands_path, data.extent, renderer=data.renderer)
 
             by_streets_path = osp.join(maps_dir, "trenches-strassenkoerper.pdf")
             by_streets = GeneratePresentation.style_layer(data.trenches, [
                 ('"In_Strasse" = false', QColor('black'), None, 0.3),
                 ('"In_Strasse" = true', QColor('#db1e2a'), None, 0.7)
             ])
-            self.make_pic_pdf([by_streets, data.polygons, data.background], by_streets_path, data.extent)
+            layers = [by_streets, data.polygons, data.background]
+            self.make_pic_pdf(layers, by_streets_path, data.extent, renderer=data.renderer)
 
             by_private_path = osp.join(maps_dir, "trenches-privatweg.pdf")
             by_private = GeneratePresentation.style_layer(data.trenches, [
                 ('"Privatweg" = false', QColor('black'), None, 0.3),
                 ('"Privatweg" = true', QColor('#487bb6'), None, 0.7)
             ])
-            self.make_pic_pdf([by_private, data.polygons, data.background], by_private_path, data.extent)
-        q.add_task(make_trench_detail_maps, name='Print trenches maps')
+            layers = [by_private, data.polygons, data.background]
+            self.make_pic_pdf(layers, by_private_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_trench_detail_maps, name='Print trenches maps',
+            needs=map_inputs + ['trenches'],
+            produces=[
+                'Karten/trenches-handschachtung.pdf',
+                'Karten/trenches-strassenkoerper.pdf',
+                'Karten/trenches-privatweg.pdf'
+            ]
+        )
+
+        # runs after all tasks above
+        compile_task = q.add_async_task(
+            lambda data, resolve, reject: self.compile_presentation(
+                data, resolve, reject, lambda fraction: q.report(compile_task, fraction),
+                lambda cancel: q.cancel_on_abort(compile_task, cancel)
+            ),
+            name='Compile presentation'
+        )
+        compile_task.measured = True
 
         q.add_task(self.show_success, name='Show success')
 
         q.start()
+        return q
 
     def show_trenches_dialog(self, data, resolve, reject):
         self.iface.messageBar().clearWidgets()
-        osm = GeneratePresentation.require_layer_gracious('OpenStreetMap')
-
         layer = self.iface.activeLayer()
+        self.dialog = EvaluationDialog(resolve, data, *self.trenches_form(data, layer))
+
+    '''
+    Prepare the data of the trenches evaluation for the polygons selected in
+    the given layer. Returns the text and layer fields the user is asked for
+    (see EvaluationDialog).
+    '''
+    def trenches_form(self, data, layer):
+        osm = GeneratePresentation.require_layer_gracious('OpenStreetMap')
         selection = GeneratePresentation.get_selection_fields(layer, ['Name DNP', 'Kreis', 'Bundesland'])
 
         ort = selection[0]["Name DNP"]
@@ -1234,29 +4147,42 @@ class GeneratePresentation:
         data.selection = sorted(selection, key=lambda p: p['Name DNP'])
         data.title = 'Adressen und Trenches auswerten'
 
-        self.dialog = EvaluationDialog(
-            resolve,
-            data,
+        return (
             {
                 'ort': { 'label': 'Ort:', 'value': ort },
                 'kreis': { 'label': 'Kreis:', 'value': kreis },
                 'land': { 'label': 'Bundesland:', 'value': land },
                 'datum': { 'label': 'Abgabedatum:', 'value': datum },
                 'kunde': { 'label': 'Kunde:', 'value': '' },
+                'incremental': { 'label': 'Nur Geändertes neu erstellen:', 'value': False },
+                'compile': { 'label': 'PDF erstellen:', 'value': False },
+                'export_processes': { 'label': 'Prozesse für Fotopunkt-Karten:', 'value': self.export_processes, 'minimum': 1 },
+                'statistics_backend': {
+                    'label': 'Statistik berechnen mit:',
+                    'value': self.statistics_backend,
+                    'choices': GeneratePresentation.STATISTICS_BACKENDS
+                },
             },
             {
-                'poi': { 'label': 'Fotopunkt:', 'required': ['Punkt_ID'], 'select_features': True },
+                'poi': {
+                    'label': 'Fotopunkt:',
+                    'required': ['Punkt_ID'],
+                    'select_features': True,
+                    'projection': GeneratePresentation.projection('poi')
+                },
                 'addresses': {
                     'label': 'Adressen:',
                     'required': ['Total Kunde', 'Total DNP'],
                     'renderer': 'categorizedSymbol',
-                    'select_features': True
+                    'select_features': True,
+                    'projection': GeneratePresentation.projection('addresses')
                 },
                 'trenches': {
                     'label': 'Trenches:',
                     'required': ['Belag', 'In_Strasse', 'Handschachtung', 'Privatweg', 'Verfahren'],
                     'renderer': 'RuleRenderer',
-                    'select_features': True
+                    'select_features': True,
+                    'projection': GeneratePresentation.projection('trenches')
                 },
                 'polygons': { 'label': 'Polygone:', 'required': ['Name DNP', 'Kreis', 'Bundesland'] },
                 'background': { 'label': 'Hintergrund:', 'default': osm },
@@ -1272,27 +4198,16 @@ class GeneratePresentation:
 
     @staticmethod
     def export_layer(layer, name, path, mode='w'):
-        context = QgsProject.instance().transformContext()
-        options = QgsVectorFileWriter.SaveVectorOptions()
-
-        if mode == 'a':
-            # do not overwrite the file but append to it
-            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
-
-        options.layerName = name
-        options.fileEncoding = layer.dataProvider().encoding()
-        options.driverName = "GPKG"
-        QgsVectorFileWriter.writeAsVectorFormatV3(layer, path, context, options)
-        doc = QDomDocument();
-        readWriteContext = context = QgsReadWriteContext()
-        layer.exportNamedStyle(doc);
-        gpkg_layer = QgsVectorLayer(f"{path}|layername={name}", name, "ogr")
-        gpkg_layer.importNamedStyle(doc)
-        gpkg_layer.saveStyleToDatabase(name, "", True, "")
+        writer = GeoPackageWriter(path, append=(mode == 'a'))
+        writer.add(layer, name)
+        writer.close()
 
     def export_surfaces_gpkg(self, data):
+        # the rules and attributes of the surfaces are changed below
+        data.surfaces = GeneratePresentation.editable_copy(data.surfaces)
         path = osp.join(data.destination, data.ort + '_Oberflächenanalyse_vorschlag.gpkg')
-        GeneratePresentation.export_layer(data.poi, 'Fotopunkt', path)
+        writer = GeoPackageWriter(path)
+        writer.add(data.poi, 'Fotopunkt')
 
         # before exporting the surfaces, remove the "noch zu klassifizieren" rule:
         renderer = data.surfaces.renderer()
@@ -1302,12 +4217,17 @@ class GeneratePresentation:
                 root.removeChild(rule)
 
         GeneratePresentation.remove_layer_attributes(data.surfaces, ['Typ', 'Area', 'Polygon'])
-        GeneratePresentation.export_layer(data.surfaces, 'Oberflächen', path, 'a')
+        writer.add(data.surfaces, 'Oberflächen')
+        writer.close()
 
     def export_trenches(self, data):
         path = osp.join(data.destination, data.ort + '_vorschlag.gpkg')
-        GeneratePresentation.export_layer(data.poi, 'Fotopunkt', path)
+        writer = GeoPackageWriter(path)
+        writer.add(data.poi, 'Fotopunkt')
 
+        # the categories, rules and attributes are changed below
+        data.addresses = GeneratePresentation.editable_copy(data.addresses)
+        data.trenches = GeneratePresentation.editable_copy(data.trenches)
         renderer = data.addresses.renderer()
         for category in renderer.categories():
             if 'Prüfung ausstehend' in category.label():
@@ -1316,32 +4236,33 @@ class GeneratePresentation:
                     renderer.deleteCategory(index)
         GeneratePresentation.remove_layer_attributes(data.addresses, ['Polygon ID', 'Nicht sichtbar'])
         # TODO: There's more to clean up
-        GeneratePresentation.export_layer(data.addresses, 'Adressen', path, 'a')
+        writer.add(data.addresses, 'Adressen')
 
         renderer = data.trenches.renderer()
         root = renderer.rootRule()
         for rule in root.children():
             if rule.label() == 'Nicht klassifiziert':
                 root.removeChild(rule)
-        GeneratePresentation.export_layer(data.trenches, 'Trenches', path, 'a')
+        writer.add(data.trenches, 'Trenches')
+        writer.close()
 
 
-    def rename_files(data):
+    def format_date(data):
         month_names = 'Januar,Februar,März,April,Mai,Juni,Juli,August,September,Oktober,November,Dezember'.split(',')
         date = data.datum
-        date_string = date.toString('yyMMdd')
-        for folder, subfolders, files in os.walk(data.destination):
-            for file in files:
-                old = osp.join(data.destination, folder, file)
-                new = osp.join(data.destination, folder, file.replace('OOO', data.ort).replace('YYMMDD', date_string))
-                os.replace(old, new)
         data.datum = '{}.~{}~{}'.format(date.day(), month_names[date.month() - 1], date.year())
 
     def show_surfaces_dialog(self, data, resolve, reject):
         self.iface.messageBar().clearWidgets()
-        osm = GeneratePresentation.require_layer_gracious('OpenStreetMap')
-
         layer = self.iface.activeLayer()
+        self.dialog = EvaluationDialog(resolve, data, *self.surfaces_form(data, layer))
+
+    '''
+    Prepare the data of the surface evaluation for the polygons selected in
+    the given layer, see trenches_form.
+    '''
+    def surfaces_form(self, data, layer):
+        osm = GeneratePresentation.require_layer_gracious('OpenStreetMap')
         selection = GeneratePresentation.get_selection_fields(layer, ['Name DNP', 'Kreis', 'Bundesland', 'Strassenmeter'])
 
         ort = selection[0]["Name DNP"]
@@ -1354,16 +4275,30 @@ class GeneratePresentation:
         data.selection = sorted(selection, key=lambda p: p['Name DNP'])
         data.title = 'Oberflächenanalyse auswerten'
 
-        self.dialog = EvaluationDialog(
-            resolve,
-            data,
-            { 'number_special': { 'label': 'Anzahl Sonderquerungen:', 'value': '0' } },
+        return (
+            {
+                'number_special': { 'label': 'Anzahl Sonderquerungen:', 'value': '0' },
+                'incremental': { 'label': 'Nur Geändertes neu erstellen:', 'value': False },
+                'compile': { 'label': 'PDF erstellen:', 'value': False },
+                'export_processes': { 'label': 'Prozesse für Fotopunkt-Karten:', 'value': self.export_processes, 'minimum': 1 },
+                'statistics_backend': {
+                    'label': 'Statistik berechnen mit:',
+                    'value': self.statistics_backend,
+                    'choices': GeneratePresentation.STATISTICS_BACKENDS
+                },
+            },
             {
-                'poi': { 'label': 'Fotopunkt:', 'required': ['Punkt_ID'], 'select_features': True },
+                'poi': {
+                    'label': 'Fotopunkt:',
+                    'required': ['Punkt_ID'],
+                    'select_features': True,
+                    'projection': GeneratePresentation.projection('poi')
+                },
                 'surfaces': {
                     'label': 'Oberflächenanalyse:',
                     'required': ['Belag', 'Typ'],
-                    'select_features': True
+                    'select_features': True,
+                    'projection': GeneratePresentation.projection('surfaces')
                 },
                 'polygons': { 'label': 'Polygone:', 'required': ['Name DNP', 'Kreis', 'Bundesland', 'Strassenmeter'] },
                 'background': { 'label': 'Hintergrund:', 'default': osm },
@@ -1375,6 +4310,9 @@ class GeneratePresentation:
         layer = data.surfaces
         area_to_length = '$area / (CASE WHEN "Typ" = \'b\' THEN 1.281 ELSE 5.787 END)'
 
+        # all surface types are registered first and summed up in a single pass
+        aggregation = Aggregation.create(layer, data.measures, data.backend)
+
         class CategoryGroup:
             surface_types = []
 
@@ -1382,6 +4320,7 @@ class GeneratePresentation:
                 self.table = Table()
                 self.total_meters = 0
                 self.total_numbers = 0
+                self.buckets = []
 
                 self.table.add_row(
                     [title, ('Länge', ''), ('Anteil', '')],
@@ -1389,18 +4328,27 @@ class GeneratePresentation:
                 )
 
             def add_surface_type(self, condition, label, color):
-                meters = GeneratePresentation.filtered_column_sum(layer, condition, area_to_length)
-                meters = math.ceil(meters)
-                self.total_meters += meters
+                self.buckets.append((len(self.table), aggregation.add(condition, area_to_length)))
 
                 color = color.lighter() # create a pseudo-transparency effect
-                self.table.add_row([label, meters, None], color)
+                self.table.add_row([label, None, None], color)
                 CategoryGroup.surface_types.append((label, color))
 
+            '''
+            Fill in the lengths of the surface types once the aggregation has run.
+            '''
+            def resolve(self):
+                for (i, bucket) in self.buckets:
+                    meters = math.ceil(bucket.value)
+                    self.total_meters += meters
+                    self.table.set_value(i, 1, meters)
+                self.buckets = []
+
             def add_total(self, label='Gesamt'):
+                self.resolve()
                 if self.total_meters > 0:
-                    for row in self.table.rows[1:]:
-                        row[2] = round(row[1] * 100 / self.total_meters)
+                    for i in range(1, len(self.table)):
+                        self.table.set_value(i, 2, round(self.table.value(i, 1) * 100 / self.total_meters))
 
                 self.table.add_row(
                     [label, self.total_meters, 100],
@@ -1409,15 +4357,12 @@ class GeneratePresentation:
                 return self.total_meters
 
             def cleanup(self):
-                for row in self.table.rows:
-                    if isinstance(row[1], int) or isinstance(row[1], float):
-                        row[1] = (row[1], 'm')
-                    if isinstance(row[2], int) or isinstance(row[2], float):
-                        row[2] = (row[2], '%')
+                self.table.numbers_to_unit('m', 1)
+                self.table.numbers_to_unit('%', 2)
 
-            def to_latex(self):
+            def to_latex(self, f=None):
                 colspec = 'l@{}X[l]rr'
-                return self.table.to_latex(colspec, 'colorsquare')
+                return self.table.to_latex(colspec, 'colorsquare', f)
 
         sidewalk = CategoryGroup('Oberflächen Bürgersteig')
         sidewalk.add_surface_type('"Belag" = \'a\' OR ("Belag" = \'sa\' AND "Typ" = \'b\')', 'Asphalt', QColor('#fa182a'))
@@ -1427,8 +4372,6 @@ class GeneratePresentation:
         sidewalk.add_surface_type('"Belag" = \'v\' OR ("Belag" = \'sv\' AND "Typ" = \'b\')', 'Verdichtet/Schotter', QColor('#066c06'))
         sidewalk.add_surface_type('"Belag" = \'m\' OR ("Belag" = \'sm\' AND "Typ" = \'b\')', 'Kopfsteinpflaster', QColor('#ff7f00'))
         sidewalk.add_surface_type('"Belag" = \'n\' OR ("Belag" = \'sn\' AND "Typ" = \'b\')', 'kein Bürgersteig', QColor('#959595'))
-        sidewalk_total = sidewalk.add_total()
-        sidewalk.cleanup()
 
         street = CategoryGroup('Oberflächen Straße')
         street.add_surface_type('"Belag" = \'sa\' AND "Typ" = \'s\'', 'Asphaltierte Straße', QColor('#ebd407'))
@@ -1436,23 +4379,33 @@ class GeneratePresentation:
         street.add_surface_type('"Belag" = \'st\' AND "Typ" = \'s\'', 'Gepflasterte Straße', QColor('#2fffee'))
         street.add_surface_type('"Belag" = \'sg\' AND "Typ" = \'s\'', 'Unbefestigte Straße', QColor('#becf50'))
         street.add_surface_type('"Belag" = \'sm\' AND "Typ" = \'s\'', 'Straße mit Kopfsteinpflaster', QColor('#87650f'))
+
+        handschachtung = aggregation.add('"Handschachtung"', area_to_length)
+        traglast = aggregation.add('"Typ" = \'b\' AND "Belag" LIKE \'s%\'', area_to_length)
+
+        special_crossing = CategoryGroup(f'Sonderquerungen ({data.number_special} St.)')
+        special_crossing.add_surface_type('"Belag" = \'x\' OR ("Belag" = \'sx\' AND "Typ" = \'b\')', 'Sonderquerung Bürgersteig', QColor('#9a50cf'))
+        special_crossing.add_surface_type('"Belag" = \'sx\' AND "Typ" = \'s\'', 'Sonderquerung Straße', QColor('#8300d4'))
+
+        aggregation.run()
+        if data.measures:
+            data.measures.save()
+
+        sidewalk_total = sidewalk.add_total()
+        sidewalk.cleanup()
+
         street_total = street.add_total()
         polygons_total = round(sum([f['Strassenmeter'] for f in data.selection]))
         street.table.add_row(['nicht BIS-geeignet', polygons_total - street_total, None], ('$\\times$', '✖'))
         street.cleanup()
 
         special = CategoryGroup('Sonderpositionen')
-        handschachtung = GeneratePresentation.filtered_column_sum(
-                layer, '"Handschachtung"', area_to_length)
-        special.table.add_row(['Handschachtung', round(handschachtung), None], ('\\hatchedsquare', '▨'))
-        traglast = GeneratePresentation.filtered_column_sum(
-                layer, '"Typ" = \'b\' AND "Belag" LIKE \'s%\'', area_to_length)
-        special.table.add_row(['Bürgersteig mit besonderer Traglastanforderung', round(traglast), None])
+        special.table.add_row(['Handschachtung', round(handschachtung.value), None], ('\\hatchedsquare', '▨'))
+        special.table.add_row(['Bürgersteig mit besonderer Traglastanforderung', round(traglast.value), None])
         special.cleanup()
 
-        special_crossing = CategoryGroup(f'Sonderquerungen ({data.number_special} St.)')
-        special_crossing.add_surface_type('"Belag" = \'x\' OR ("Belag" = \'sx\' AND "Typ" = \'b\')', 'Sonderquerung Bürgersteig', QColor('#9a50cf'))
-        special_crossing.add_surface_type('"Belag" = \'sx\' AND "Typ" = \'s\'', 'Sonderquerung Straße', QColor('#8300d4'))
+        # the special crossings have no total, their lengths are filled in here
+        special_crossing.resolve()
         special_crossing.cleanup()
 
         summary = CategoryGroup('Gesamtoberfläche')
@@ -1469,19 +4422,19 @@ class GeneratePresentation:
             f.write('\\item[\\hatchedsquare] Handschachtung \n')
             f.write('}\n')
 
-            f.write('\\renewcommand\\oberflaechenBuergersteig{' + sidewalk.to_latex() + '}\n')
-            f.write('\\renewcommand\\oberflaechenStrasse{' + street.to_latex() + '}\n')
-            f.write('\\renewcommand\\oberflaechenSonderposition{' + special.to_latex() + '}\n')
-            f.write('\\renewcommand\\oberflaechenSonderquerung{' + special_crossing.to_latex() + '}\n')
-            f.write('\\renewcommand\\oberflaechenGesamt{' + summary.to_latex() + '}\n')
+            tables = [
+                ('oberflaechenBuergersteig', sidewalk),
+                ('oberflaechenStrasse', street),
+                ('oberflaechenSonderposition', special),
+                ('oberflaechenSonderquerung', special_crossing),
+                ('oberflaechenGesamt', summary),
+            ]
+            for (command, group) in tables:
+                f.write('\\renewcommand\\' + command + '{')
+                group.to_latex(f)
+                f.write('}\n')
 
-        Table.offset = 0
-        path = glob.glob(data.destination + '\\*Oberflächenanalyse.xlsx')
-        if len(path) == 0:
-            path = osp.join(data.destination, "Oberflächenanalyse.xlsx")
-        else:
-            path = path[0]
-        workbook = xlsxwriter.Workbook(path)
+        workbook = xlsxwriter.Workbook(osp.join(data.destination, data.surface_workbook))
         worksheet = workbook.add_worksheet()
         sidewalk.table.to_xlsx(workbook, [2, 50, 10, 2, 10, 2, 10], worksheet=worksheet)
         street.table.to_xlsx(workbook, worksheet=worksheet)
@@ -1490,44 +4443,62 @@ class GeneratePresentation:
         summary.table.to_xlsx(workbook, worksheet=worksheet)
         workbook.close()
 
+    '''
+    Name of the workbook of the surface statistics relative to the destination:
+    the <Ort>_Oberflächenanalyse.xlsx deployed by the template, or a new one
+    named after the first selected polygon.
+    '''
+    @staticmethod
+    def surface_workbook(data):
+        paths = sorted(glob.glob(osp.join(glob.escape(data.destination), '*Oberflächenanalyse.xlsx')))
+        if len(paths) > 0:
+            return osp.basename(paths[0])
+        return data.selection[0]['Name DNP'] + '_Oberflächenanalyse.xlsx'
+
+    def show_template_surfaces_dialog(self, data, resolve, reject):
+        layer = self.iface.activeLayer()
+        self.dialog = EvaluationDialog(resolve, data, *self.template_surfaces_form(data, layer))
+
+    '''
+    Prepare the data of the surface template for the polygons selected in the
+    given layer, see trenches_form.
+    '''
+    def template_surfaces_form(self, data, layer):
+        selection = GeneratePresentation.get_selection_fields(layer, ['Name DNP', 'Kreis', 'Bundesland', 'Strassenmeter'])
+        data.selection = sorted(selection, key=lambda p: p['Name DNP'])
+        feature = data.selection[0]
+        ort = feature["Name DNP"]
+        kreis = feature["Kreis"]
+        land = feature["Bundesland"]
+        data.destination = self.destination_directory
+        data.title = 'Template für Oberflaechenanalyse erstellen'
+
+        return (
+            {
+                'ort': { 'label': 'Ort:', 'value': ort },
+                'kreis': { 'label': 'Kreis:', 'value': kreis },
+                'land': { 'label': 'Bundesland:', 'value': land },
+                'datum': { 'label': 'Abgabedatum:', 'value': QDate(1900, 1, 1) },
+                'kunde': { 'label': 'Kunde:', 'value': '' },
+            },
+            {}
+        )
+
     def template_surfaces(self, *args):
-        q = TaskQueue()
+        q = TaskQueue(profiler=TaskProfiler(self.profile_tasks))
         q.on_task_complete = self.print_progress
         q.on_error = self.print_error
 
-        def show_dialog(data, resolve, reject):
-            layer = self.iface.activeLayer()
-            selection = GeneratePresentation.get_selection_fields(layer, ['Name DNP', 'Kreis', 'Bundesland', 'Strassenmeter'])
-            data.selection = sorted(selection, key=lambda p: p['Name DNP'])
-            feature = data.selection[0]
-            ort = feature["Name DNP"]
-            kreis = feature["Kreis"]
-            land = feature["Bundesland"]
-            datum = datetime.today().strftime('%d.%m.%Y')
-            data.destination = self.destination_directory
-            data.title = 'Template für Oberflaechenanalyse erstellen'
-
-            self.dialog = EvaluationDialog(
-                resolve,
-                data,
-                {
-                    'ort': { 'label': 'Ort:', 'value': ort },
-                    'kreis': { 'label': 'Kreis:', 'value': kreis },
-                    'land': { 'label': 'Bundesland:', 'value': land },
-                    'datum': { 'label': 'Abgabedatum:', 'value': QDate(1900, 1, 1) },
-                    'kunde': { 'label': 'Kunde:', 'value': '' },
-                },
-                {}
-            )
-        q.add_async_task(show_dialog, name='Show dialog')
+        q.add_async_task(self.show_template_surfaces_dialog, name='Show dialog')
 
         def copy_template(data):
             self.destination_directory = data.destination
-            self.copy_template("common", data.destination)
-            self.copy_template("surface_classification", data.destination)
+            renames = { 'OOO': data.ort, 'YYMMDD': data.datum.toString('yyMMdd') }
+            self.copy_template("common", data.destination, renames=renames)
+            self.copy_template("surface_classification", data.destination, renames=renames)
         q.add_task(copy_template, name='Copy template')
 
-        q.add_task(GeneratePresentation.rename_files, name='Rename file')
+        q.add_task(GeneratePresentation.format_date, name='Format date')
         q.add_task(GeneratePresentation.write_metadata, name='Write metadata')
 
         def write_polygons(data):
@@ -1535,13 +4506,20 @@ class GeneratePresentation:
                 meters = format_number_latex(round(poly['Strassenmeter']))
                 return '   \\item[$\\bullet$] \\Ort{} -- ' + poly['Name DNP'] + ': ' + meters + '~m\n'
 
+            '''
+            Write the polygons with index start to end (exclusive) directly to
+            the file, without copying the page out of the selection.
+            '''
+            def write_page(f, start, end):
+                for i in range(start, min(end, len(polys))):
+                    f.write(poly_to_string(polys[i]))
+
             polys = data.selection
-            polygons_total = round(sum([f['Strassenmeter'] for f in polys]))
+            polygons_total = round(sum(f['Strassenmeter'] for f in polys))
 
             polys_first_page = 9
             polys_per_page = 13
             num_pages = 1 + math.ceil((len(polys) - polys_first_page) / polys_per_page)
-            pages = [polys[0:polys_first_page]] + [polys[polys_first_page+i*polys_per_page : polys_first_page+(i+1)*polys_per_page] for i in range(num_pages-1)]
 
             with open(osp.join(data.destination, "Praesentation", "OberflaechenStatistik.tex"), "a") as f:
                 per_meter = 0.21
@@ -1568,58 +4546,112 @@ class GeneratePresentation:
                     f.write('\\item Analysierte Polygone: {}~St.\n'.format(len(polys)))
 
                 f.write('\\begin{itemize}\n')
-                for poly in pages[0]:
-                    f.write(poly_to_string(poly))
+                write_page(f, 0, polys_first_page)
                 f.write('\\end{itemize}\n')
                 f.write('}\n')
 
                 f.write('\n\\newcommand\\weiterepolygone{')
-                for i, page in enumerate(pages[1:]):
+                for i in range(num_pages - 1):
+                    start = polys_first_page + i * polys_per_page
                     f.write('\\begin{frame}{\\Ort: Preise}\\begin{itemize}')
                     f.write('\\item Analysierte Polygone: {}~St. (Seite {} von {})\n'.format(len(polys), i+2, num_pages))
                     f.write('\\begin{itemize}\n')
-                    for poly in page:
-                        f.write(poly_to_string(poly))
+                    write_page(f, start, start + polys_per_page)
                     f.write('\\end{itemize}\\end{itemize}\\end{frame}\n')
                 f.write('}\n')
         q.add_task(write_polygons, name='Write polygons')
 
         q.add_task(self.show_success, name='Show success')
         q.start()
+        return q
 
 
     def evaluate_surfaces(self, *args):
-        q = TaskQueue()
+        q = TaskQueue(
+            parallel=True, history=self.runtime_history(), manifest=Manifest(), profiler=TaskProfiler(self.profile_tasks)
+        )
         q.on_task_complete = self.print_progress
         q.on_error = self.print_error
 
-        q.add_async_task(self.show_surfaces_dialog, name='Show surfaces dialog')
+        q.add_async_task(
+            self.show_surfaces_dialog, name='Show surfaces dialog',
+            produces=['extent', 'destination', 'selection', 'number_special', 'poi', 'surfaces', 'polygons', 'background']
+        )
 
         def init(data):
-            data.polygons = GeneratePresentation.features_within_polygons(data.polygons, data.selection)
+            data.polygons = GeneratePresentation.features_within_polygons(
+                data.polygons, data.selection, GeneratePresentation.projection('polygons')
+            )
+            data.measures = MeasureCache(osp.join(GeneratePresentation.cache_directory(), 'measures'))
+            data.backend = data.statistics_backend
+            data.renderer = MapRenderer(self.image_width, self.image_height, self.render_cache(q.manifest.fingerprints))
             data.points_of_interest = list(data.poi.getFeatures())
             q.update_effort(poi_task, 1 + len(data.points_of_interest))
+            poi_task.produces = GeneratePresentation.points_of_interest_outputs(data.points_of_interest)
+            # the workbook is named after the Ort
+            data.surface_workbook = GeneratePresentation.surface_workbook(data)
+            statistics_task.produces = ['Praesentation/OberflaechenStatistik.tex', data.surface_workbook]
             self.destination_directory = data.destination
+            self.export_processes = data.export_processes
+            self.statistics_backend = data.statistics_backend
 
-        q.add_task(init, name='Initialize')
-        q.add_task(GeneratePresentation.calculate_surface_statistics, name='Calculate surface statistics')
+        q.add_task(
+            init, name='Initialize',
+            needs=['destination', 'selection', 'polygons', 'poi'],
+            produces=['polygons', 'measures', 'backend', 'renderer', 'points_of_interest', 'surface_workbook']
+        )
+        statistics_task = q.add_task(
+            GeneratePresentation.calculate_surface_statistics, name='Calculate surface statistics',
+            background=True,
+            needs=['destination', 'selection', 'number_special', 'surfaces', 'measures', 'backend', 'surface_workbook'],
+            # the workbook is added once the Ort is known
+            produces=['Praesentation/OberflaechenStatistik.tex']
+        )
 
-        poi_task = q.add_task(
-            lambda data: self.process_points_of_interest(data, [data.surfaces, data.background]),
-            name='Process points of interest'
+        poi_task = q.add_async_task(
+            lambda data, resolve, reject: self.process_points_of_interest(
+                data, [data.surfaces, data.background], resolve, reject,
+                lambda fraction: q.report(poi_task, fraction), lambda: q.release(poi_task),
+                lambda cancel: q.cancel_on_abort(poi_task, cancel)
+            ),
+            name='Process points of interest',
+            needs=['destination', 'points_of_interest', 'extent', 'surfaces', 'background', 'renderer'],
+            # the maps of the Fotopunkte are added once they are known
+            produces=['Praesentation/PointsOfInterest.tex']
         )
+        # no user interaction, so the runtime is worth recording
+        poi_task.measured = True
 
         def make_title_pic(data):
             titlepic_path = osp.join(data.destination, "Bilder", "titelbild.pdf")
             layers = [data.poi, data.surfaces, data.polygons, data.background]
-            self.make_pic_pdf(layers, titlepic_path, data.extent)
-        q.add_task(make_title_pic, name='Make title pic')
+            self.make_pic_pdf(layers, titlepic_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_title_pic, name='Make title pic',
+            needs=['destination', 'extent', 'poi', 'surfaces', 'polygons', 'background', 'renderer'],
+            produces=['Bilder/titelbild.pdf']
+        )
 
         def make_map(data):
             map_path = osp.join(data.destination, "Karten", "karte.pdf")
             layers = [data.surfaces, data.polygons, data.background]
-            self.make_pic_pdf(layers, map_path, data.extent)
-        q.add_task(make_map, name='Print map')
+            self.make_pic_pdf(layers, map_path, data.extent, renderer=data.renderer)
+        q.add_task(
+            make_map, name='Print map',
+            needs=['destination', 'extent', 'surfaces', 'polygons', 'background', 'renderer'],
+            produces=['Karten/karte.pdf']
+        )
+
+        # runs after all tasks above
+        compile_task = q.add_async_task(
+            lambda data, resolve, reject: self.compile_presentation(
+                data, resolve, reject, lambda fraction: q.report(compile_task, fraction),
+                lambda cancel: q.cancel_on_abort(compile_task, cancel)
+            ),
+            name='Compile presentation'
+        )
+        compile_task.measured = True
 
         q.add_task(self.show_success, name='Show success')
         q.start()
+        return q
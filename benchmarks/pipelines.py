@@ -0,0 +1,415 @@
+'''
+Benchmark the trenches and surfaces evaluations end to end on synthetic layers
+with the schemas the plugin requires. Run it with the Python interpreter of
+QGIS (e.g. from the OSGeo4W shell):
+
+  python benchmarks/pipelines.py                          # scales 1 and 10
+  python benchmarks/pipelines.py --scales 1 5 20 --repeat 5
+  python benchmarks/pipelines.py --save baseline.json     # record a baseline
+  python benchmarks/pipelines.py --baseline baseline.json # compare against it
+
+At scale 1, the evaluated polygon holds about SIZES features of every layer
+and a neighbouring polygon as many again. The layers are generated from a
+fixed seed into a GeoPackage, so every run evaluates the same data, and each
+pipeline runs headless through cli.py, with empty caches (see --warm). The
+runtime of every step is taken from the timing report of the TaskQueue (see
+TaskProfiler) and the median of --repeat runs is reported.
+
+With --incremental, every pipeline additionally runs twice incrementally
+into the same destination. The second run must skip every step with output
+files, as nothing changed in between; a step that runs again (e.g. because an
+output it declares is never written) fails the script.
+
+With --baseline, a step is a regression if its median exceeds the one in the
+baseline by more than --tolerance and MIN_DIFFERENCE seconds, and the script
+fails. Baselines depend on the machine, so record them where they are
+compared.
+'''
+import os, sys, json, time, random, shutil, platform, argparse, tempfile, importlib.util
+from os import path as osp
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from qgis.core import *
+from qgis.PyQt.QtGui import QColor
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+VERSION = 1
+
+# features of every layer per unit of scale within the evaluated polygon
+SIZES = { 'addresses': 1000, 'trenches': 3000, 'surfaces': 3000 }
+# side of the evaluated polygon at scale 1 in meters, the density stays the same
+SIDE = 1000
+ORIGIN = (400000, 5500000)
+# differences below are noise
+MIN_DIFFERENCE = 0.1
+
+ADDRESS_CATEGORIES = [
+    ('a', '(a) Geprüft', '#54ae4a'),
+    ('b', '(b) Nachträglich aufgenommen', '#487bb6'),
+    ('c', '(c) Nicht anschließbar', '#e4bb72'),
+    ('p', '(p) Prüfung ausstehend', '#999999'),
+    ('n', '(n) Neubaugebiet', '#9a50cf'),
+    ('o', '(o) Ohne Adresse', '#cf5050'),
+]
+TRENCH_BELAG = ['a', 't', 'g', 'm', 'k', 'c', 'x']
+SURFACE_BELAG = ['a', 'b', 't', 'g', 'v', 'm', 'n', 'x', 'sa', 'sb', 'st', 'sg', 'sv', 'sm', 'sn', 'sx']
+CROSSINGS = ['Bahn', 'Bach', 'Bundesstraße']
+
+# pipeline: layers of the job (key: layer name)
+PIPELINES = {
+    'trenches': {
+        'poi': 'Fotopunkt', 'addresses': 'Adressen', 'trenches': 'Trenches',
+        'polygons': 'Polygone', 'background': 'Hintergrund',
+    },
+    'surfaces': {
+        'poi': 'Fotopunkt', 'surfaces': 'Oberflächen', 'polygons': 'Polygone', 'background': 'Hintergrund',
+    },
+}
+
+
+def load_module(name, file):
+    spec = importlib.util.spec_from_file_location(name, osp.join(ROOT, file))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def memory_layer(geometry_type, name, table):
+    (fields, rows) = table
+    layer = QgsVectorLayer(f'{geometry_type}?crs=EPSG:25832&' + '&'.join([f'field={f}' for f in fields]), name, 'memory')
+    features = []
+    for (geometry, attributes) in rows:
+        feature = QgsFeature(layer.fields())
+        feature.setGeometry(geometry)
+        feature.setAttributes(attributes)
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+'''
+Random point within the evaluated polygon and its neighbour to the east.
+'''
+def random_point(rng, side):
+    return (ORIGIN[0] + rng.random() * 2 * side, ORIGIN[1] + rng.random() * side)
+
+
+def polygon_rows(scale, side):
+    rows = []
+    for (i, name) in enumerate(['Benchmark', 'Nachbarort']):
+        x = ORIGIN[0] + i * side
+        rectangle = QgsRectangle(x, ORIGIN[1], x + side, ORIGIN[1] + side)
+        rows.append((QgsGeometry.fromRect(rectangle), [name, 'Musterkreis', 'Musterland', 10000 * scale]))
+    return (['Name DNP:string', 'Kreis:string', 'Bundesland:string', 'Strassenmeter:integer'], rows)
+
+
+def address_rows(size, side, rng):
+    rows = []
+    for i in range(size):
+        (x, y) = random_point(rng, side)
+        kunde = rng.randint(1, 20)
+        rows.append((QgsGeometry.fromPointXY(QgsPointXY(x, y)), [
+            rng.choice(ADDRESS_CATEGORIES)[0], kunde, kunde + rng.randint(-2, 2), i, rng.random() < 0.05,
+        ]))
+    fields = ['Pruefung:string', 'Total Kunde:integer', 'Total DNP:integer', 'Polygon ID:integer', 'Nicht sichtbar:boolean']
+    return (fields, rows)
+
+
+def trench_rows(size, side, rng):
+    rows = []
+    for i in range(size):
+        (x, y) = random_point(rng, side)
+        points = [QgsPointXY(x, y), QgsPointXY(x + rng.random() * 50, y + rng.random() * 50)]
+        belag = rng.choice(TRENCH_BELAG)
+        rows.append((QgsGeometry.fromPolylineXY(points), [
+            belag,
+            rng.choice(['r', 'h']) if belag == 'c' else None,
+            rng.random() < 0.5,
+            rng.random() < 0.1,
+            rng.random() < 0.2,
+            rng.choice(CROSSINGS) if rng.random() < 0.001 else None,
+        ]))
+    fields = [
+        'Belag:string', 'Verfahren:string', 'In_Strasse:boolean', 'Handschachtung:boolean',
+        'Privatweg:boolean', 'Sonderquerung:string',
+    ]
+    return (fields, rows)
+
+
+def surface_rows(size, side, rng):
+    rows = []
+    for i in range(size):
+        (x, y) = random_point(rng, side)
+        w = 1 + rng.random() * 20
+        h = 1 + rng.random() * 20
+        rows.append((QgsGeometry.fromRect(QgsRectangle(x, y, x + w, y + h)), [
+            rng.choice(SURFACE_BELAG), rng.choice(['b', 's']), rng.random() < 0.05, w * h, i,
+        ]))
+    return (['Belag:string', 'Typ:string', 'Handschachtung:boolean', 'Area:double', 'Polygon:integer'], rows)
+
+
+def poi_rows(points, side, rng):
+    rows = []
+    for i in range(points):
+        # Fotopunkte only within the evaluated polygon
+        x = ORIGIN[0] + (0.1 + rng.random() * 0.8) * side
+        y = ORIGIN[1] + (0.1 + rng.random() * 0.8) * side
+        rows.append((QgsGeometry.fromPointXY(QgsPointXY(x, y)), [i + 1]))
+    return (['Punkt_ID:integer'], rows)
+
+
+def background_rows(side):
+    rectangle = QgsRectangle(ORIGIN[0] - side, ORIGIN[1] - side, ORIGIN[0] + 3 * side, ORIGIN[1] + 2 * side)
+    return (['Name:string'], [(QgsGeometry.fromRect(rectangle), ['Hintergrund'])])
+
+
+def rule_renderer(layer, rules, geometry_type, else_label):
+    renderer = QgsRuleBasedRenderer(QgsSymbol.defaultSymbol(geometry_type))
+    root = renderer.rootRule()
+    for (belag, color) in rules:
+        symbol = QgsSymbol.defaultSymbol(geometry_type)
+        symbol.setColor(QColor(color))
+        root.appendChild(QgsRuleBasedRenderer.Rule(symbol, 0, 0, f'"Belag" = \'{belag}\'', belag))
+    root.appendChild(QgsRuleBasedRenderer.Rule(QgsSymbol.defaultSymbol(geometry_type), 0, 0, 'ELSE', else_label))
+    root.removeChildAt(0)
+    layer.setRenderer(renderer)
+
+
+def style_layers(layers):
+    categories = []
+    for (token, label, color) in ADDRESS_CATEGORIES:
+        symbol = QgsSymbol.defaultSymbol(QgsWkbTypes.PointGeometry)
+        symbol.setColor(QColor(color))
+        categories.append(QgsRendererCategory(token, symbol, label))
+    layers['Adressen'].setRenderer(QgsCategorizedSymbolRenderer('Pruefung', categories))
+
+    rng = random.Random(0)
+    color = lambda: QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)).name()
+    rule_renderer(
+        layers['Trenches'], [(belag, color()) for belag in TRENCH_BELAG],
+        QgsWkbTypes.LineGeometry, 'Nicht klassifiziert'
+    )
+    rule_renderer(
+        layers['Oberflächen'], [(belag, color()) for belag in SURFACE_BELAG],
+        QgsWkbTypes.PolygonGeometry, 'noch zu klassifizieren'
+    )
+
+
+'''
+Generate the layers of the given scale into a GeoPackage in directory and add
+them to the project.
+'''
+def create_layers(directory, scale, points, seed):
+    rng = random.Random(f'{seed}-{scale}')
+    side = SIDE * scale ** 0.5
+    # the neighbouring polygon holds as many features again
+    definitions = [
+        ('Polygone', 'Polygon', polygon_rows(scale, side)),
+        ('Adressen', 'Point', address_rows(2 * SIZES['addresses'] * scale, side, rng)),
+        ('Trenches', 'LineString', trench_rows(2 * SIZES['trenches'] * scale, side, rng)),
+        ('Oberflächen', 'Polygon', surface_rows(2 * SIZES['surfaces'] * scale, side, rng)),
+        ('Fotopunkt', 'Point', poi_rows(points, side, rng)),
+        ('Hintergrund', 'Polygon', background_rows(side)),
+    ]
+
+    path = osp.join(directory, f'benchmark-{scale}.gpkg')
+    context = QgsProject.instance().transformContext()
+    layers = {}
+    for (name, geometry_type, table) in definitions:
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = name
+        if osp.exists(path):
+            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+        result = QgsVectorFileWriter.writeAsVectorFormatV3(memory_layer(geometry_type, name, table), path, context, options)
+        if result[0] != QgsVectorFileWriter.NoError:
+            raise RuntimeError(f'Layer "{name}" could not be written: {result[1]}')
+
+        layer = QgsVectorLayer(f'{path}|layername={name}', name, 'ogr')
+        if not layer.isValid():
+            raise RuntimeError(f'Layer "{name}" could not be loaded.')
+        layers[name] = layer
+
+    style_layers(layers)
+    QgsProject.instance().addMapLayers(list(layers.values()))
+    return layers
+
+
+'''
+Run the pipeline once, returns the steps of its timing report.
+'''
+def run_pipeline(cli, plugin, pipeline, destination, args, incremental=False):
+    job = {
+        'pipeline': pipeline,
+        'polygons': 'Polygone',
+        'filter': '"Name DNP" = \'Benchmark\'',
+        'layers': PIPELINES[pipeline],
+        'metadata': { 'kunde': 'Benchmark' },
+        'destination': destination,
+        'incremental': incremental,
+    }
+    error = cli.run_pipeline(plugin, job, export_processes=args.export_processes)
+    if error:
+        raise RuntimeError(f'{pipeline}: {error}')
+
+    with open(osp.join(destination, plugin.TaskProfiler.FILENAME), encoding='utf-8') as f:
+        report = json.load(f)
+    steps = { task['name']: task for task in report['tasks'] if task['measured'] and task['status'] == 'done' }
+    steps['Total'] = { 'wall_seconds': report['wall_seconds'], 'peak_rss_mb': report['peak_rss_mb'] }
+    return steps
+
+
+'''
+Run the pipeline incrementally twice into destination, returns the steps with
+output files (those in the manifest) that the second run did not skip.
+'''
+def stale_steps(cli, plugin, pipeline, destination, args):
+    run_pipeline(cli, plugin, pipeline, destination, args, incremental=True)
+    steps = run_pipeline(cli, plugin, pipeline, destination, args, incremental=True)
+    with open(osp.join(destination, plugin.Manifest.FILENAME), encoding='utf-8') as f:
+        recorded = json.load(f)
+    return sorted([name for name in steps if name in recorded])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle - 1] + values[middle]) / 2
+
+
+def benchmark(cli, plugin, directory, args):
+    results = {}
+    stale = []
+    for scale in args.scales:
+        QgsProject.instance().removeAllMapLayers()
+        create_layers(directory, scale, args.points, args.seed)
+
+        for pipeline in args.pipelines:
+            runs = []
+            for i in range(args.repeat):
+                if not args.warm:
+                    shutil.rmtree(plugin.GeneratePresentation.cache_directory(), ignore_errors=True)
+                destination = osp.join(directory, f'{pipeline}-{scale}-{i}')
+                os.makedirs(destination)
+                runs.append(run_pipeline(cli, plugin, pipeline, destination, args))
+
+            steps = {}
+            for name in runs[0]:
+                measured = [run[name] for run in runs if name in run]
+                steps[name] = {
+                    'seconds': median([step['wall_seconds'] for step in measured]),
+                    'peak_rss_mb': max([step['peak_rss_mb'] or 0 for step in measured]),
+                }
+                if 'features' in measured[0]:
+                    steps[name]['features'] = measured[0]['features']
+            results[f'{pipeline}/{scale}'] = steps
+
+            if args.incremental:
+                destination = osp.join(directory, f'{pipeline}-{scale}-incremental')
+                os.makedirs(destination)
+                stale += [(f'{pipeline}/{scale}', name) for name in stale_steps(cli, plugin, pipeline, destination, args)]
+    return (results, stale)
+
+
+def machine():
+    return {
+        'node': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'qgis': Qgis.version(),
+        'cpus': os.cpu_count(),
+    }
+
+
+'''
+Print the results next to the baseline, returns the regressions.
+'''
+def compare(results, baseline, tolerance):
+    reference = baseline['results'] if baseline else {}
+    regressions = []
+    print(f'{"benchmark":<16} {"step":<34} {"seconds":>9} {"baseline":>9} {"change":>8}')
+    for (key, steps) in results.items():
+        for (name, step) in steps.items():
+            line = f'{key:<16} {name:<34} {step["seconds"]:>8.2f}s'
+            before = reference.get(key, {}).get(name)
+            if before:
+                change = step['seconds'] / before['seconds'] - 1 if before['seconds'] > 0 else 0
+                line += f' {before["seconds"]:>8.2f}s {change:>+7.0%}'
+                if change > tolerance and step['seconds'] - before['seconds'] > MIN_DIFFERENCE:
+                    regressions.append((key, name))
+                    line += '  regression!'
+            print(line)
+    return regressions
+
+
+def main(args):
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('version') != VERSION:
+            print(f'Baseline {args.baseline} is outdated, record it again.')
+            return 1
+        for key in ['seed', 'points', 'repeat', 'warm', 'export_processes']:
+            if baseline['parameters'].get(key) != getattr(args, key):
+                print(f'Warning: the baseline was recorded with {key}={baseline["parameters"].get(key)}.')
+        if baseline['machine'] != machine():
+            print(f'Warning: the baseline was recorded on {baseline["machine"]["node"]} ({baseline["machine"]["platform"]}).')
+
+    directory = tempfile.mkdtemp(prefix='auswertungstools-benchmark-')
+    # a profile of its own keeps the caches of the plugin apart from the user's
+    app = QgsApplication([], False, osp.join(directory, 'profile'))
+    app.initQgis()
+    project = QgsProject.instance()
+    project.setCrs(QgsCoordinateReferenceSystem('EPSG:25832'))
+    project.setEllipsoid('EPSG:7019')
+
+    cli = load_module('auswertungstools_cli', 'cli.py')
+    plugin = cli.load_plugin()
+    try:
+        start = time.perf_counter()
+        (results, stale) = benchmark(cli, plugin, directory, args)
+        print(f'benchmarked in {time.perf_counter() - start:.0f}s\n')
+    finally:
+        QgsProject.instance().removeAllMapLayers()
+        app.exitQgis()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        parameters = { key: getattr(args, key) for key in ['scales', 'pipelines', 'seed', 'points', 'repeat', 'warm', 'export_processes'] }
+        content = { 'version': VERSION, 'machine': machine(), 'parameters': parameters, 'results': results }
+        temporary = f'{args.save}.{os.getpid()}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=2, ensure_ascii=False)
+        os.replace(temporary, args.save)
+
+    for (key, name) in stale:
+        print(f'{key}: "{name}" ran again in an unchanged incremental run.')
+
+    if regressions:
+        print(f'\n{len(regressions)} regression(s) of more than {args.tolerance:.0%}.')
+        return 1
+    return 1 if stale else 0
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Benchmark the evaluations on synthetic layers.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10], help='sizes of the layers, see SIZES')
+    parser.add_argument('--pipelines', nargs='+', choices=list(PIPELINES.keys()), default=list(PIPELINES.keys()))
+    parser.add_argument('--points', type=int, default=6, help='number of Fotopunkte')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic layers')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per pipeline and scale')
+    parser.add_argument('--warm', action='store_true', help='keep the caches between the runs')
+    parser.add_argument('--incremental', action='store_true', help='check that unchanged incremental runs skip all steps')
+    parser.add_argument('--export-processes', type=int, default=1, help='processes rendering the Fotopunkt maps')
+    parser.add_argument('--baseline', help='JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--save', help='JSON file to record the results in as baseline')
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_arguments(sys.argv[1:])))
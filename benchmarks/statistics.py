@@ -0,0 +1,164 @@
+'''
+Benchmark the expression-based and the NumPy statistics backend against each
+other on synthetic trench and surface layers. Run it with the Python
+interpreter of QGIS (e.g. from the OSGeo4W shell):
+
+  python benchmarks/statistics.py            # 10k, 100k and 1M features
+  python benchmarks/statistics.py 5000 20000 # custom layer sizes
+
+For every size, both backends compute the trench and surface statistics into a
+temporary directory. The script reports the runtimes and fails if the raw sums
+or the generated LaTeX/Excel inputs of both backends differ.
+'''
+import os, sys, time, random, tempfile, importlib.util
+from os import path as osp
+
+from qgis.core import *
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+TRENCH_BELAG = ['a', 't', 'g', 'm', 'k', 'c', 'x']
+SURFACE_BELAG = ['a', 'b', 't', 'g', 'v', 'm', 'n', 'x', 'sa', 'sb', 'st', 'sg', 'sv', 'sm', 'sn', 'sx']
+CROSSINGS = ['Bahn', 'Bach', 'Bundesstraße']
+
+
+def load_plugin():
+    spec = importlib.util.spec_from_file_location(
+        'auswertungstools', osp.join(ROOT, '__init__.py'), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['auswertungstools'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def trench_layer(size, rng):
+    layer = QgsVectorLayer(
+        'LineString?crs=EPSG:25832&field=Belag:string&field=Verfahren:string&field=In_Strasse:boolean'
+        '&field=Handschachtung:boolean&field=Privatweg:boolean&field=Sonderquerung:string',
+        'Trenches', 'memory'
+    )
+    features = []
+    for i in range(size):
+        x = 400000 + rng.random() * 10000
+        y = 5500000 + rng.random() * 10000
+        points = [QgsPointXY(x, y), QgsPointXY(x + rng.random() * 50, y + rng.random() * 50)]
+        belag = rng.choice(TRENCH_BELAG)
+        feature = QgsFeature(layer.fields())
+        feature.setGeometry(QgsGeometry.fromPolylineXY(points))
+        feature.setAttributes([
+            belag,
+            rng.choice(['r', 'h']) if belag == 'c' else None,
+            rng.random() < 0.5,
+            rng.random() < 0.1,
+            rng.random() < 0.2,
+            rng.choice(CROSSINGS) if rng.random() < 0.001 else None,
+        ])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def surface_layer(size, rng):
+    layer = QgsVectorLayer(
+        'Polygon?crs=EPSG:25832&field=Belag:string&field=Typ:string&field=Handschachtung:boolean',
+        'Oberflächen', 'memory'
+    )
+    features = []
+    for i in range(size):
+        x = 400000 + rng.random() * 10000
+        y = 5500000 + rng.random() * 10000
+        w = 1 + rng.random() * 20
+        h = 1 + rng.random() * 20
+        feature = QgsFeature(layer.fields())
+        feature.setGeometry(QgsGeometry.fromRect(QgsRectangle(x, y, x + w, y + h)))
+        feature.setAttributes([rng.choice(SURFACE_BELAG), rng.choice(['b', 's']), rng.random() < 0.05])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def read_outputs(directory):
+    result = {}
+    for folder, subfolders, files in os.walk(directory):
+        for file in files:
+            with open(osp.join(folder, file), 'rb') as f:
+                result[osp.relpath(osp.join(folder, file), directory)] = f.read()
+    return result
+
+
+def raw_sums(plugin, layer, backend):
+    area_to_length = '$area / (CASE WHEN "Typ" = \'b\' THEN 1.281 ELSE 5.787 END)'
+    aggregation = plugin.Aggregation.create(layer, plugin.MeasureCache(), backend)
+    buckets = [aggregation.add(f'"Belag" = \'{belag}\'', area_to_length) for belag in SURFACE_BELAG]
+    buckets.append(aggregation.add('"Handschachtung"', '$area'))
+    aggregation.run()
+    return [bucket.value for bucket in buckets]
+
+
+def run_backend(plugin, backend, trenches, surfaces):
+    destination = tempfile.mkdtemp(prefix=f'statistics-{backend}-')
+    os.makedirs(osp.join(destination, 'Praesentation'))
+
+    data = plugin.dotdict()
+    data.destination = destination
+    data.trenches = trenches
+    data.surfaces = surfaces
+    data.selection = [{ 'Name DNP': 'Benchmark', 'Strassenmeter': 100000 }]
+    data.number_special = '0'
+    data.backend = backend
+    data.measures = plugin.MeasureCache()
+    data.surface_workbook = plugin.GeneratePresentation.surface_workbook(data)
+
+    timings = {}
+    start = time.perf_counter()
+    plugin.GeneratePresentation.calculate_trench_lengths(data)
+    timings['trenches'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plugin.GeneratePresentation.calculate_surface_statistics(data)
+    timings['surfaces'] = time.perf_counter() - start
+
+    return timings, read_outputs(destination)
+
+
+def main(sizes):
+    app = QgsApplication([], False)
+    app.initQgis()
+    QgsProject.instance().setEllipsoid('EPSG:7019')
+    plugin = load_plugin()
+    if plugin.np is None:
+        print('NumPy is not available, nothing to compare.')
+        return 1
+
+    failed = False
+    print(f'{"features":>10} {"backend":>10} {"trenches":>10} {"surfaces":>10}')
+    for size in sizes:
+        rng = random.Random(size)
+        trenches = trench_layer(size, rng)
+        surfaces = surface_layer(size, rng)
+
+        outputs = {}
+        for backend in ['expression', 'numpy']:
+            timings, outputs[backend] = run_backend(plugin, backend, trenches, surfaces)
+            print(f'{size:>10} {backend:>10} {timings["trenches"]:>9.2f}s {timings["surfaces"]:>9.2f}s')
+
+        # the generated xlsx files contain timestamps, so only compare the LaTeX output
+        tex = lambda files: { name: content for (name, content) in files.items() if name.endswith('.tex') }
+        if tex(outputs['expression']) != tex(outputs['numpy']):
+            print(f'{size:>10} output of the backends differs!')
+            failed = True
+
+        expected = raw_sums(plugin, surfaces, 'expression')
+        actual = raw_sums(plugin, surfaces, 'numpy')
+        if [repr(x) for x in expected] != [repr(x) for x in actual]:
+            print(f'{size:>10} raw sums of the backends differ: {expected} != {actual}')
+            failed = True
+
+    app.exitQgis()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000, 1000000]
+    sys.exit(main(sizes))
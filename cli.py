@@ -0,0 +1,568 @@
+'''
+Runs the evaluation pipelines of the plugin with QGIS but without its GUI,
+e.g. from cron on a build server. Run it with the Python interpreter of QGIS:
+
+  python cli.py --project projekt.qgz --pipeline trenches --polygons Polygone \
+      --filter "\"Name DNP\" = 'Musterstadt'" --layer poi=Fotopunkte \
+      --layer addresses=Adressen --layer trenches=Trenches --set kunde=GF+ \
+      --destination /out/musterstadt
+
+  python cli.py jobs.json --processes 4
+
+A job file holds the project and a list of jobs with the same keys as the
+arguments above (a job may also name its own project):
+
+  {
+    "project": "projekt.qgz",
+    "jobs": [
+      {
+        "pipeline": "trenches",
+        "polygons": "Polygone",
+        "filter": "\"Name DNP\" = 'Musterstadt'",
+        "layers": { "poi": "Fotopunkte", "addresses": "Adressen", "trenches": "Trenches" },
+        "metadata": { "kunde": "GF+" },
+        "destination": "/out/musterstadt",
+        "incremental": true
+      }
+    ]
+  }
+
+Relative paths of the project, destination and summary in a job file are
+relative to the job file.
+
+The pipelines are template_surfaces, trenches and surfaces. The polygons are
+selected by feature ids ("ids") or an expression ("filter"). The fields of the
+dialog that are not given in "metadata" keep their defaults, and layers that
+are not given are left empty, except for the background, which defaults to
+the layer "OpenStreetMap". The pipelines are driven by the same TaskQueue as
+in QGIS. With several jobs, every job runs in a process of its own, at most
+--processes at a time.
+
+Batch mode evaluates every group of polygons with the same value of a field
+(--group-by "Name DNP", in a job file "group_by"), or only the listed
+"groups". "{group}" in the destination is replaced by the group, otherwise a
+folder per group is created in it:
+
+  python cli.py --project projekt.qgz --polygons Polygone --group-by "Name DNP" \
+      --layer poi=Fotopunkte --layer addresses=Adressen --layer trenches=Trenches \
+      --destination "/out/{group}" --summary /out/zusammenfassung.csv
+
+The groups are distributed over --processes worker processes. Each worker
+loads the project once, copies the features of the layers within all of its
+groups into memory, builds their spatial indexes and then runs the groups one
+after another on this shared data. Finally, a summary of the status, runtime
+and number of output files of every group is printed (and written as CSV to
+--summary or "summary").
+
+With --compile (in a job file "compile": true), the presentations are finally
+compiled to PDF with LaTeX. In batch mode, the presentations of all groups are
+compiled together once the workers are done, --processes at a time, and the
+compile times are added to the summary.
+
+The detail maps of the Fotopunkte are rendered within QGIS, or with
+--export-processes (in a job file "export_processes") by as many processes of
+their own.
+
+The trench and surface statistics are computed with QGIS expressions, or with
+--statistics-backend numpy (in a job file "statistics_backend": "numpy") from
+arrays, if NumPy is installed.
+
+Every run writes the runtime, CPU time, peak memory and feature counts of its
+steps to .auswertungstools-timings.json in the destination, and prints its
+slowest steps. With --profile (in a job file "profile": true), every step
+additionally runs under cProfile, see .auswertungstools-profiles.
+'''
+import os, sys, csv, json, time, shutil, argparse, tempfile, subprocess, importlib.util
+from os import path as osp
+
+ROOT = osp.dirname(osp.abspath(__file__))
+
+# pipeline: (method starting it, method showing its dialog, method preparing its form)
+PIPELINES = {
+    'template_surfaces': ('template_surfaces', 'show_template_surfaces_dialog', 'template_surfaces_form'),
+    'trenches': ('evaluate_trenches', 'show_trenches_dialog', 'trenches_form'),
+    'surfaces': ('evaluate_surfaces', 'show_surfaces_dialog', 'surfaces_form'),
+}
+
+
+def load_plugin():
+    spec = importlib.util.spec_from_file_location(
+        'auswertungstools', osp.join(ROOT, '__init__.py'), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['auswertungstools'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def find_layer(name):
+    from qgis.core import QgsProject
+    layers = QgsProject.instance().mapLayersByName(name)
+    if len(layers) == 0:
+        raise RuntimeError(f'Layer "{name}" nicht im Projekt gefunden.')
+    return layers[0]
+
+
+'''
+Create a GeneratePresentation that takes the user input from a job instead of
+a dialog and reports to the console instead of the message bar. Layers in
+shared (key: (project layer, copy in memory, spatial index of the copy)) are
+selected from their copy.
+'''
+def headless_presentation(plugin, job, on_finished, shared={}):
+    from qgis.PyQt.QtCore import QDate
+
+    class HeadlessPresentation(plugin.GeneratePresentation):
+        def __init__(self):
+            super().__init__(None)
+            self.label = osp.basename(osp.normpath(job['destination']))
+            self.error = None
+
+        def fill_form(self, form, data, resolve):
+            polygons = find_layer(job['polygons'])
+            if 'ids' in job:
+                polygons.selectByIds(job['ids'])
+            elif 'filter' in job:
+                polygons.selectByExpression(job['filter'])
+            else:
+                raise RuntimeError('Keine Polygone ausgewählt ("ids" oder "filter" fehlt).')
+
+            os.makedirs(job['destination'], exist_ok=True)
+            self.destination_directory = job['destination']
+            (text_fields, layer_fields) = form(data, polygons)
+
+            metadata = dict(job.get('metadata', {}))
+            for key in ['incremental', 'compile', 'export_processes', 'statistics_backend']:
+                if key in job:
+                    metadata[key] = job[key]
+            for key, field in text_fields.items():
+                value = metadata.get(key, field['value'])
+                if isinstance(field['value'], QDate) and isinstance(value, str):
+                    value = QDate.fromString(value, 'dd.MM.yyyy')
+                if 'choices' in field and value not in field['choices']:
+                    raise RuntimeError(f'Ungültiger Wert "{value}" für "{key}", möglich: {", ".join(field["choices"])}.')
+                data[key] = value
+
+            names = job.get('layers', {})
+            for key, options in layer_fields.items():
+                if key in shared:
+                    layer = shared[key][0]
+                else:
+                    layer = find_layer(names[key]) if key in names else options.get('default')
+                if not layer:
+                    if 'required' in options:
+                        raise RuntimeError(f'Kein Layer für "{key}" angegeben.')
+                    data[key] = None
+                    continue
+
+                if 'required' in options:
+                    allowed = plugin.LayerSelector.layers_with_fields(options['required'], options.get('renderer'))
+                    if layer not in allowed:
+                        raise RuntimeError(f'Layer "{layer.name()}" fehlen Attributfelder oder Renderer für "{key}".')
+                if 'select_features' in options:
+                    projection = options.get('projection')
+                    index = None
+                    if key in shared:
+                        (source, layer, index) = shared[key]
+                    layer = plugin.LayerSelector.select_features(layer, data.selection, False, projection, index)
+                data[key] = layer
+
+            data.destination = job['destination']
+            resolve(data)
+
+        def show_template_surfaces_dialog(self, data, resolve, reject):
+            self.fill_form(self.template_surfaces_form, data, resolve)
+
+        def show_trenches_dialog(self, data, resolve, reject):
+            self.fill_form(self.trenches_form, data, resolve)
+
+        def show_surfaces_dialog(self, data, resolve, reject):
+            self.fill_form(self.surfaces_form, data, resolve)
+
+        def print_progress(self, progress):
+            print(f'[{self.label}] {round(progress * 100)} %', file=sys.stderr, flush=True)
+
+        def print_error(self, e):
+            self.error = e
+            on_finished()
+
+        def show_success(self, data):
+            plugin.GeneratePresentation.close_run(data)
+            for (path, seconds) in (data.compile_timings or {}).items():
+                print(f'[{self.label}] PDF {osp.basename(path)}: {seconds:.1f} s', file=sys.stderr, flush=True)
+            for (name, seconds) in data.profiler.slowest(3) if data.profiler else []:
+                print(f'[{self.label}] {name}: {seconds:.1f} s', file=sys.stderr, flush=True)
+            on_finished()
+
+    return HeadlessPresentation()
+
+
+def start_qgis():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication
+    app = QgsApplication([], False)
+    app.initQgis()
+    return app
+
+
+def read_project(path):
+    from qgis.core import QgsProject
+    if not QgsProject.instance().read(path):
+        raise RuntimeError(f'Projekt "{path}" konnte nicht geladen werden.')
+
+
+'''
+Run the pipeline of the job until it succeeded or failed. Returns the error,
+if any.
+'''
+def run_pipeline(plugin, job, shared={}, export_processes=None):
+    from qgis.core import QgsApplication
+    from qgis.PyQt.QtCore import QEventLoop
+
+    loop = QEventLoop()
+    finished = []
+    def on_finished():
+        finished.append(True)
+        loop.quit()
+
+    presentation = headless_presentation(plugin, job, on_finished, shared)
+    if export_processes:
+        presentation.export_processes = export_processes
+    presentation.profile_tasks = bool(job.get('profile'))
+    getattr(presentation, PIPELINES[job['pipeline']][0])()
+    if not finished:
+        loop.exec_()
+
+    # let aborted background tasks wind down before going on
+    QgsApplication.taskManager().cancelAll()
+    while QgsApplication.taskManager().countActiveTasks() > 0:
+        QgsApplication.processEvents()
+        time.sleep(0.05)
+
+    if presentation.error:
+        print(f'[{presentation.label}] Fehler: {presentation.error}', file=sys.stderr)
+    return presentation.error
+
+
+def run_job(job):
+    app = start_qgis()
+    try:
+        read_project(job['project'])
+        error = run_pipeline(load_plugin(), job)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        error = e
+    finally:
+        app.exitQgis()
+    return 1 if error else 0
+
+
+def group_destination(job, group):
+    name = str(group).replace('/', '-').replace('\\', '-')
+    if '{group}' in job['destination']:
+        return job['destination'].replace('{group}', name)
+    return osp.join(job['destination'], name)
+
+
+def group_filter(job, group):
+    from qgis.core import QgsExpression
+    return f'{QgsExpression.quotedColumnRef(job["group_by"])} = {QgsExpression.quotedValue(group)}'
+
+
+def batch_groups(job):
+    if 'groups' in job:
+        return list(job['groups'])
+    polygons = find_layer(job['polygons'])
+    index = polygons.fields().indexFromName(job['group_by'])
+    if index < 0:
+        raise RuntimeError(f'Layer "{polygons.name()}" hat kein Attributfeld "{job["group_by"]}".')
+    values = [value for value in polygons.uniqueValues(index) if value is not None and value != '']
+    return sorted(values, key=str)
+
+
+'''
+Copy the features of the given layers within the polygons of all groups into
+memory and index them, so that the groups are selected from these copies.
+'''
+def share_layers(plugin, job, groups):
+    from qgis.core import QgsFeatureRequest, QgsExpression, QgsSpatialIndex, QgsVectorLayer
+
+    polygons = find_layer(job['polygons'])
+    expression = ' OR '.join([group_filter(job, group) for group in groups])
+    selection = list(polygons.getFeatures(QgsFeatureRequest(QgsExpression(expression))))
+
+    shared = {}
+    for key, name in job.get('layers', {}).items():
+        source = find_layer(name)
+        if not isinstance(source, QgsVectorLayer) or source == polygons:
+            continue
+        # only what the evaluations read of the layer is copied
+        projection = plugin.GeneratePresentation.projection(key)
+        view = plugin.GeneratePresentation.features_within_polygons(source, selection, projection)
+        # views of files are read from disk, the groups read from memory instead
+        copy = plugin.GeneratePresentation.editable_copy(view, projection)
+        index = QgsSpatialIndex(copy.getFeatures(), None, QgsSpatialIndex.FlagStoreFeatureGeometries)
+        shared[key] = (source, copy, index)
+    return shared
+
+
+def run_batch_worker(job, worker, workers, results_path):
+    app = start_qgis()
+    results = []
+    try:
+        read_project(job['project'])
+        plugin = load_plugin()
+        groups = batch_groups(job)[worker::workers]
+        shared = share_layers(plugin, job, groups) if len(groups) > 0 else {}
+
+        for group in groups:
+            group_job = dict(job)
+            group_job['filter'] = group_filter(job, group)
+            group_job['destination'] = group_destination(job, group)
+            # the presentations of all groups are compiled together in the end
+            group_job['compile'] = False
+            start = time.perf_counter()
+            error = run_pipeline(plugin, group_job, shared)
+            outputs = sum([len(files) for (folder, subfolders, files) in os.walk(group_job['destination'])])
+            results.append({
+                'group': group,
+                'status': 'Fehler' if error else 'ok',
+                'error': str(error) if error else '',
+                'seconds': time.perf_counter() - start,
+                'outputs': outputs,
+                'destination': group_job['destination'],
+                'documents': plugin.GeneratePresentation.presentation_documents(group_job['destination'])
+                    if job.get('compile') and not error else [],
+            })
+    except Exception as e:
+        print(e, file=sys.stderr)
+        results.append({ 'group': None, 'status': 'Fehler', 'error': str(e) })
+    finally:
+        with open(results_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        app.exitQgis()
+    return 0 if all([r['status'] == 'ok' for r in results]) else 1
+
+
+'''
+Compile the presentations of all groups of a batch at once, processes at a
+time, and add the compile times and errors to the results of the groups.
+'''
+def compile_batch(results, processes):
+    from qgis.PyQt.QtCore import QEventLoop
+
+    documents = [(path, r) for r in results for path in r.get('documents', [])]
+    if len(documents) == 0:
+        return
+
+    app = start_qgis()
+    plugin = load_plugin()
+    formats = osp.join(plugin.GeneratePresentation.cache_directory(), 'formats')
+    compiler = plugin.LatexCompiler(processes=processes, formats=formats)
+    for (path, r) in documents:
+        compiler.add(path)
+
+    loop = QEventLoop()
+    def on_progress(fraction):
+        print(f'[PDF] {round(fraction * 100)} %', file=sys.stderr, flush=True)
+    try:
+        compiler.start(loop.quit, lambda e: loop.quit(), on_progress)
+        if not compiler.closed:
+            loop.exec_()
+    except RuntimeError as e:
+        compiler.errors = { path: str(e) for (path, r) in documents }
+
+    for (path, r) in documents:
+        r['compile_seconds'] = r.get('compile_seconds', 0) + compiler.timings.get(path, 0)
+        if path in compiler.errors:
+            r['status'] = 'Fehler'
+            r['error'] = compiler.errors[path]
+    app.exitQgis()
+
+
+'''
+Run the groups of a batch job in worker processes and summarize the results.
+'''
+def run_batch(job_file, i, job, processes):
+    workers = max(min(processes, len(job['groups'])) if 'groups' in job else processes, 1)
+    directory = tempfile.mkdtemp(prefix='auswertungstools-')
+    try:
+        running = []
+        for k in range(workers):
+            results_path = osp.join(directory, f'results{k}.json')
+            command = [
+                sys.executable, osp.abspath(__file__), job_file, '--job', str(i),
+                '--worker', str(k), '--workers', str(workers), '--results', results_path
+            ]
+            running.append((subprocess.Popen(command), results_path))
+
+        results = []
+        for (process, results_path) in running:
+            process.wait()
+            if osp.exists(results_path):
+                with open(results_path, encoding='utf-8') as f:
+                    results += json.load(f)
+            else:
+                results.append({ 'group': None, 'status': 'Fehler', 'error': f'Exit-Code {process.returncode}' })
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if job.get('compile'):
+        compile_batch(results, processes)
+
+    results.sort(key=lambda r: str(r['group']))
+    print(f'{"Gruppe":<30} {"Status":>8} {"Dauer":>9} {"PDF":>9} {"Dateien":>8}')
+    for r in results:
+        print(
+            f'{str(r["group"]):<30} {r["status"]:>8} {r.get("seconds", 0):>8.1f}s '
+            f'{r.get("compile_seconds", 0):>8.1f}s {r.get("outputs", 0):>8}'
+        )
+    seconds = sum([r.get('seconds', 0) for r in results])
+    compile_seconds = sum([r.get('compile_seconds', 0) for r in results])
+    outputs = sum([r.get('outputs', 0) for r in results])
+    print(f'{"Summe":<30} {"":>8} {seconds:>8.1f}s {compile_seconds:>8.1f}s {outputs:>8}')
+
+    if job.get('summary'):
+        with open(job['summary'], 'w', encoding='utf-8', newline='') as f:
+            columns = ['group', 'status', 'seconds', 'compile_seconds', 'outputs', 'destination', 'error']
+            writer = csv.DictWriter(f, columns, delimiter=';', extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+
+    return 0 if all([r['status'] == 'ok' for r in results]) else 1
+
+
+def run(job_file, i, job, processes):
+    if 'group_by' in job:
+        return run_batch(job_file, i, job, processes)
+    return run_job(job)
+
+
+'''
+Run every job in a process of its own, at most processes at a time, and print
+a summary of their runtimes. The processes are divided among the jobs running
+at once, so that batch jobs do not each start as many workers.
+'''
+def run_jobs(job_file, jobs, processes):
+    share = max(processes // min(processes, len(jobs)), 1)
+    pending = list(range(len(jobs)))
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < processes:
+            i = pending.pop(0)
+            command = [sys.executable, osp.abspath(__file__), job_file, '--job', str(i), '--processes', str(share)]
+            running[i] = (subprocess.Popen(command), time.perf_counter())
+
+        for i, (process, start) in list(running.items()):
+            if process.poll() is not None:
+                results[i] = (process.returncode, time.perf_counter() - start)
+                del running[i]
+        time.sleep(0.1)
+
+    print(f'{"Job":>4} {"Status":>8} {"Dauer":>9}  Ziel')
+    for i, job in enumerate(jobs):
+        (code, seconds) = results[i]
+        status = 'ok' if code == 0 else 'Fehler'
+        print(f'{i:>4} {status:>8} {seconds:>8.1f}s  {job["destination"]}')
+    return 0 if all([code == 0 for (code, seconds) in results.values()]) else 1
+
+
+def read_jobs(path):
+    with open(path, encoding='utf-8') as f:
+        content = json.load(f)
+    jobs = content['jobs'] if 'jobs' in content else [content]
+    # paths in the job file are relative to it
+    directory = osp.dirname(osp.abspath(path))
+    for job in jobs:
+        if 'project' not in job:
+            job['project'] = content['project']
+        for key in ['project', 'destination', 'summary']:
+            if job.get(key):
+                job[key] = osp.join(directory, job[key])
+    return jobs
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description='Auswertungen ohne QGIS-Oberfläche erstellen.')
+    parser.add_argument('job_file', nargs='?', help='JSON-Datei mit Aufträgen')
+    parser.add_argument('--job', type=int, help='nur diesen Auftrag der Datei ausführen')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Aufträge gleichzeitig')
+    parser.add_argument('--project', help='QGIS-Projektdatei')
+    parser.add_argument('--pipeline', choices=list(PIPELINES.keys()), default='trenches')
+    parser.add_argument('--polygons', help='Layer mit den Polygonen')
+    parser.add_argument('--ids', type=int, nargs='+', help='Objekt-IDs der Polygone')
+    parser.add_argument('--filter', help='Ausdruck zur Auswahl der Polygone')
+    parser.add_argument('--layer', action='append', default=[], metavar='FELD=LAYER', help='Layer für ein Feld')
+    parser.add_argument('--set', action='append', default=[], metavar='FELD=WERT', help='Metadaten, z.B. kunde=GF+')
+    parser.add_argument('--destination', help='Zielordner')
+    parser.add_argument('--incremental', action='store_true', help='nur Geändertes neu erstellen')
+    parser.add_argument('--compile', action='store_true', help='Präsentation als PDF kompilieren')
+    parser.add_argument('--profile', action='store_true', help='jeden Schritt mit cProfile messen')
+    parser.add_argument('--export-processes', type=int, help='Prozesse für die Karten der Fotopunkte')
+    parser.add_argument('--statistics-backend', choices=['expression', 'numpy'], help='Berechnung der Statistiken')
+    parser.add_argument('--group-by', help='Attributfeld, nach dem die Polygone gruppiert werden (Batch)')
+    parser.add_argument('--groups', nargs='+', help='nur diese Gruppen auswerten (Batch)')
+    parser.add_argument('--summary', help='CSV-Datei für die Zusammenfassung (Batch)')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--results', help=argparse.SUPPRESS)
+    return parser.parse_args(arguments)
+
+
+def main(arguments):
+    args = parse_arguments(arguments)
+
+    if args.job_file:
+        jobs = read_jobs(args.job_file)
+        if args.worker is not None:
+            return run_batch_worker(jobs[args.job], args.worker, args.workers, args.results)
+        if args.job is not None:
+            return run(args.job_file, args.job, jobs[args.job], args.processes)
+        if len(jobs) == 1:
+            return run(args.job_file, 0, jobs[0], args.processes)
+        return run_jobs(args.job_file, jobs, args.processes)
+
+    if not args.project or not args.polygons or not args.destination:
+        print('--project, --polygons und --destination werden benötigt.', file=sys.stderr)
+        return 2
+
+    job = {
+        'project': osp.abspath(args.project),
+        'pipeline': args.pipeline,
+        'polygons': args.polygons,
+        'layers': dict([item.split('=', 1) for item in args.layer]),
+        'metadata': dict([item.split('=', 1) for item in args.set]),
+        'destination': osp.abspath(args.destination),
+        'incremental': args.incremental,
+        'compile': args.compile,
+        'profile': args.profile,
+    }
+    if args.export_processes:
+        job['export_processes'] = args.export_processes
+    if args.statistics_backend:
+        job['statistics_backend'] = args.statistics_backend
+    if args.ids:
+        job['ids'] = args.ids
+    if args.filter:
+        job['filter'] = args.filter
+    if not args.group_by:
+        return run_job(job)
+
+    job['group_by'] = args.group_by
+    if args.groups:
+        job['groups'] = args.groups
+    if args.summary:
+        job['summary'] = osp.abspath(args.summary)
+    # the workers read the job from a file
+    (handle, job_file) = tempfile.mkstemp(prefix='auswertungstools-', suffix='.json')
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8') as f:
+            json.dump({ 'jobs': [job] }, f)
+        return run_batch(job_file, 0, job, args.processes)
+    finally:
+        os.remove(job_file)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+'''
+Worker process of the ExportPool: renders map PDFs with QGIS without GUI.
+
+  python export_worker.py jobs.json
+
+The job file lists the layers (source, provider and QML style) and the jobs
+(extent and destination). After every finished job, "done <index>" is printed.
+'''
+import sys, json, importlib.util
+from os import path as osp
+
+from qgis.core import *
+from qgis.PyQt.QtXml import QDomDocument
+
+ROOT = osp.dirname(osp.abspath(__file__))
+
+
+def load_plugin():
+    spec = importlib.util.spec_from_file_location(
+        'auswertungstools', osp.join(ROOT, '__init__.py'), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['auswertungstools'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_layer(options):
+    if options['type'] == 'raster':
+        layer = QgsRasterLayer(options['source'], options['name'], options['provider'])
+    else:
+        layer = QgsVectorLayer(options['source'], options['name'], options['provider'])
+    if not layer.isValid():
+        raise RuntimeError(f'Layer "{options["name"]}" konnte nicht geladen werden.')
+    if options.get('subset'):
+        # views of a layer (see GeneratePresentation.layer_view)
+        layer.setSubsetString(options['subset'])
+
+    doc = QDomDocument()
+    doc.setContent(options['style'])
+    layer.importNamedStyle(doc)
+    QgsProject.instance().addMapLayer(layer, False)
+    return layer
+
+
+def main(job_file):
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    with open(job_file) as f:
+        job = json.load(f)
+
+    project = QgsProject.instance()
+    project.setCrs(QgsCoordinateReferenceSystem.fromWkt(job['crs']))
+    project.setEllipsoid(job['ellipsoid'])
+
+    plugin = load_plugin()
+    layers = [load_layer(options) for options in job['layers']]
+    renderer = plugin.MapRenderer(job['image_width'], job['image_height'])
+    for item in job['jobs']:
+        extent = QgsRectangle(*item['extent'])
+        renderer.render(layers, item['destination'], extent, job['zoom_factor'])
+        print(f'done {item["index"]}', flush=True)
+    renderer.close()
+
+    app.exitQgis()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1]))
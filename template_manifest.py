@@ -0,0 +1,100 @@
+'''
+Manifest of the presentation templates (template/manifest.json), listing the
+files of every template folder with size and checksum and whether they may be
+deployed as hard link. Only read-only assets (LINKABLE) may be linked. All
+files that the evaluations write to or the user edits are cloned or copied,
+including the example images that the analysts replace for every Ort. Update
+the manifest after changing a template:
+
+  python template_manifest.py
+
+If the listed files or their sizes no longer match the template folders, the
+manifest is built from the folders instead (with a warning), so that a
+forgotten update never leaves a file undeployed.
+'''
+import os, sys, json, hashlib, warnings
+from os import path as osp
+
+TEMPLATE = osp.join(osp.dirname(osp.abspath(__file__)), 'template')
+VERSION = 2
+# paths within a template folder that are never edited in a destination
+LINKABLE = ['Bilder/Logo.png']
+
+
+def checksum(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build(template=TEMPLATE):
+    folders = {}
+    for name in sorted(os.listdir(template)):
+        root = osp.join(template, name)
+        if not osp.isdir(root):
+            continue
+
+        files = []
+        directories = []
+        for folder, subfolders, names in os.walk(root):
+            subfolders.sort()
+            relative = osp.relpath(folder, root)
+            if relative != '.':
+                directories.append(relative.replace(os.sep, '/'))
+            for file in sorted(names):
+                path = osp.join(folder, file)
+                file_path = osp.relpath(path, root).replace(os.sep, '/')
+                files.append({
+                    'path': file_path,
+                    'size': osp.getsize(path),
+                    'sha1': checksum(path),
+                    'link': file_path in LINKABLE,
+                })
+        folders[name] = { 'directories': directories, 'files': files }
+
+    return { 'version': VERSION, 'folders': folders }
+
+
+def listing(template=TEMPLATE):
+    files = set()
+    for name in os.listdir(template):
+        root = osp.join(template, name)
+        if not osp.isdir(root):
+            continue
+        for folder, subfolders, names in os.walk(root):
+            for file in names:
+                path = osp.join(folder, file)
+                files.add((name, osp.relpath(path, root).replace(os.sep, '/'), osp.getsize(path)))
+    return files
+
+
+'''
+Determine whether the manifest lists exactly the files of the template
+folders, with their current sizes.
+'''
+def matches(manifest, template=TEMPLATE):
+    listed = set()
+    for (name, folder) in manifest['folders'].items():
+        listed.update([(name, file['path'], file['size']) for file in folder['files']])
+    return listed == listing(template)
+
+
+def load(template=TEMPLATE):
+    path = osp.join(template, 'manifest.json')
+    if osp.exists(path):
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == VERSION and matches(manifest, template):
+            return manifest
+        warnings.warn(f'{path} is outdated, run template_manifest.py to update it.')
+    return build(template)
+
+
+if __name__ == '__main__':
+    manifest = build()
+    with open(osp.join(TEMPLATE, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    sys.exit(0)